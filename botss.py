@@ -1,102 +1,637 @@
 import time
+_BOOT_MONO = time.monotonic()  # точка отсчёта для замера времени до первого действия
+
 import threading
 import requests
 import telebot
 from telebot import types
-from tronpy import Tron
-from tronpy.providers import HTTPProvider
-from tronpy.keys import PrivateKey
 import os
 import re
+import sys
+import fcntl
+import socket
+import socketserver
+import queue
 import logging
 import json
+import io
+import random
+import csv
+import collections
+import uuid
+import concurrent.futures
+import codecs
+import struct
+from array import array
 from datetime import datetime, timedelta, timezone
-from typing import List, Dict, Tuple
-
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
+from types import MappingProxyType
+from typing import List, Dict, Tuple, NamedTuple
+# tronpy тяжёлый (криптография, abi) и нужен только для подписи транзакций — импортируется лениво, см. _get_tron()
 
-# Часовой пояс UTC+3
-zone_time = int(os.getenv("zone_time"))
-TZ_MOSCOW = timezone(timedelta(hours=zone_time))
-last_check_time = datetime.min.replace(tzinfo=TZ_MOSCOW)
 
 # Настройка логирования в начале файла (должна быть)
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
-logging.basicConfig(level=logging.error, format='%(asctime)s - %(levelname)s - %(message)s')
-logging.basicConfig(level=logging.warning, format='%(asctime)s - %(levelname)s - %(message)s')
 
 path_json_otl = "/app/scheduled_tasks.json"
 SETTINGS_PATH = "/app/bot_settings.json"
+TELEMETRY_PATH = "/app/energy_telemetry.bin"
+LEDGER_PATH = "/app/cluster_ledger.jsonl"
+ROLLUPS_PATH = "/app/ledger_rollups.json"
+TUNABLES_PATH = "/app/tunables.json"
 
 
-# Инициализация флага (фактическое значение будет загружено из файла)
-MONITORING_ENABLED = False
 
 
-# Получаем токен бота
-try:
-    API_TOKEN = os.getenv("API_TOKEN")
-except:
-    logging.info("API_TOKEN бота не задан в .env")
-bot = telebot.TeleBot(API_TOKEN)
 
+#---------------------------------------------------- Загрузка конфигурации ----------------------------------------------------------
+class Tunables(NamedTuple):
+    """
+    Параметры расписания, которые меняются без перезапуска: командой /set или правкой TUNABLES_PATH.
+    Объект неизменяемый и подменяется целиком, поэтому код, один раз взявший TUNABLES, видит согласованный набор.
+    """
+    CHECK_INTERVAL_MINUTES: int  # как часто проверяем входящие делегации
+    SLICE_MINUTES: int  # разрыв между задачами, который ещё склеивается в один кластер
+    TIME_BUY_ENERGY: int  # через сколько минут от входящей аренды прячем энергию
+    AUTO_HOLD_MINUTES: int  # на сколько минут прячем автоматически
 
 
-# Преобразуем строку ADMIN_IDS в список целых чисел
-try:
-    ADMIN_IDS = [int(i.strip()) for i in os.getenv("ADMIN_IDS").split(',')]
-except:
-    logging.info("❌ Ошибка: ADMIN_IDS должны быть заданы как список чисел через запятую в .env.")
-    ADMIN_IDS = []
+def _tunables_errors(values: Dict) -> List[str]:
+    errors = []
+    for name in ("CHECK_INTERVAL_MINUTES", "AUTO_HOLD_MINUTES"):
+        if values[name] <= 0:
+            errors.append(f"{name}: должно быть больше нуля")
+    for name in ("SLICE_MINUTES", "TIME_BUY_ENERGY"):
+        if values[name] < 0:
+            errors.append(f"{name}: не может быть отрицательным")
+    return errors
 
 
+def _load_env_config() -> Dict:
+    """
+    Читает и проверяет ВСЕ переменные окружения за один проход.
+    Если хоть одна обязательная переменная отсутствует или невалидна — печатает полный список ошибок и завершает процесс,
+    чтобы контейнер не работал с битой конфигурацией.
+    """
+    errors = []
+
+    def env_str(name):
+        value = (os.getenv(name) or "").strip()
+        if not value:
+            errors.append(f"{name}: не задана")
+        return value
+
+    def env_int(name, default=None):
+        raw = os.getenv(name)
+        if raw is None or not raw.strip():
+            if default is None:
+                errors.append(f"{name}: не задана")
+                return 0
+            return default
+        try:
+            return int(raw.strip())
+        except ValueError:
+            errors.append(f"{name}: ожидается целое число, получено {raw!r}")
+            return 0
 
+    def env_choice(name, default, choices):
+        value = (os.getenv(name) or default).strip().lower()
+        if value not in choices:
+            errors.append(f"{name}: допустимо одно из {', '.join(choices)}, получено {value!r}")
+            return default
+        return value
+
+    def env_float(name, default):
+        raw = os.getenv(name)
+        if raw is None or not raw.strip():
+            return default
+        try:
+            return float(raw.strip())
+        except ValueError:
+            errors.append(f"{name}: ожидается число, получено {raw!r}")
+            return default
+
+    cfg = {
+        "zone_time": env_int("zone_time"),
+        "TZ_NAME": (os.getenv("TZ_NAME") or "").strip(),
+        "API_TOKEN": env_str("API_TOKEN"),
+        "API_KEY_TRONSCAN": env_str("API_KEY_TRONSCAN"),
+        "API_KEY_TRONGRID": env_str("API_KEY_TRONGRID"),
+        "PRIV_KEY_MY_HEX": env_str("PRIV_KEY_MY_HEX"),
+        "PERM_ID": env_int("PERM_ID"),
+        "MAIN_WALLET": env_str("MAIN_WALLET"),
+        "STASHING_TARGET": env_str("STASHING_TARGET"),
+        "CHECK_INTERVAL_MINUTES": env_int("CHECK_INTERVAL_MINUTES"),
+        "SLICE_MINUTES": env_int("SLICE_MINUTES"),
+        "TIME_BUY_ENERGY": env_int("TIME_BUY_ENERGY"),
+        "AUTO_HOLD_MINUTES": env_int("AUTO_HOLD_MINUTES"),
+        # Необязательные, есть значения по умолчанию
+        "TX_FEE_TRX": env_float("TX_FEE_TRX", 0.35),
+        "ENERGY_FEE_SUN": env_int("ENERGY_FEE_SUN", 100),
+        "ENERGY_PRICE_TTL_MINUTES": env_int("ENERGY_PRICE_TTL_MINUTES", 10),
+        "TOPUP_INTERVAL_SECONDS": env_int("TOPUP_INTERVAL_SECONDS", 120),
+        "TOPUP_MIN_TRX": env_int("TOPUP_MIN_TRX", 100),
+        "RETRY_BASE_SECONDS": env_float("RETRY_BASE_SECONDS", 15.0),
+        "RETRY_MAX_SECONDS": env_float("RETRY_MAX_SECONDS", 600.0),
+        "RETRY_UNDELEGATE_DEADLINE_MINUTES": env_int("RETRY_UNDELEGATE_DEADLINE_MINUTES", 120),
+        "HANDLER_THREADS": env_int("HANDLER_THREADS", 4),
+        "STATUS_REFRESH_SECONDS": env_int("STATUS_REFRESH_SECONDS", 60),
+        "BACKFILL_PARALLEL": env_int("BACKFILL_PARALLEL", 3),
+        "BACKFILL_RPS": env_float("BACKFILL_RPS", 4.0),
+        "BACKFILL_PAGE_SIZE": env_int("BACKFILL_PAGE_SIZE", 50),
+        "BACKFILL_MAX_PAGES": env_int("BACKFILL_MAX_PAGES", 40),
+        "REPLICA_ID": (os.getenv("REPLICA_ID") or f"{socket.gethostname()}-{os.getpid()}").strip(),
+        "LEADER_LOCK_PATH": (os.getenv("LEADER_LOCK_PATH") or "").strip() or "/app/leader.lock",
+        "LEADER_HEARTBEAT_SECONDS": env_float("LEADER_HEARTBEAT_SECONDS", 2.0),
+        "LEADER_POLL_SECONDS": env_float("LEADER_POLL_SECONDS", 1.0),
+        "LEADER_STALE_SECONDS": env_float("LEADER_STALE_SECONDS", 30.0),
+        "ENGINE_SOCKET_PATH": (os.getenv("ENGINE_SOCKET_PATH") or "").strip() or "/app/run/engine.sock",
+        "ENGINE_CALL_TIMEOUT_SECONDS": env_float("ENGINE_CALL_TIMEOUT_SECONDS", 180.0),
+        "CLOCK_SYNC_SECONDS": env_int("CLOCK_SYNC_SECONDS", 60),
+        "CLOCK_SKEW_WARN_SECONDS": env_float("CLOCK_SKEW_WARN_SECONDS", 5.0),
+        "TRACE_ENABLED": env_int("TRACE_ENABLED", 1),
+        "TRACE_RING_SIZE": env_int("TRACE_RING_SIZE", 500),
+        "TELEMETRY_INTERVAL_SECONDS": env_int("TELEMETRY_INTERVAL_SECONDS", 300),
+        "TELEMETRY_CAPACITY": env_int("TELEMETRY_CAPACITY", 2016),
+        "AUTO_PATTERN_MODE": env_choice("AUTO_PATTERN_MODE", "off", ("off", "propose", "create")),
+        "PATTERN_SLOT_MINUTES": env_int("PATTERN_SLOT_MINUTES", 30),
+        "PATTERN_MIN_DAYS": env_int("PATTERN_MIN_DAYS", 3),
+        "PATTERN_MIN_ENERGY": env_int("PATTERN_MIN_ENERGY", 1000),
+        "REACTIVE_ENABLED": env_int("REACTIVE_ENABLED", 0),
+        "REACTIVE_FREE_ENERGY_HIGH": env_int("REACTIVE_FREE_ENERGY_HIGH", 0),
+        "REACTIVE_UNUSED_SLOT_HIGH": env_int("REACTIVE_UNUSED_SLOT_HIGH", 0),
+        "REACTIVE_HYSTERESIS": env_float("REACTIVE_HYSTERESIS", 0.2),
+        "REACTIVE_MIN_POLL_SECONDS": env_float("REACTIVE_MIN_POLL_SECONDS", 5.0),
+        "REACTIVE_MAX_POLL_SECONDS": env_float("REACTIVE_MAX_POLL_SECONDS", 60.0),
+        "REACTIVE_SETTLE_MINUTES": env_float("REACTIVE_SETTLE_MINUTES", 5.0),
+        "REACTIVE_SETTLE_ENERGY": env_int("REACTIVE_SETTLE_ENERGY", 1000),
+        "REACTIVE_MAX_HOLD_MINUTES": env_int("REACTIVE_MAX_HOLD_MINUTES", 60),
+    }
+
+    # ADMIN_IDS — список чисел через запятую
+    try:
+        cfg["ADMIN_IDS"] = [int(i.strip()) for i in env_str("ADMIN_IDS").split(',') if i.strip()]
+        if not cfg["ADMIN_IDS"]:
+            raise ValueError
+    except ValueError:
+        errors.append("ADMIN_IDS: должны быть заданы как список чисел через запятую")
 
+    # Приватный ключ проверяем без tronpy: 32 байта в hex
+    if cfg["PRIV_KEY_MY_HEX"]:
+        try:
+            if len(bytes.fromhex(cfg["PRIV_KEY_MY_HEX"])) != 32:
+                raise ValueError
+        except ValueError:
+            errors.append("PRIV_KEY_MY_HEX: ожидается 64 hex-символа")
 
-try:
-    api_key_tronscan = os.getenv("API_KEY_TRONSCAN")
-    api_key_trongrid = os.getenv("API_KEY_TRONGRID")
-    priv_key_my_hex = os.getenv("PRIV_KEY_MY_HEX")
-    PERM_ID = int(os.getenv("PERM_ID"))
-    main_wallet = os.getenv("MAIN_WALLET")
-    stashing_target = os.getenv("STASHING_TARGET")
-    CHECK_INTERVAL_MINUTES = int(os.getenv("CHECK_INTERVAL_MINUTES"))
-    SLICE_MINUTES = int(os.getenv("SLICE_MINUTES"))
-    
-    priv_key_my = PrivateKey(bytes.fromhex(priv_key_my_hex))
-    
-except Exception as e:
-    logging.info(f"❌ Критическая ошибка: Не удалось загрузить все необходимые переменные из .env. Проверьте .env. Ошибка: {e}")
+    # Именованный пояс (Europe/Moscow) учитывает переходы на летнее время, в отличие от фиксированного zone_time
+    if cfg["TZ_NAME"]:
+        try:
+            cfg["TZ"] = ZoneInfo(cfg["TZ_NAME"])
+        except (ZoneInfoNotFoundError, ValueError):
+            errors.append(f"TZ_NAME: неизвестный часовой пояс {cfg['TZ_NAME']!r}")
+    else:
+        cfg["TZ"] = timezone(timedelta(hours=cfg["zone_time"]))
+
+    # Реактивный режим: нужен хотя бы один порог, опрос от частого к редкому, гистерезис — доля порога
+    if cfg["REACTIVE_ENABLED"]:
+        if cfg["REACTIVE_FREE_ENERGY_HIGH"] <= 0 and cfg["REACTIVE_UNUSED_SLOT_HIGH"] <= 0:
+            errors.append("REACTIVE_ENABLED: задайте REACTIVE_FREE_ENERGY_HIGH и/или REACTIVE_UNUSED_SLOT_HIGH")
+        if not 0 < cfg["REACTIVE_MIN_POLL_SECONDS"] <= cfg["REACTIVE_MAX_POLL_SECONDS"]:
+            errors.append("REACTIVE_MIN_POLL_SECONDS: должно быть больше нуля и не больше REACTIVE_MAX_POLL_SECONDS")
+        if not 0 <= cfg["REACTIVE_HYSTERESIS"] < 1:
+            errors.append("REACTIVE_HYSTERESIS: ожидается доля порога от 0 до 1")
+        if cfg["REACTIVE_SETTLE_MINUTES"] <= 0 or cfg["REACTIVE_MAX_HOLD_MINUTES"] <= 0:
+            errors.append("REACTIVE_SETTLE_MINUTES / REACTIVE_MAX_HOLD_MINUTES: должны быть больше нуля")
+
+    if not 0 < cfg["RETRY_BASE_SECONDS"] <= cfg["RETRY_MAX_SECONDS"]:
+        errors.append("RETRY_BASE_SECONDS: должно быть больше нуля и не больше RETRY_MAX_SECONDS")
+
+    # Параметры расписания — той же проверкой, что и /set с tunables.json
+    errors += [e for e in _tunables_errors(cfg) if not any(x.startswith(e.split(":")[0] + ":") for x in errors)]
+
+    for name in ("HANDLER_THREADS", "STATUS_REFRESH_SECONDS",
+                 "BACKFILL_PARALLEL", "BACKFILL_PAGE_SIZE", "BACKFILL_MAX_PAGES", "TELEMETRY_CAPACITY", "PATTERN_SLOT_MINUTES",
+                 "RETRY_UNDELEGATE_DEADLINE_MINUTES"):
+        if cfg[name] <= 0 and not any(e.startswith(f"{name}:") for e in errors):
+            errors.append(f"{name}: должно быть больше нуля")
+
+    if errors:
+        logging.critical("❌ Критическая ошибка конфигурации, проверьте .env:\n  - " + "\n  - ".join(errors))
+        sys.exit(1)
+    return cfg
+
+
+_CONFIG = _load_env_config()
+
+# Часовой пояс: TZ_NAME, если задан, иначе фиксированный UTC+zone_time
+zone_time = _CONFIG["zone_time"]
+TZ_MOSCOW = _CONFIG["TZ"]
+
+API_TOKEN = _CONFIG["API_TOKEN"]
+ADMIN_IDS = _CONFIG["ADMIN_IDS"]
+api_key_tronscan = _CONFIG["API_KEY_TRONSCAN"]
+api_key_trongrid = _CONFIG["API_KEY_TRONGRID"]
+priv_key_my_hex = _CONFIG["PRIV_KEY_MY_HEX"]
+PERM_ID = _CONFIG["PERM_ID"]
+main_wallet = _CONFIG["MAIN_WALLET"]
+stashing_target = _CONFIG["STASHING_TARGET"]
+
+
+ENV_TUNABLES = Tunables(**{name: _CONFIG[name] for name in Tunables._fields})  # значения из .env — база для файла
+TUNABLES = ENV_TUNABLES  # действующие значения; меняет только apply_tunables()
+
+# Модель стоимости для планировщика кластеров
+TX_FEE_TRX = _CONFIG["TX_FEE_TRX"]  # стоимость одной транзакции delegate/undelegate (bandwidth), TRX
+ENERGY_FEE_SUN = _CONFIG["ENERGY_FEE_SUN"]  # цена 1 ед. энергии при сжигании, sun
+ENERGY_PRICE_TTL_MINUTES = _CONFIG["ENERGY_PRICE_TTL_MINUTES"]  # как часто обновляем цену энергии для модели
+
+# Догрузка (top-up) делегации во время активного кластера
+TOPUP_INTERVAL_SECONDS = _CONFIG["TOPUP_INTERVAL_SECONDS"]  # как часто проверяем освободившийся TRX (0 — выключено)
+TOPUP_MIN_TRX = _CONFIG["TOPUP_MIN_TRX"]  # минимальный прирост TRX, ради которого шлём транзакцию
+
+# Повторы транзакций планировщика, которые не прошли
+RETRY_BASE_SECONDS = _CONFIG["RETRY_BASE_SECONDS"]  # пауза перед первым повтором, дальше удваивается (со случайным разбросом)
+RETRY_MAX_SECONDS = _CONFIG["RETRY_MAX_SECONDS"]  # потолок паузы между повторами
+RETRY_UNDELEGATE_DEADLINE_MINUTES = _CONFIG["RETRY_UNDELEGATE_DEADLINE_MINUTES"]  # после стольких минут неудач возврата — тревога администраторам
+
+# Догон истории после простоя
+BACKFILL_PARALLEL = _CONFIG["BACKFILL_PARALLEL"]  # сколько страниц истории запрашивать одновременно
+BACKFILL_RPS = _CONFIG["BACKFILL_RPS"]  # не больше стольких запросов к TronScan в секунду
+BACKFILL_PAGE_SIZE = _CONFIG["BACKFILL_PAGE_SIZE"]  # транзакций на страницу
+BACKFILL_MAX_PAGES = _CONFIG["BACKFILL_MAX_PAGES"]  # предел страниц за один догон
+
+# Лидерство между репликами
+REPLICA_ID = _CONFIG["REPLICA_ID"]  # имя реплики в логах и в файле аренды
+LEADER_LOCK_PATH = _CONFIG["LEADER_LOCK_PATH"]  # общий файл аренды лидера для всех реплик
+LEADER_HEARTBEAT_SECONDS = _CONFIG["LEADER_HEARTBEAT_SECONDS"]  # как часто лидер пишет heartbeat
+LEADER_POLL_SECONDS = _CONFIG["LEADER_POLL_SECONDS"]  # как часто резерв пытается взять блокировку
+LEADER_STALE_SECONDS = _CONFIG["LEADER_STALE_SECONDS"]  # после скольких секунд без heartbeat резерв предупреждает о зависшем лидере
+
+# Разделение на процессы engine / frontend
+ENGINE_SOCKET_PATH = _CONFIG["ENGINE_SOCKET_PATH"]  # Unix-сокет, по которому фронтенд отправляет команды движку
+ENGINE_CALL_TIMEOUT_SECONDS = _CONFIG["ENGINE_CALL_TIMEOUT_SECONDS"]  # сколько фронтенд ждёт ответа движка (ручные транзакции долгие)
+
+# Часы расписания, синхронизированные с блокчейном
+CLOCK_SYNC_SECONDS = _CONFIG["CLOCK_SYNC_SECONDS"]  # как часто сверяемся с последним блоком (0 — локальные часы)
+CLOCK_SKEW_WARN_SECONDS = _CONFIG["CLOCK_SKEW_WARN_SECONDS"]  # предупреждать, если локальные часы разошлись с сетью сильнее
+
+# Трассировка фаз планировщика (кольцевой буфер в памяти)
+TRACE_ENABLED = bool(_CONFIG["TRACE_ENABLED"])
+TRACE_RING_SIZE = _CONFIG["TRACE_RING_SIZE"]
+
+# Телеметрия энергии и автопланирование по повторяющимся окнам расхода
+TELEMETRY_INTERVAL_SECONDS = _CONFIG["TELEMETRY_INTERVAL_SECONDS"]  # период сэмплирования (0 — выключено)
+TELEMETRY_CAPACITY = _CONFIG["TELEMETRY_CAPACITY"]  # сэмплов в кольце на кошелёк (2016 × 5 мин = 7 дней)
+AUTO_PATTERN_MODE = _CONFIG["AUTO_PATTERN_MODE"]  # off / propose / create
+PATTERN_SLOT_MINUTES = _CONFIG["PATTERN_SLOT_MINUTES"]  # ширина суточного слота
+PATTERN_MIN_DAYS = _CONFIG["PATTERN_MIN_DAYS"]  # в скольких разных днях должен повториться расход
+PATTERN_MIN_ENERGY = _CONFIG["PATTERN_MIN_ENERGY"]  # минимальный рост EnergyUsed между сэмплами, считающийся расходом
+
+# Реактивное скрытие по уровню энергии MAIN_WALLET
+REACTIVE_ENABLED = bool(_CONFIG["REACTIVE_ENABLED"])
+REACTIVE_FREE_ENERGY_HIGH = _CONFIG["REACTIVE_FREE_ENERGY_HIGH"]  # порог свободной энергии (0 — не используется)
+REACTIVE_UNUSED_SLOT_HIGH = _CONFIG["REACTIVE_UNUSED_SLOT_HIGH"]  # порог unused_slot, TRX (0 — не используется)
+REACTIVE_HYSTERESIS = _CONFIG["REACTIVE_HYSTERESIS"]  # новый запуск — только после падения ниже порога на эту долю
+REACTIVE_MIN_POLL_SECONDS = _CONFIG["REACTIVE_MIN_POLL_SECONDS"]  # период опроса у самого порога
+REACTIVE_MAX_POLL_SECONDS = _CONFIG["REACTIVE_MAX_POLL_SECONDS"]  # период опроса вдали от порога
+REACTIVE_SETTLE_MINUTES = _CONFIG["REACTIVE_SETTLE_MINUTES"]  # сколько EnergyUsed должен не расти, чтобы вернуть
+REACTIVE_SETTLE_ENERGY = _CONFIG["REACTIVE_SETTLE_ENERGY"]  # рост EnergyUsed за окно, который ещё считается «не растёт»
+REACTIVE_MAX_HOLD_MINUTES = _CONFIG["REACTIVE_MAX_HOLD_MINUTES"]  # вернуть не позже, даже если расход не успокоился
+
+# Обработчики Telegram выполняются пулом из HANDLER_THREADS потоков: долгая операция с кошельком
+# не замораживает остальные кнопки
+HANDLER_THREADS = _CONFIG["HANDLER_THREADS"]
+
+STATUS_REFRESH_SECONDS = _CONFIG["STATUS_REFRESH_SECONDS"]  # период фонового обновления снимка для /status
+
+bot = telebot.TeleBot(API_TOKEN, threaded=True, num_threads=HANDLER_THREADS)
+#--------------------------------------------------------------------------------------------------------------------------------
 
 
 
 
 
 # ---------------------------------------------------- Логирование ----------------------------------------------------------------
+# Уведомления администраторам отправляет отдельный поток из очереди: планировщик не ждёт Telegram,
+# и если тот недоступен, транзакции всё равно уходят вовремя.
+NOTIFY_QUEUE_SIZE = 500
+_notify_queue = queue.Queue(maxsize=NOTIFY_QUEUE_SIZE)
+
+
+def _notify_admins(msg, skip_chat_id=None):
+    log_message = f"[{datetime.now(TZ_MOSCOW).strftime('%Y-%m-%d %H:%M:%S')}]  \n{msg}"
+    try:
+        _notify_queue.put_nowait((log_message, skip_chat_id))
+    except queue.Full:
+        logging.error(f"[ERROR] Очередь уведомлений переполнена, сообщение не отправлено: {msg}")
+
+
+def notifier_worker():
+    while True:
+        log_message, skip_chat_id = _notify_queue.get()
+        for admin_id in ADMIN_IDS:
+            if admin_id == skip_chat_id:
+                continue
+            try:
+                bot.send_message(admin_id, log_message, parse_mode='Markdown', disable_web_page_preview=True)
+            except Exception as e:
+                # Используем standard logging для ошибки отправки
+                logging.info(f"[ERROR] Could not send message to {admin_id}: {e}")
+
+
 def log_error_crash(msg):
     # Используем standard logging (будет видно в Docker logs)
     logging.error(f" {msg}")
-    
-    log_message = f"[{datetime.now(TZ_MOSCOW).strftime('%Y-%m-%d %H:%M:%S')}]  \n{msg}"
     # Отправка администраторам
-    for admin_id in ADMIN_IDS:
-        try:
-            bot.send_message(admin_id, log_message, parse_mode='Markdown', disable_web_page_preview=True)
-        except telebot.apihelper.ApiTelegramException as e:
-            # Используем standard logging для ошибки отправки
-            logging.info(f"[ERROR] Could not send message to {admin_id}: {e}")
+    _notify_admins(msg)
 
-def log_work(msg):
+def log_work(msg, skip_chat_id=None):
     # Используем standard logging (будет видно в Docker logs)
     logging.info(f" {msg}")
-    
-    log_message = f"[{datetime.now(TZ_MOSCOW).strftime('%Y-%m-%d %H:%M:%S')}]  \n{msg}"
-    # Отправка администраторам
-    for admin_id in ADMIN_IDS:
+    # Отправка администраторам (кроме того, кто запустил действие — он видит результат в своём сообщении прогресса)
+    _notify_admins(msg, skip_chat_id)
+
+
+class ProgressMessage:
+    """
+    Одно сообщение на всё ручное действие: отправляется один раз и дальше редактируется по мере прохождения этапов.
+    Если отредактировать не получилось (сообщение удалено и т.п.), отправляет новое и продолжает уже с ним.
+    message_id — подхватить сообщение, уже отправленное фронтендом (движок продолжает его редактировать).
+    Ошибки Telegram не прерывают операцию: прогресс — только отображение.
+    """
+
+    def __init__(self, chat_id, text, message_id=None):
+        self.chat_id = chat_id
+        self.text = text
+        self.message_id = message_id if message_id is not None else bot.send_message(chat_id, text).message_id
+
+    def update(self, text, parse_mode=None):
+        if text == self.text:
+            return
+        self.text = text
         try:
-            bot.send_message(admin_id, log_message, parse_mode='Markdown', disable_web_page_preview=True)
+            bot.edit_message_text(text, self.chat_id, self.message_id, parse_mode=parse_mode, disable_web_page_preview=True)
         except telebot.apihelper.ApiTelegramException as e:
-            # Используем standard logging для ошибки отправки
-            logging.info(f"[ERROR] Could not send message to {admin_id}: {e}")
+            logging.info(f"[ERROR] Could not edit progress message in {self.chat_id}: {e}")
+            try:
+                self.message_id = bot.send_message(self.chat_id, text, parse_mode=parse_mode, disable_web_page_preview=True).message_id
+            except Exception as e:
+                logging.info(f"[ERROR] Could not send progress message to {self.chat_id}: {e}")
+        except Exception as e:
+            logging.info(f"[ERROR] Could not edit progress message in {self.chat_id}: {e}")
+#--------------------------------------------------------------------------------------------------------------------------------
+
+
+
+
+
+
+#------------------------------------------ Команды движка ----------------------------------------------------------------------
+# Всё, что меняет расписание и настройки или трогает кошелёк, оформлено как команды движка. Обработчики Telegram
+# вызывают их через engine_call(): в совмещённом режиме это обычный вызов функции, в режиме frontend — запрос
+# к процессу engine по Unix-сокету (раздел «IPC движка»). Аргументы и результат — JSON-совместимые значения.
+ENGINE_COMMANDS = {}
+
+
+def engine_command(name: str):
+    def register(func):
+        ENGINE_COMMANDS[name] = func
+        return func
+    return register
+#--------------------------------------------------------------------------------------------------------------------------------
+
+
+
+
+
+
+#------------------------------------------ Трассировка и профилирование -------------------------------------------------------
+# Каждый span — (unix-время окончания, имя фазы, длительность в секундах, успешно ли).
+# Буфер ограничен TRACE_RING_SIZE, старые записи вытесняются сами.
+_trace_ring = collections.deque(maxlen=max(TRACE_RING_SIZE, 1))
+
+
+class _Span:
+    __slots__ = ("name", "t0")
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.t0 = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        # GeneratorExit — потребитель генератора остановился раньше (нашёл нужное), это не ошибка фазы
+        ok = exc_type is None or issubclass(exc_type, GeneratorExit)
+        _trace_ring.append((time.time(), self.name, time.perf_counter() - self.t0, ok))
+        return False
+
+
+class _NullSpan:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+
+_NULL_SPAN = _NullSpan()
+
+
+def trace_span(name: str):
+    """Контекст-менеджер для замера фазы. При TRACE_ENABLED=0 возвращает общий пустой объект."""
+    return _Span(name) if TRACE_ENABLED else _NULL_SPAN
+
+
+def trace_summary() -> List[Tuple[str, int, float, float, int]]:
+    """Агрегирует буфер по фазам: (имя, кол-во, среднее мс, максимум мс, ошибок)."""
+    stats = {}
+    for _, name, dur, ok in list(_trace_ring):
+        s = stats.setdefault(name, [0, 0.0, 0.0, 0])
+        s[0] += 1
+        s[1] += dur
+        s[2] = max(s[2], dur)
+        s[3] += 0 if ok else 1
+    return sorted(
+        ((name, n, total / n * 1000, mx * 1000, err) for name, (n, total, mx, err) in stats.items()),
+        key=lambda row: row[1] * row[2], reverse=True
+    )
+
+
+class SamplingProfiler:
+    """
+    Сэмплирующий профайлер: раз в interval секунд снимает стеки всех потоков через sys._current_frames()
+    и копит их в формате collapsed stacks (`поток;функция;функция N`), пригодном для flamegraph.pl / speedscope.
+    Пока не запущен — не стоит ничего: отдельного потока нет.
+    """
+
+    def __init__(self, interval: float = 0.01):
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self, seconds: float, on_done) -> bool:
+        """Запускает сбор на seconds секунд; по окончании вызывает on_done(collapsed_text, samples). False, если уже идёт."""
+        with self._lock:
+            if self.running():
+                return False
+            self._thread = threading.Thread(target=self._run, args=(seconds, on_done), name="profiler", daemon=True)
+            self._thread.start()
+            return True
+
+    def _run(self, seconds, on_done):
+        me = threading.get_ident()
+        counts = collections.Counter()
+        samples = 0
+        deadline = time.monotonic() + seconds
+        while time.monotonic() < deadline:
+            names = {t.ident: t.name for t in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                    frame = frame.f_back
+                stack.append(names.get(ident, str(ident)))
+                counts[";".join(reversed(stack))] += 1
+            samples += 1
+            time.sleep(self.interval)
+        collapsed = "\n".join(f"{stack} {n}" for stack, n in counts.most_common())
+        try:
+            on_done(collapsed, samples)
+        except Exception as e:
+            log_error_crash(f"Ошибка отправки профиля: {e}")
+
+
+profiler = SamplingProfiler()
+#--------------------------------------------------------------------------------------------------------------------------------
+
+
+
+
+
+
+#------------------------------------------ Потоковый разбор ответов TronScan -----------------------------------------------------
+# Ответы TronScan (история транзакций, resourcev2) читаются кусками и разбираются по одному элементу массива "data":
+# в памяти одновременно живут только текущий кусок и один элемент, урезанный до нужных полей.
+# Пиковое потребление не зависит от limit/размера страницы — важно при лимите контейнера 150M.
+STREAM_CHUNK_SIZE = 16 * 1024
+
+TX_FIELDS = ("hash", "timestamp", "contractType", "contractData.receiver_address", "contractData.resource")
+DELEGATION_FIELDS = ("receiverAddress", "balance")
+
+
+def _project(item: Dict, fields) -> Dict:
+    """Оставляет в элементе только перечисленные поля (вложенные — через точку)."""
+    out = {}
+    for path in fields:
+        src, dst = item, out
+        keys = path.split(".")
+        for k in keys[:-1]:
+            src = src.get(k) if isinstance(src, dict) else None
+            if src is None:
+                break
+            dst = dst.setdefault(k, {})
+        else:
+            if isinstance(src, dict) and keys[-1] in src:
+                dst[keys[-1]] = src[keys[-1]]
+    return out
+
+
+def iter_json_array_items(chunks, key: str = "data", fields=None):
+    """
+    Из потока байтовых кусков JSON-объекта верхнего уровня по одному выдаёт элементы массива `key`.
+    Остальные поля верхнего уровня пропускаются без разбора.
+    """
+    decoder = json.JSONDecoder()
+    utf8 = codecs.getincrementaldecoder("utf-8")()
+    chunks = iter(chunks)
+    buf, pos = "", 0
+    exhausted = False
+
+    def more():
+        nonlocal buf, pos, exhausted
+        chunk = next(chunks, None)
+        if chunk is None:
+            exhausted = True
+            buf = buf[pos:] + utf8.decode(b"", final=True)
+        else:
+            buf = buf[pos:] + utf8.decode(chunk)
+        pos = 0
+
+    # 1. Ищем на глубине 1 ключ `key`, за которым идёт начало массива
+    depth, in_string, escape = 0, False, False
+    token, last_string = None, None  # token — символы текущей строки верхнего уровня (не длиннее ключа)
+    while True:
+        if pos >= len(buf):
+            if exhausted:
+                return
+            more()
+            continue
+        ch = buf[pos]
+        pos += 1
+        if in_string:
+            if escape:
+                escape = False
+            elif ch == "\\":
+                escape = True
+                continue
+            elif ch == '"':
+                in_string = False
+                last_string = "".join(token) if token is not None else None
+                token = None
+                continue
+            if token is not None and len(token) <= len(key):
+                token.append(ch)
+        elif ch == '"':
+            in_string = True
+            token = [] if depth == 1 else None
+        elif ch in "{[":
+            depth += 1
+            if depth == 2 and ch == "[" and last_string == key:
+                break
+        elif ch in "}]":
+            depth -= 1
+        elif ch == "," and depth == 1:
+            last_string = None
+
+    # 2. Разбираем элементы массива по одному
+    while True:
+        while True:
+            while pos < len(buf) and buf[pos] in " \t\r\n,":
+                pos += 1
+            if pos < len(buf) or exhausted:
+                break
+            more()
+        if pos >= len(buf) or buf[pos] == "]":
+            return
+        try:
+            item, end = decoder.raw_decode(buf, pos)
+        except json.JSONDecodeError:
+            if exhausted:
+                raise
+            more()
+            continue
+        pos = end
+        yield _project(item, fields) if fields and isinstance(item, dict) else item
+
+
+def stream_tronscan_items(url: str, fields, span: str, key: str = "data"):
+    """GET к TronScan с потоковым разбором массива `key`. При HTTP-ошибке — исключение."""
+    headers = {"TRON-PRO-API-KEY": api_key_tronscan}
+    with trace_span(span), requests.get(url, headers=headers, timeout=10, stream=True) as response:
+        if response.status_code != 200:
+            raise Exception(f"TronScan API Error: {response.status_code}, {response.text[:500]}")
+        yield from iter_json_array_items(response.iter_content(chunk_size=STREAM_CHUNK_SIZE), key=key, fields=fields)
 #--------------------------------------------------------------------------------------------------------------------------------
 
 
@@ -105,86 +640,192 @@ def log_work(msg):
 
 
 #------------------------------------------ Tron функции ------------------------------------------------------------------
-# (Используют глобальные переменные api_key_trongrid, api_key_tronscan, PERM_ID, priv_key_my)
+# (Используют глобальные переменные api_key_trongrid, api_key_tronscan, PERM_ID, priv_key_my_hex)
+
+_tron_lock = threading.Lock()
+_tron = None  # (client, priv_key) — создаются при первой транзакции
+
+
+def _get_tron():
+    """Лениво импортирует tronpy и возвращает закэшированные клиент и ключ подписи."""
+    global _tron
+    with _tron_lock:
+        if _tron is None:
+            from tronpy import Tron
+            from tronpy.providers import HTTPProvider
+            from tronpy.keys import PrivateKey
+            client = Tron(provider=HTTPProvider(api_key=api_key_trongrid))
+            _tron = (client, PrivateKey(bytes.fromhex(priv_key_my_hex)))
+        return _tron
+
+
+def query_energy_info(addressEN):
+    """
+    Ресурсы энергии кошелька: (free_energy_ac, trx_energy_price, unused_slot, all_energy, energy_used, delegated_in).
+    При ошибке API — исключение.
+    """
+    headers = {
+        "accept": "application/json",
+        "content-type": "application/json",
+        "TRON-PRO-API-KEY": api_key_trongrid
+    }
+    url = "https://api.trongrid.io/wallet/getaccountresource"
+    payload = {"address": addressEN, "visible": True}
+    with trace_span("trongrid.getaccountresource"):
+        response = requests.post(url, json=payload, headers=headers, timeout=15)
+    if response.status_code != 200:
+        raise RuntimeError(f"getaccountresource: {response.status_code}, {response.text}")
+    data = response.json()
+    energy_used = data.get("EnergyUsed",0)
+    energy_limit = data.get("EnergyLimit",0)
+    delegated_energy_from_others = data.get("account_resource.acquired_delegated_frozenV2_balance_for_energy",0)
+    delegated_energy_to_others = data.get("delegatedFrozenV2BalanceForEnergy",0)
+    total_energy_limit = data.get("TotalEnergyLimit",0)
+    total_energy_weight = data.get("TotalEnergyWeight",0)
+    trx_energy_price = total_energy_weight / total_energy_limit if total_energy_limit > 0 else 0
+    all_energy = energy_limit + delegated_energy_from_others
+    free_energy_ac = all_energy - energy_used if all_energy > energy_used else 0
+    unused_slot = int(free_energy_ac * trx_energy_price) if trx_energy_price > 0 else 0
+    return free_energy_ac, trx_energy_price, unused_slot, all_energy, energy_used, delegated_energy_from_others
 
 def get_energy_info(addressEN):
     try:
-        headers = {
-            "accept": "application/json",
-            "content-type": "application/json",
-            "TRON-PRO-API-KEY": api_key_trongrid
-        }
-        url = "https://api.trongrid.io/wallet/getaccountresource"
-        payload = {"address": addressEN, "visible": True}
-        response = requests.post(url, json=payload, headers=headers)
-        if response.status_code != 200:
-            log_error_crash(f"Ошибка getaccountresource: {response.status_code}, {response.text}")
-            return 0,0,0,0,0,0
-        data = response.json()
-        energy_used = data.get("EnergyUsed",0)
-        energy_limit = data.get("EnergyLimit",0)
-        delegated_energy_from_others = data.get("account_resource.acquired_delegated_frozenV2_balance_for_energy",0)
-        delegated_energy_to_others = data.get("delegatedFrozenV2BalanceForEnergy",0)
-        total_energy_limit = data.get("TotalEnergyLimit",0)
-        total_energy_weight = data.get("TotalEnergyWeight",0)
-        trx_energy_price = total_energy_weight / total_energy_limit if total_energy_limit > 0 else 0
-        all_energy = energy_limit + delegated_energy_from_others
-        free_energy_ac = all_energy - energy_used if all_energy > energy_used else 0
-        unused_slot = int(free_energy_ac * trx_energy_price) if trx_energy_price > 0 else 0
-        return free_energy_ac, trx_energy_price, unused_slot, all_energy, energy_used, delegated_energy_from_others
+        return query_energy_info(addressEN)
     except Exception as e:
         log_error_crash(f"Ошибка в get_energy_info: {e}")
         return 0,0,0,0,0,0
 
-def get_max_delegatable_trx(addressEN):
+def query_max_delegatable_trx(addressEN):
+    """Сколько sun можно делегировать под энергию. При ошибке API — исключение."""
     url = "https://api.trongrid.io/wallet/getcandelegatedmaxsize"
     payload = {"owner_address": addressEN,"type":1,"visible":True}
     headers = {"accept":"application/json","content-type":"application/json","TRON-PRO-API-KEY": api_key_trongrid}
+    with trace_span("trongrid.getcandelegatedmaxsize"):
+        response = requests.post(url,json=payload,headers=headers,timeout=15)
+    if response.status_code != 200:
+        raise RuntimeError(f"getcandelegatedmaxsize: {response.status_code} {response.text}")
+    return response.json().get("max_size",0)
+
+def get_max_delegatable_trx(addressEN):
     try:
-        response = requests.post(url,json=payload,headers=headers)
-        if response.status_code == 200:
-            data = response.json()
-            return data.get("max_size",0)
-        else:
-            log_error_crash(f"Ошибка getcandelegatedmaxsize: {response.status_code} {response.text}")
-            return 0
+        return query_max_delegatable_trx(addressEN)
     except Exception as e:
         log_error_crash(f"Ошибка getcandelegatedmaxsize: {e}")
         return 0
 
-def create_delegate_energy_txid(addressEN, receiver_address_delegate_my, delegate_my_trx):
+def get_delegation_balance(addressEN, receiver_address):
+    """Возвращает объём (sun), делегированный с addressEN на receiver_address под энергию. При ошибке API — исключение."""
+    url = f"https://apilist.tronscanapi.com/api/account/resourcev2?address={addressEN}&type=2&resourceType=2"
+    for delegation in stream_tronscan_items(url, DELEGATION_FIELDS, "tronscan.resourcev2"):
+        if delegation.get("receiverAddress") == receiver_address:
+            return delegation.get("balance", 0)
+    return 0
+
+# Квитанции последних транзакций: комиссии из receipt и время от broadcast до подтверждения.
+# Планировщик забирает их в задачи кластера (tx_receipts), ручные операции просто вытесняются.
+TX_RECEIPTS_KEEP = 100
+_tx_receipts = collections.OrderedDict()
+_tx_receipts_lock = threading.Lock()  # пишут планировщик и пул ручных операций, забирает планировщик
+
+
+def remember_tx_receipt(txid: str, info: Dict, confirm_s: float):
+    receipt = info.get("receipt", {})
+    entry = {
+        "txid": txid,
+        "fee_sun": info.get("fee", 0),
+        "net_fee_sun": receipt.get("net_fee", 0),
+        "energy_fee_sun": receipt.get("energy_fee", 0),
+        "net_usage": receipt.get("net_usage", 0),
+        "energy_usage": receipt.get("energy_usage_total", 0),
+        "block_ts": info.get("blockTimeStamp"),
+        "confirm_s": round(confirm_s, 3),
+    }
+    with _tx_receipts_lock:
+        _tx_receipts[txid] = entry
+        while len(_tx_receipts) > TX_RECEIPTS_KEEP:
+            _tx_receipts.popitem(last=False)
+
+
+def take_tx_receipt(txid: str, kind: str):
+    """Квитанция транзакции с пометкой kind (delegate / topup / undelegate) или None, если её нет."""
+    with _tx_receipts_lock:
+        receipt = _tx_receipts.pop(txid, None)
+    return None if receipt is None else dict(receipt, kind=kind)
+
+
+class TxError(Exception):
+    """Транзакция не прошла. transient — повтор может помочь (сеть, перегрузка ноды, транзакция не дождалась блока)."""
+
+    def __init__(self, message: str, transient: bool = True):
+        super().__init__(message)
+        self.transient = transient
+
+
+# Ошибки, которые повтор не исправит: отказ валидации контракта (не хватает TRX, нет прав у PERM_ID), подпись, адрес.
+# Классы — имена исключений tronpy (он импортируется лениво), коды — из ответа broadcast.
+PERMANENT_TX_ERRORS = ("BadSignature", "ValidationError", "BadAddress", "BadKey")
+PERMANENT_TX_CODES = ("CONTRACT_VALIDATE_ERROR", "CONTRACT_EXE_ERROR", "SIGERROR")
+
+
+def is_transient_tx_error(e: Exception) -> bool:
+    """Временная ли ошибка. Неизвестные считаются временными: число повторов всё равно ограничено сроком."""
+    if isinstance(e, TxError):
+        return e.transient
+    if type(e).__name__ in PERMANENT_TX_ERRORS:
+        return False
+    return not any(code in str(e) for code in PERMANENT_TX_CODES)
+
+
+def _send_resource_tx(kind: str, build, amount_trx: float) -> str:
+    """Собирает, подписывает и отправляет delegate/undelegate, ждёт подтверждения. Возвращает txid или бросает TxError."""
     try:
-        provider = HTTPProvider(api_key=api_key_trongrid)
-        client = Tron(provider=provider)
-        amount_trx = int(delegate_my_trx * 1_000_000)
-        txn = (client.trx.delegate_resource(addressEN,receiver_address_delegate_my,amount_trx,resource='ENERGY')
-               .permission_id(PERM_ID).build().sign(priv_key_my))
-        response = txn.broadcast().wait()
-        if 'id' in response:
-            log_work(f"Энергия делегирована на {receiver_address_delegate_my} в размере {delegate_my_trx:,.2f} TRX")
-            return txn.txid, True
-        else:
-            log_error_crash(f"Ошибка делегации: {response}")
-            return None, False
+        client, priv_key_my = _get_tron()
+        with trace_span(f"tron.{kind}.build"):
+            txn = build(client, int(amount_trx * 1_000_000)).permission_id(PERM_ID).build().sign(priv_key_my)
+        broadcast_mono = time.monotonic()
+        with trace_span(f"tron.{kind}.broadcast_wait"):
+            response = txn.broadcast().wait()
     except Exception as e:
+        raise TxError(f"{type(e).__name__}: {e}", is_transient_tx_error(e)) from e
+    if 'id' not in response:
+        raise TxError(str(response), is_transient_tx_error(RuntimeError(str(response))))
+    remember_tx_receipt(txn.txid, response, time.monotonic() - broadcast_mono)
+    return txn.txid
+
+
+def send_delegate_energy(addressEN, receiver_address_delegate_my, delegate_my_trx, progress=None) -> str:
+    txid = _send_resource_tx(
+        "delegate",
+        lambda client, amount: client.trx.delegate_resource(addressEN, receiver_address_delegate_my, amount, resource='ENERGY'),
+        delegate_my_trx)
+    log_work(f"Энергия делегирована на {receiver_address_delegate_my} в размере {delegate_my_trx:,.2f} TRX",
+             skip_chat_id=progress.chat_id if progress else None)
+    record_last_tx("delegate", txid, delegate_my_trx)
+    return txid
+
+
+def send_undelegate_energy(addressEN, receiver_address_delegate_my, undelegate_trx, progress=None) -> str:
+    txid = _send_resource_tx(
+        "undelegate",
+        lambda client, amount: client.trx.undelegate_resource(addressEN, receiver_address_delegate_my, amount, resource='ENERGY'),
+        undelegate_trx)
+    log_work(f"Отозвана делегация {undelegate_trx:,.2f} TRX с {receiver_address_delegate_my}",
+             skip_chat_id=progress.chat_id if progress else None)
+    record_last_tx("undelegate", txid, undelegate_trx)
+    return txid
+
+
+def create_delegate_energy_txid(addressEN, receiver_address_delegate_my, delegate_my_trx, progress=None):
+    try:
+        return send_delegate_energy(addressEN, receiver_address_delegate_my, delegate_my_trx, progress), True
+    except TxError as e:
         log_error_crash(f"Ошибка делегации: {e}")
         return None, False
 
-def create_undelegate_energy_txid(addressEN, receiver_address_delegate_my, undelegate_trx):
+def create_undelegate_energy_txid(addressEN, receiver_address_delegate_my, undelegate_trx, progress=None):
     try:
-        provider = HTTPProvider(api_key=api_key_trongrid)
-        client = Tron(provider=provider)
-        amount_trx = int(undelegate_trx * 1_000_000)
-        txn = (client.trx.undelegate_resource(addressEN,receiver_address_delegate_my,amount_trx,resource='ENERGY')
-               .permission_id(PERM_ID).build().sign(priv_key_my))
-        response = txn.broadcast().wait()
-        if 'id' in response:
-            log_work(f"Отозвана делегация {undelegate_trx:,.2f} TRX с {receiver_address_delegate_my}")
-            return txn.txid, True
-        else:
-            log_error_crash(f"Ошибка отзыва делегации: {response}")
-            return None, False
-    except Exception as e:
+        return send_undelegate_energy(addressEN, receiver_address_delegate_my, undelegate_trx, progress), True
+    except TxError as e:
         log_error_crash(f"Ошибка отзыва делегации: {e}")
         return None, False
 #--------------------------------------------------------------------------------------------------------------------------------
@@ -193,14 +834,149 @@ def create_undelegate_energy_txid(addressEN, receiver_address_delegate_my, undel
 
 
 
+#------------------------------------------- Время сети ---------------------------------------------------------------
+# Время входящих делегаций приходит из меток блоков, поэтому и расписание считаем во времени сети, а не по часам контейнера:
+# они могут уходить, а их перевод сдвигает все кластеры. ChainClock хранит смещение «время сети − time.monotonic()»
+# по свежим блокам, now() = monotonic + смещение. Метка последнего блока не позже реального времени сети, поэтому
+# каждый замер — оценка снизу; из последних CLOCK_WINDOW замеров берём максимальный.
+CLOCK_WINDOW = 10
+
+
+class ChainClock:
+    def __init__(self):
+        self._samples = collections.deque(maxlen=CLOCK_WINDOW)
+        self._offset = time.time() - time.monotonic()  # пока замеров нет — локальные часы
+        self.synced_mono = None
+        self.block_number = None
+
+    def sync(self) -> bool:
+        """Сверяется с последним блоком TronGrid. Возвращает False, если ответ не получен."""
+        headers = {"accept": "application/json", "content-type": "application/json", "TRON-PRO-API-KEY": api_key_trongrid}
+        try:
+            with trace_span("trongrid.getblock"):
+                response = requests.post("https://api.trongrid.io/wallet/getblock", json={"detail": False},
+                                         headers=headers, timeout=10)
+            received = time.monotonic()
+            raw = response.json()["block_header"]["raw_data"]
+        except (requests.RequestException, ValueError, KeyError) as e:
+            logging.error(f"❌ Ошибка синхронизации времени с сетью: {e}")
+            return False
+        self._samples.append(raw["timestamp"] / 1000.0 - received)
+        self._offset = max(self._samples)
+        self.synced_mono = received
+        self.block_number = raw.get("number")
+        return True
+
+    def time(self) -> float:
+        """Текущее время сети, unix-секунды."""
+        return time.monotonic() + self._offset
+
+    def now(self) -> datetime:
+        return datetime.fromtimestamp(self.time(), tz=TZ_MOSCOW)
+
+    def deadline(self, when: datetime) -> float:
+        """Момент времени сети → дедлайн по time.monotonic()."""
+        return when.timestamp() - self._offset
+
+    def skew(self):
+        """На сколько секунд локальные часы впереди сети (None — ещё не синхронизировались)."""
+        if self.synced_mono is None:
+            return None
+        return time.time() - self.time()
+
+
+chain_clock = ChainClock()
+
+
+def clock_worker():
+    """Периодическая сверка с сетью. Первую сверку делает main() до восстановления расписания."""
+    warned = False
+    while True:
+        time.sleep(CLOCK_SYNC_SECONDS)
+        if chain_clock.sync():
+            skew = chain_clock.skew()
+            if abs(skew) > CLOCK_SKEW_WARN_SECONDS and not warned:
+                log_work(f"⚠️ Часы сервера расходятся с сетью на {skew:+.1f} с. Расписание ведётся по времени сети.")
+                warned = True
+            elif abs(skew) <= CLOCK_SKEW_WARN_SECONDS:
+                warned = False
+#--------------------------------------------------------------------------------------------------------------------------------
+
+
+
+
+
+#------------------------------------------- Блокировки кошельков ---------------------------------------------------------------
+# Любая операция, меняющая состояние кошелька в сети (расчёт объёма + delegate/undelegate), выполняется
+# под блокировкой этого кошелька. Просмотр (списки, статус) блокировки не берёт и работает параллельно.
+_wallet_locks_guard = threading.Lock()
+_wallet_locks = {}
+
+
+def _get_wallet_lock(address: str) -> threading.RLock:
+    with _wallet_locks_guard:
+        lock = _wallet_locks.get(address)
+        if lock is None:
+            lock = _wallet_locks[address] = threading.RLock()
+        return lock
+
+
+class wallet_operation:
+    """
+    Контекст-менеджер: эксклюзивный доступ к кошельку на время операции.
+    Если кошелёк занят, сначала вызывается on_wait() (например, сообщение "в очереди"), затем ждём освобождения.
+    """
+
+    def __init__(self, address: str, on_wait=None):
+        self.lock = _get_wallet_lock(address)
+        self.on_wait = on_wait
+
+    def __enter__(self):
+        if not self.lock.acquire(blocking=False):
+            if self.on_wait is not None:
+                try:
+                    self.on_wait()
+                except Exception as e:
+                    logging.info(f"[ERROR] on_wait: {e}")
+            with trace_span("wallet_lock.wait"):
+                self.lock.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.lock.release()
+        return False
+#--------------------------------------------------------------------------------------------------------------------------------
+
+
+
+
+
 #------------------------------------------- Декоратор для проверки админов ---------------------------------------------------
 def admin_only(func):
     def wrapper(message,*args,**kwargs):
+        # message — Message или CallbackQuery (у него чат лежит в call.message)
+        chat_id = message.chat.id if hasattr(message, "chat") else message.message.chat.id
         if message.from_user.id not in ADMIN_IDS:
-            bot.send_message(message.chat.id,"⛔ У тебя нет доступа")
+            bot.send_message(chat_id,"⛔ У тебя нет доступа")
             return
-        return func(message,*args,**kwargs)
+        try:
+            return func(message,*args,**kwargs)
+        except EngineUnavailable as e:
+            logging.error(f"❌ Движок недоступен: {e}")
+            bot.send_message(chat_id, "⚠️ Движок недоступен, попробуйте позже. Запланированные операции выполняются независимо от бота.")
+        except (StateNotSaved, EngineCommandError) as e:
+            reply_engine_error(chat_id, e)
     return wrapper
+
+
+def reply_engine_error(chat_id, e: Exception, what: str = "Изменение применено"):
+    """Отвечает админу на ошибку команды движка: StateNotSaved (совмещённый режим) или ответ движка с ошибкой (frontend)."""
+    logging.error(f"❌ Ошибка команды движка: {e}")
+    if isinstance(e, StateNotSaved) or getattr(e, "error_type", None) == "StateNotSaved":
+        bot.send_message(chat_id, f"⚠️ {what} только в памяти: запись на диск не удалась. "
+                                  f"Запишется со следующей удачной записью, а до этого пропадёт при перезапуске движка.")
+    else:
+        bot.send_message(chat_id, f"❌ Команда не выполнена: {e}")
 #--------------------------------------------------------------------------------------------------------------------------------
 
 
@@ -210,10 +986,11 @@ def admin_only(func):
 
 
 # ------------------------------------------ Клавиатура снизу ----------------------------------------------------------------
-def bottom_keyboard():
-    # Флаг MONITORING_ENABLED должен быть доступен здесь как глобальный
-    global MONITORING_ENABLED
-    status_emoji = '🟢' if MONITORING_ENABLED else '🔴'
+def bottom_keyboard(monitoring_enabled=None):
+    # Состояние автослежения хранит движок; если его уже знаем (только что переключили), не спрашиваем повторно
+    if monitoring_enabled is None:
+        monitoring_enabled = engine_call("monitoring")
+    status_emoji = '🟢' if monitoring_enabled else '🔴'
     
     markup = types.ReplyKeyboardMarkup(row_width=2, resize_keyboard=True, one_time_keyboard=False)
     markup.add(
@@ -237,28 +1014,54 @@ def realtime_keyboard():
 
 
 
+#---------------------------------------------- Запись файлов -------------------------------------------------------------------
+def write_file_in_place(path: str, text: str):
+    """
+    Перезаписывает файл на месте и дожидается записи на диск (fsync).
+    Не через временный файл + os.replace: в docker-compose файлы смонтированы по одному (bind mount),
+    и переименование поверх точки монтирования падает с EBUSY. Текст готовится заранее, поэтому
+    файл пуст только на время одного write().
+    """
+    with open(path, "w", encoding="utf-8") as f:
+        f.write(text)
+        f.flush()
+        os.fsync(f.fileno())
+#--------------------------------------------------------------------------------------------------------------------------------
+
+
+
 #---------------------------------------------- Работа с файлом настроек -------------------------------------------------
-def save_settings():
-    """Сохраняет текущее состояние слежения в файл."""
-    settings = {"monitoring_enabled": MONITORING_ENABLED}
-    try:
-        with open(SETTINGS_PATH, "w", encoding="utf-8") as f:
-            json.dump(settings, f, indent=2)
-    except Exception as e:
-        logging.error(f"❌ Ошибка: Не удалось сохранить настройки: {e}")
+# monitoring_enabled — кнопка автослежения; incoming_checkpoint_ms — время (мс) самой свежей просмотренной транзакции
+# MAIN_WALLET, с которого догоняем историю после простоя. Меняет настройки только state (см. «Владелец состояния»).
+DEFAULT_SETTINGS = {"monitoring_enabled": False, "incoming_checkpoint_ms": None}
+
 
-def load_settings():
-    """Загружает состояние слежения из файла при старте."""
-    global MONITORING_ENABLED
+def read_settings_file():
+    """Настройки из файла или None, если файла нет либо он повреждён."""
     try:
         with open(SETTINGS_PATH, "r", encoding="utf-8") as f:
             settings = json.load(f)
-            # Загружаем значение, по умолчанию False, если ключ отсутствует
-            MONITORING_ENABLED = settings.get("monitoring_enabled", False)
+        return {key: settings.get(key, default) for key, default in DEFAULT_SETTINGS.items()}
     except (FileNotFoundError, json.JSONDecodeError):
-        # Если файл не найден или поврежден, устанавливаем по умолчанию и сохраняем
-        MONITORING_ENABLED = False
-        save_settings()
+        return None
+
+
+def write_settings_file(settings: Dict):
+    write_file_in_place(SETTINGS_PATH, json.dumps(settings, indent=2))
+
+
+@engine_command("monitoring")
+def get_monitoring_state() -> bool:
+    return state.settings["monitoring_enabled"]
+
+
+@engine_command("toggle_monitoring")
+def toggle_monitoring_state() -> bool:
+    """Переключает автослежение, сохраняет настройки и возвращает новое состояние."""
+    enabled = state.toggle_monitoring()
+    status_text = "Включено 🟢" if enabled else "Выключено 🔴"
+    log_work(f"Автоматическое слежение переключено в состояние: {status_text}")
+    return enabled
 #--------------------------------------------------------------------------------------------------------------------------------
 
 
@@ -268,21 +1071,14 @@ def load_settings():
 @bot.message_handler(func=lambda m: m.text.startswith("Автослежение"))
 @admin_only
 def toggle_monitoring(message):
-    global MONITORING_ENABLED # Работаем с глобальным флагом!
-    
-    # 1. Переключаем состояние
-    MONITORING_ENABLED = not MONITORING_ENABLED
-    
-    # 2. Сохраняем состояние
-    save_settings()
-    
-    status_text = "Включено 🟢" if MONITORING_ENABLED else "Выключено 🔴"
-    log_work(f"Автоматическое слежение переключено в состояние: {status_text}")
+    # Переключает и сохраняет движок
+    enabled = engine_call("toggle_monitoring")
+    status_text = "Включено 🟢" if enabled else "Выключено 🔴"
     
     bot.send_message(
         message.chat.id, 
         f"Автоматическое слежение теперь: **{status_text}**.", 
-        reply_markup=bottom_keyboard(), # Обновляем клавиатуру, чтобы показать новый статус
+        reply_markup=bottom_keyboard(enabled), # Обновляем клавиатуру, чтобы показать новый статус
         parse_mode='Markdown'
     )
 #--------------------------------------------------------------------------------------------------------------------------------
@@ -307,6 +1103,92 @@ def start_bot_message(message):
 
 
 
+# ------------------------------- Диагностика: /trace и /profile ------------------------------------------------------------
+PROFILE_MAX_MINUTES = 30
+
+
+@engine_command("trace_report")
+def trace_report() -> str:
+    rows = trace_summary()
+    if not rows:
+        return "📭 Буфер трассировки пуст" + ("" if TRACE_ENABLED else " (TRACE_ENABLED=0).")
+    lines = [f"{name}: n={n} avg={avg:.1f}мс max={mx:.1f}мс" + (f" err={err}" if err else "") for name, n, avg, mx, err in rows]
+    return f"🧭 Фазы (последние {len(_trace_ring)} span):\n\n" + "\n".join(lines)
+
+
+@bot.message_handler(commands=["trace"])
+@admin_only
+def show_trace(message):
+    bot.send_message(message.chat.id, engine_call("trace_report"))
+
+
+@engine_command("start_profile")
+def start_profile_for(chat_id: int, minutes: float) -> bool:
+    """Профилирует процесс движка (там работают планировщик и транзакции); файл уходит в chat_id."""
+    def send_profile(collapsed, samples):
+        name = f"profile_{datetime.now(TZ_MOSCOW).strftime('%Y%m%d_%H%M%S')}.collapsed"
+        bot.send_document(
+            chat_id, io.BytesIO(collapsed.encode("utf-8")), visible_file_name=name,
+            caption=f"🔥 Профиль за {minutes:g} мин, сэмплов: {samples}. Формат collapsed stacks (flamegraph.pl, speedscope)."
+        )
+
+    return profiler.start(minutes * 60, send_profile)
+
+
+@bot.message_handler(commands=["profile"])
+@admin_only
+def start_profile(message):
+    parts = message.text.split()
+    try:
+        minutes = float(parts[1]) if len(parts) > 1 else 1
+        if not 0 < minutes <= PROFILE_MAX_MINUTES:
+            raise ValueError
+    except ValueError:
+        bot.send_message(message.chat.id, f"❌ Использование: /profile N, где N — минуты (до {PROFILE_MAX_MINUTES}).")
+        return
+
+    chat_id = message.chat.id
+    if engine_call("start_profile", chat_id=chat_id, minutes=minutes):
+        bot.send_message(chat_id, f"⏱️ Профайлер запущен на {minutes:g} мин. Файл придёт по окончании.")
+    else:
+        bot.send_message(chat_id, "⚠️ Профайлер уже запущен.")
+
+
+@engine_command("energy_report")
+def energy_report() -> str:
+    if not energy_telemetry:
+        text = "📭 Телеметрия выключена (TELEMETRY_INTERVAL_SECONDS=0)."
+        return text + (f"\n\n{reactive_stasher.summary()}" if REACTIVE_ENABLED else "")
+    lines = []
+    for address, ring in energy_telemetry.items():
+        label = "Котлета" if address == main_wallet else "Тайник"
+        last = ring.last()
+        if last is None:
+            lines.append(f"{label}: сэмплов пока нет")
+            continue
+        ts, free_energy, energy_used, _, delegated_in = last
+        at = datetime.fromtimestamp(ts, tz=TZ_MOSCOW).strftime('%Y-%m-%d %H:%M')
+        lines.append(
+            f"{label} ({ring.count}/{ring.capacity} сэмплов, последний {at}):\n"
+            f"  свободно {free_energy:,.0f}, израсходовано {energy_used:,.0f}, делегировано внутрь {delegated_in:,.0f}"
+        )
+    windows = find_usage_windows(energy_telemetry[main_wallet])
+    windows_str = ", ".join(f"{m // 60:02d}:{m % 60:02d}" for m in windows) or "не найдены"
+    lines.append(f"\nПовторяющиеся окна расхода: {windows_str}\nРежим автопланирования: {AUTO_PATTERN_MODE}")
+    if REACTIVE_ENABLED:
+        lines.append(reactive_stasher.summary())
+    return "📈 Телеметрия энергии\n\n" + "\n".join(lines)
+
+
+@bot.message_handler(commands=["energy"])
+@admin_only
+def show_energy_telemetry(message):
+    bot.send_message(message.chat.id, engine_call("energy_report"))
+#--------------------------------------------------------------------------------------------------------------------------------
+
+
+
+
 
 
 #-------------------------------------------------- КНОПКИ!------------------------------------------------------------------------------
@@ -314,87 +1196,91 @@ def start_bot_message(message):
 @bot.message_handler(func=lambda m: m.text=="Спрятать 📤")
 @admin_only
 def stash_energy(message):
-    bot.send_message(message.chat.id, "⏳ Рассчитываю максимальный объем для делегирования...")
-    
+    progress = ProgressMessage(message.chat.id, "⏳ Рассчитываю максимальный объем для делегирования...")
+    # Дальше сообщение прогресса редактирует движок
+    engine_call("stash", chat_id=progress.chat_id, message_id=progress.message_id, text=progress.text)
+
+
+@engine_command("stash")
+def stash_with_progress(chat_id: int, message_id: int, text: str):
+    progress = ProgressMessage(chat_id, text, message_id=message_id)
+    on_wait = lambda: progress.update("🕓 В очереди: по кошельку уже выполняется операция, запущу сразу после неё...")
+    with wallet_operation(main_wallet, on_wait=on_wait):
+        _stash_energy(progress)
+
+
+def _stash_energy(progress):
+    progress.update("⏳ Рассчитываю максимальный объем для делегирования...")
+
     # 1. Получаем максимальный объем TRX для делегирования (в sun)
     trx_deleg_max_sun = get_max_delegatable_trx(main_wallet)
     
     if trx_deleg_max_sun == 0:
-        bot.send_message(message.chat.id, "✅ Нечего делегировать. Вся энергия уже спрятана, или нет свободного TRX.")
+        progress.update("✅ Нечего делегировать. Вся энергия уже спрятана, или нет свободного TRX.")
         return
 
     # Переводим в TRX
     trx_to_delegate = int(trx_deleg_max_sun / 1_000_000)
     
     # 2. Выполняем делегирование
-    txid, ok = create_delegate_energy_txid(main_wallet, stashing_target, trx_to_delegate)
+    txid, ok = create_delegate_energy_txid(main_wallet, stashing_target, trx_to_delegate, progress=progress)
 
     if ok:
         txid_link = "https://tronscan.org/#/transaction/" + txid
-        bot.send_message(message.chat.id, 
-                         f"✅ Спрятано!\n\n"
-                         f"Делегировано: {trx_to_delegate:,.2f} TRX\n"
-                         f"[Ссылка на транзакцию]({txid_link})",
-                         parse_mode='Markdown', disable_web_page_preview=True)
+        progress.update(f"✅ Спрятано!\n\n"
+                        f"Делегировано: {trx_to_delegate:,.2f} TRX\n"
+                        f"[Ссылка на транзакцию]({txid_link})",
+                        parse_mode='Markdown')
     else:
-        bot.send_message(message.chat.id, "❌ Произошла ошибка при делегировании. Проверьте логи.")
+        progress.update("❌ Произошла ошибка при делегировании. Проверьте логи.")
 
 
 # ================== Логика "Вернуть" (Отзыв) ==================
 @bot.message_handler(func=lambda m: m.text=="Вернуть 📥")
 @admin_only
 def reclaim_energy(message):
-    bot.send_message(message.chat.id, "⏳ Проверяю активные делегации на Адрес-Тайник...")
-    
-    # 1. Получаем список всех делегаций с нашего main_wallet
-    url = f"https://apilist.tronscanapi.com/api/account/resourcev2?address={main_wallet}&type=2&resourceType=2"
-    headers = {"TRON-PRO-API-KEY": api_key_tronscan}
+    progress = ProgressMessage(message.chat.id, "⏳ Проверяю активные делегации на Адрес-Тайник...")
+    engine_call("reclaim", chat_id=progress.chat_id, message_id=progress.message_id, text=progress.text)
+
+
+@engine_command("reclaim")
+def reclaim_with_progress(chat_id: int, message_id: int, text: str):
+    progress = ProgressMessage(chat_id, text, message_id=message_id)
+    on_wait = lambda: progress.update("🕓 В очереди: по кошельку уже выполняется операция, запущу сразу после неё...")
+    with wallet_operation(main_wallet, on_wait=on_wait):
+        _reclaim_energy(progress)
+
+
+def _reclaim_energy(progress):
+    progress.update("⏳ Проверяю активные делегации на Адрес-Тайник...")
 
+    # 1. Ищем делегацию с нашего main_wallet на stashing_target
     try:
-        response = requests.get(url, headers=headers)
-        if response.status_code != 200:
-            raise Exception(f"TronScan API Error: {response.status_code}, {response.text}")
-            
-        data = response.json()
-        delegations_list = data.get("data", [])
-        
+        balance_sun = get_delegation_balance(main_wallet, stashing_target)
     except Exception as e:
         log_error_crash(f"Ошибка запроса списка делегаций к TronScan: {e}")
-        bot.send_message(message.chat.id, "❌ Не удалось получить список делегаций. Проверьте логи.")
+        progress.update("❌ Не удалось получить список делегаций. Проверьте логи.")
         return
-        
-    # 2. Ищем делегацию, сделанную на stashing_target
-    target_delegation = None
-    for delegation in delegations_list:
-        if delegation.get("receiverAddress") == stashing_target:
-            target_delegation = delegation
-            break
 
-    if not target_delegation:
-        bot.send_message(message.chat.id, "✅ Нет активных делегаций на Адрес-Тайник для отзыва.")
-        return
-        
-    # 3. Выполняем отзыв
-    amount_in_trx = target_delegation.get("balance", 0) / 1_000_000
-    amount_in_trx = int(amount_in_trx) # Округляем до целого TRX
+    # 2. Выполняем отзыв
+    amount_in_trx = int(balance_sun / 1_000_000) # Округляем до целого TRX
 
     if amount_in_trx <= 0:
-        bot.send_message(message.chat.id, "❌ Обнаружен нулевой объем делегации на Адрес-Тайник.")
+        progress.update("✅ Нет активных делегаций на Адрес-Тайник для отзыва.")
         return
 
-    bot.send_message(message.chat.id, f"🔄 Запускаю отзыв делегации: {amount_in_trx:,.2f} TRX с `{stashing_target}`...", parse_mode='Markdown')
+    progress.update(f"🔄 Запускаю отзыв делегации: {amount_in_trx:,.2f} TRX с `{stashing_target}`...", parse_mode='Markdown')
     
-    txid, ok = create_undelegate_energy_txid(main_wallet, stashing_target, amount_in_trx)
+    txid, ok = create_undelegate_energy_txid(main_wallet, stashing_target, amount_in_trx, progress=progress)
 
     if ok:
         txid_link = "https://tronscan.org/#/transaction/" + txid
-        bot.send_message(message.chat.id, 
-                         f"✅ Возвращено!\n\n"
-                         f"Отозвано: {amount_in_trx:,.2f} TRX\n"
-                         f"[Ссылка на транзакцию]({txid_link})",
-                         parse_mode='Markdown', disable_web_page_preview=True)
+        progress.update(f"✅ Возвращено!\n\n"
+                        f"Отозвано: {amount_in_trx:,.2f} TRX\n"
+                        f"[Ссылка на транзакцию]({txid_link})",
+                        parse_mode='Markdown')
     else:
-        bot.send_message(message.chat.id, "❌ Произошла ошибка при отзыве делегации. Проверьте логи.")
+        progress.update("❌ Произошла ошибка при отзыве делегации. Проверьте логи.")
 
 
 
@@ -429,7 +1315,7 @@ def go_back_to_main(message):
 #---------------------------------------------Работа с задачами в очереди ---------------------------------------------------------------
 def load_scheduled_tasks():
     try:
-        with open(path_json_otl, "r", encoding="utf-8") as f:
+        with trace_span("json.load_tasks"), open(path_json_otl, "r", encoding="utf-8") as f:
             data = json.load(f)
             # Приведение строк к datetime
             for task in data:
@@ -437,11 +1323,32 @@ def load_scheduled_tasks():
                     task["schedule_time"] = datetime.fromisoformat(task["schedule_time"])
                 if isinstance(task["return_time"], str):
                     task["return_time"] = datetime.fromisoformat(task["return_time"])
+                task.setdefault("id", uuid.uuid4().hex[:12])
                 task.setdefault("txid_delegate_source", None)
+                task.setdefault("delegated_trx", 0)
+                task.setdefault("txid_topups", [])
+                task.setdefault("tx_receipts", [])
             return data
     except (FileNotFoundError, json.JSONDecodeError):
         return []
 
+def new_task(schedule_time, return_time, txid_delegate_source=None) -> Dict:
+    """Новая задача скрытия. txid_delegate_source — TXID входящей делегации или другой источник (для дедупликации)."""
+    return {
+        "id": uuid.uuid4().hex[:12],
+        "schedule_time": schedule_time,
+        "return_time": return_time,
+        "executed": False,
+        "delegated": False,
+        "returned": False,
+        "txid_delegate": None,
+        "txid_return": None,
+        "txid_delegate_source": txid_delegate_source,
+        "delegated_trx": 0,
+        "txid_topups": [],
+        "tx_receipts": [],
+    }
+
 def save_scheduled_tasks(tasks):
     # Конвертируем datetime в строки для JSON
     serializable = []
@@ -450,8 +1357,270 @@ def save_scheduled_tasks(tasks):
         t["schedule_time"] = t["schedule_time"].isoformat()
         t["return_time"] = t["return_time"].isoformat()
         serializable.append(t)
-    with open(path_json_otl, "w", encoding="utf-8") as f:
-        json.dump(serializable, f, indent=2, ensure_ascii=False)
+    # Сначала весь текст, потом запись: ошибка сериализации не обнулит файл задач
+    text = json.dumps(serializable, indent=2, ensure_ascii=False)
+    with trace_span("json.save_tasks"):
+        write_file_in_place(path_json_otl, text)
+#--------------------------------------------------------------------------------------------------------------------------------
+
+
+
+
+
+#----------------------------------------------- Владелец состояния ---------------------------------------------------------------
+# Задачи и настройки меняет только поток state. Остальные потоки (планировщик, проверка входящих, реактивный режим,
+# команды из Telegram) отправляют ему команды через очередь и ждут ответа, а читают без блокировок готовый снимок:
+# state.tasks — кортеж задач только для чтения, state.settings — настройки. Опубликованный словарь задачи больше
+# не меняется: команда правит копию и подменяет её в списке, поэтому снимок, взятый до команды, остаётся целым.
+# Команды, накопившиеся в очереди, применяются пачкой и сохраняются одной записью файла, а ответ вызывающий получает
+# только после записи. Так потоки больше не затирают изменения друг друга циклом «прочитал файл — поменял — записал».
+# Если запись не удалась, команды, менявшие этот файл, получают StateNotSaved: изменение остаётся в памяти
+# и записывается со следующей удачной записью.
+STATE_BATCH_MAX = 100  # сколько команд применять за одну запись
+
+
+class StateNotSaved(Exception):
+    """Изменение применено в памяти, но не записано на диск."""
+
+
+def _copy_task(t) -> Dict:
+    """Копия задачи для изменения: списки тоже копируются, они общие со снимком."""
+    return dict(t, txid_topups=list(t["txid_topups"]), tx_receipts=list(t["tx_receipts"]))
+
+
+class StateOwner:
+    def __init__(self):
+        self._commands = queue.Queue()
+        self._thread = None
+        self._tasks = []
+        self._settings = dict(DEFAULT_SETTINGS)
+        self._dirty = set()  # что нужно записать на диск: "tasks", "settings"
+        self._touched = set()  # что изменила текущая команда
+        self._save_error = None  # последняя ошибка записи, пока запись не восстановится
+        self._last_check_time = datetime.min.replace(tzinfo=TZ_MOSCOW)  # последняя проверка входящих (не сохраняется)
+        self.tasks = ()
+        self.settings = MappingProxyType(dict(self._settings))
+        self.flushes = 0  # записей файла задач
+        self.commands = 0
+
+    def start(self):
+        """Загружает задачи и настройки и запускает поток-владелец. До старта команды выполняются в вызывающем потоке."""
+        self._tasks = load_scheduled_tasks()
+        settings = read_settings_file()
+        if settings is None:
+            # Файла нет или он повреждён — начинаем с настроек по умолчанию и сразу их сохраняем
+            settings = dict(DEFAULT_SETTINGS)
+            self._dirty.add("settings")
+        self._settings = settings
+        self._flush()
+        self._publish()
+        self._thread = threading.Thread(target=self._run, name="state", daemon=True)
+        self._thread.start()
+
+    def call(self, command, *args):
+        """
+        Выполняет команду в потоке-владельце и возвращает её результат (после записи на диск).
+        Если изменение не удалось записать — StateNotSaved.
+        """
+        if self._thread is None or threading.current_thread() is self._thread:
+            outer, self._touched = self._touched, set()
+            try:
+                result = command(*args)
+            finally:
+                touched, self._touched = self._touched, outer | self._touched
+            failed = self._flush()
+            self._publish()
+            if touched & failed:
+                raise self._not_saved(touched & failed)
+            return result
+        future = concurrent.futures.Future()
+        self._commands.put((command, args, future))
+        return future.result()
+
+    def _run(self):
+        while True:
+            batch = [self._commands.get()]
+            while len(batch) < STATE_BATCH_MAX:
+                try:
+                    batch.append(self._commands.get_nowait())
+                except queue.Empty:
+                    break
+            results = []
+            with trace_span("state.batch"):
+                for command, args, future in batch:
+                    self._touched = set()
+                    try:
+                        results.append((future, command(*args), None, self._touched))
+                    except Exception as e:
+                        results.append((future, None, e, self._touched))
+                self._touched = set()
+                failed = self._flush()
+                self._publish()
+            self.commands += len(batch)
+            for future, result, error, touched in results:
+                if error is None and touched & failed:
+                    error = self._not_saved(touched & failed)
+                if error is not None:
+                    future.set_exception(error)
+                else:
+                    future.set_result(result)
+
+    def _mark(self, what: str):
+        """Команда изменила задачи ("tasks") или настройки ("settings")."""
+        self._dirty.add(what)
+        self._touched.add(what)
+
+    def _flush(self) -> set:
+        """
+        Записывает изменённое. Возвращает, что записать не удалось: оно остаётся в памяти и помеченным,
+        запишется со следующей пачкой. Администраторам — одно сообщение на сбой, а не на каждую пачку.
+        """
+        failed = set()
+        for what, save, data in (("tasks", save_scheduled_tasks, self._tasks),
+                                 ("settings", write_settings_file, self._settings)):
+            if what not in self._dirty:
+                continue
+            try:
+                save(data)
+            except Exception as e:
+                failed.add(what)
+                if self._save_error is None:
+                    log_error_crash(f"❌ Не удалось сохранить {'задачи' if what == 'tasks' else 'настройки'}: {e}\n"
+                                    f"Изменения пока только в памяти, повторю со следующей записью.")
+                else:
+                    logging.error(f"❌ Ошибка: Не удалось сохранить {what}: {e}")
+                self._save_error = e
+                continue
+            self._dirty.discard(what)
+            if what == "tasks":
+                self.flushes += 1
+        if self._save_error is not None and not self._dirty:
+            log_work("✅ Задачи и настройки снова сохраняются на диск.")
+            self._save_error = None
+        return failed
+
+    def _not_saved(self, what) -> StateNotSaved:
+        return StateNotSaved(f"не записано на диск ({', '.join(sorted(what))}): {self._save_error}. "
+                             f"Изменение действует в памяти и будет записано со следующей удачной записью.")
+
+    def _publish(self):
+        self.tasks = tuple(MappingProxyType(t) for t in self._tasks)
+        self.settings = MappingProxyType(dict(self._settings))
+
+    # --- Команды с задачами ---
+    def add_tasks(self, tasks: List[Dict], dedup: bool = True) -> List:
+        """Добавляет задачи. dedup — пропустить те, чей txid_delegate_source уже есть. Возвращает добавленные."""
+        def command():
+            known = {t["txid_delegate_source"] for t in self._tasks if t["txid_delegate_source"]} if dedup else set()
+            added = []
+            for t in tasks:
+                source = t["txid_delegate_source"]
+                if source and source in known:
+                    continue
+                known.add(source)
+                added.append(t)
+            if added:
+                self._tasks.extend(added)
+                self._mark("tasks")
+            return [MappingProxyType(t) for t in added]
+        return self.call(command)
+
+    def update_tasks(self, ids, change) -> int:
+        """
+        change(task) правит копию каждой задачи из ids; всё — одна запись файла. Задачи, удалённые тем временем,
+        пропускаются. Возвращает число изменённых задач.
+        """
+        ids = set(ids)
+
+        def command():
+            changed = 0
+            for i, t in enumerate(self._tasks):
+                if t["id"] in ids:
+                    t = _copy_task(t)
+                    change(t)
+                    self._tasks[i] = t
+                    changed += 1
+            if changed:
+                self._mark("tasks")
+            return changed
+        return self.call(command)
+
+    def remove_tasks(self, predicate) -> int:
+        """Удаляет задачи, для которых predicate(task) истинно. Возвращает число удалённых."""
+        def command():
+            kept = [t for t in self._tasks if not predicate(t)]
+            removed = len(self._tasks) - len(kept)
+            if removed:
+                self._tasks = kept
+                self._mark("tasks")
+            return removed
+        return self.call(command)
+
+    def remove_active_by_id(self, task_id: str) -> bool:
+        """Удаляет невыполненную задачу по id. False — такой нет (уже выполнена или удалена)."""
+        def command():
+            kept = [t for t in self._tasks if t["executed"] or t["id"] != task_id]
+            if len(kept) == len(self._tasks):
+                return False
+            self._tasks = kept
+            self._mark("tasks")
+            return True
+        return self.call(command)
+
+    # --- Команды с настройками ---
+    def toggle_monitoring(self) -> bool:
+        def command():
+            self._settings["monitoring_enabled"] = not self._settings["monitoring_enabled"]
+            self._mark("settings")
+            return self._settings["monitoring_enabled"]
+        return self.call(command)
+
+    def advance_checkpoint(self, timestamp_ms):
+        """Сдвигает checkpoint истории вперёд (назад никогда)."""
+        def command():
+            if timestamp_ms and timestamp_ms > (self._settings["incoming_checkpoint_ms"] or 0):
+                self._settings["incoming_checkpoint_ms"] = timestamp_ms
+                self._mark("settings")
+        return self.call(command)
+
+    def claim_incoming_check(self, now: datetime, interval_minutes: float) -> bool:
+        """True, если с прошлой проверки входящих прошло interval_minutes; тогда проверка считается начатой в now."""
+        def command():
+            if now - self._last_check_time < timedelta(minutes=interval_minutes):
+                return False
+            self._last_check_time = now
+            return True
+        return self.call(command)
+
+
+state = StateOwner()
+
+
+# Фоновые проходы (планировщик, проверка входящих, догон) вызывают state через эти обёртки. Если запись на диск
+# не удалась, изменение уже действует в памяти, тревогу администраторам один раз на сбой отправил StateOwner._flush,
+# а проход продолжается: транзакция уже отправлена, и её нельзя потерять из-за прерванного прохода.
+def scheduler_update_tasks(ids, change):
+    try:
+        state.update_tasks(ids, change)
+    except StateNotSaved as e:
+        logging.error(f"❌ Задачи изменены только в памяти: {e}")
+
+
+def scheduler_advance_checkpoint(timestamp_ms):
+    try:
+        state.advance_checkpoint(timestamp_ms)
+    except StateNotSaved as e:
+        logging.error(f"❌ Checkpoint истории сдвинут только в памяти: {e}")
+
+
+def scheduler_add_tasks(tasks: List[Dict]) -> List:
+    """state.add_tasks для фоновых проходов. Возвращает добавленные задачи и при неудачной записи."""
+    try:
+        return state.add_tasks(tasks)
+    except StateNotSaved as e:
+        logging.error(f"❌ Задачи добавлены только в памяти: {e}")
+        ids = {t["id"] for t in tasks}
+        return [t for t in state.tasks if t["id"] in ids]
 #--------------------------------------------------------------------------------------------------------------------------------
 
 
@@ -487,7 +1656,7 @@ def delayed_stash_step1(message):
     try:
         naive_dt = datetime.strptime(message.text.strip(), "%Y-%m-%d %H:%M")
         schedule_time = naive_dt.replace(tzinfo=TZ_MOSCOW)
-        if schedule_time <= datetime.now(TZ_MOSCOW):
+        if schedule_time <= chain_clock.now():
             bot.send_message(message.chat.id, "❌ Время должно быть в будущем!")
             return
             
@@ -534,19 +1703,17 @@ def delayed_stash_step3(message, schedule_time, return_time, hold_minutes):
     if tx_input != '-':
         txid_delegate_source = tx_input
 
-    # 2. Сохраняем задачу
-    tasks = load_scheduled_tasks()
-    tasks.append({
-        "schedule_time": schedule_time,
-        "return_time": return_time,
-        "executed": False,
-        "delegated": False,
-        "returned": False,
-        "txid_delegate": None,
-        "txid_return": None,
-        "txid_delegate_source": txid_delegate_source # Сохраняем TXID или None
-    })
-    save_scheduled_tasks(tasks)
+    # 2. Сохраняем задачу (через движок — он владеет файлом задач)
+    try:
+        engine_call("add_task", schedule_time=schedule_time.isoformat(), return_time=return_time.isoformat(),
+                    txid_delegate_source=txid_delegate_source) # Сохраняем TXID или None
+    except EngineUnavailable as e:
+        logging.error(f"❌ Движок недоступен: {e}")
+        bot.send_message(message.chat.id, "⚠️ Движок недоступен, задача не сохранена. Попробуйте позже.")
+        return
+    except (StateNotSaved, EngineCommandError) as e:
+        reply_engine_error(message.chat.id, e, "Задача добавлена")
+        return
 
     # 3. Отправляем подтверждение
     txid_msg = ""
@@ -568,23 +1735,31 @@ def delayed_stash_step3(message, schedule_time, return_time, hold_minutes):
         f"Вернуть через: {hold_minutes} мин → {return_time.strftime('%Y-%m-%d %H:%M')} (UTC+3)",
         parse_mode='Markdown', disable_web_page_preview=True
     )
+
+
+@engine_command("add_task")
+def add_scheduled_task(schedule_time: str, return_time: str, txid_delegate_source=None):
+    """Добавляет ручную задачу. Время — в ISO-формате с часовым поясом."""
+    state.add_tasks([new_task(datetime.fromisoformat(schedule_time), datetime.fromisoformat(return_time),
+                              txid_delegate_source)], dedup=False)
+    request_status_refresh()
 #-----------------------------------------------------------------------------------------------------------------------
 
 
 
 
 #----------------------------------------- Обработчик кнопки Показать отложки --------------------------------------------------
-def _send_tasks_list_message(message):
-    tasks = load_scheduled_tasks()
+@engine_command("tasks_report")
+def tasks_report() -> Dict:
+    """Текст списка активных задач и плана кластеров (MarkdownV2) и их id по порядку — для кнопок удаления."""
+    tasks = state.tasks
     active_tasks = [t for t in tasks if not t.get("executed")]
 
     if not active_tasks:
-        bot.send_message(message.chat.id, "✅ Список активных отложенных задач пуст.")
-        return
+        return {"text": "", "ids": []}
 
     # === 1. Формируем список задач ===
     output = "📜 **Активные отложенные задачи \\(UTC\\+3\\):**\n\n"
-    markup = types.InlineKeyboardMarkup()
 
     for i, task in enumerate(active_tasks):
         # Преобразуем время в строки (если ещё datetime)
@@ -600,8 +1775,6 @@ def _send_tasks_list_message(message):
         elif not task.get("delegated"):
             status = " \\(Ждёт делегирования\\)"
 
-        markup.add(types.InlineKeyboardButton(f"❌ Удалить задачу #{i+1}", callback_data=f"delete_task_{i}"))
-
         output += (
             f"**Задача \\#{i+1}**{status}\n"
             f"**TXID:** `{txid_value}`\n"
@@ -611,10 +1784,10 @@ def _send_tasks_list_message(message):
         )
 
     # === 2. Формируем блок кластеров ===
-    now = datetime.now(TZ_MOSCOW)
-    clusters = group_tasks_into_clusters(active_tasks, max_gap_minutes=SLICE_MINUTES)
+    now = chain_clock.now()
+    clusters, costs = plan_clusters(active_tasks)
     cluster_info = []
-    for cluster in clusters:
+    for cluster, cost in zip(clusters, costs):
         c_start = min(t["schedule_time"] for t in cluster)
         c_end = max(t["return_time"] for t in cluster)
         delegated_in_cluster = any(t["delegated"] and not t["returned"] for t in cluster)
@@ -623,14 +1796,20 @@ def _send_tasks_list_message(message):
             "start": c_start,
             "end": c_end,
             "delegated": delegated_in_cluster,
+            "cost": cost,
         })
 
     if cluster_info:
-        output += "\n📦 **Кластеры задач \\(SLICE\\=5 мин\\):**\n\n"
+        total_cost = escape_markdown_v2(f"{sum(costs):,.2f}")
+        output += (
+            f"\n📦 **План кластеров \\(SLICE\\={TUNABLES.SLICE_MINUTES} мин\\)**\n"
+            f"Ожидаемая стоимость: `{total_cost} TRX`\n\n"
+        )
         for i, c in enumerate(cluster_info, 1):
             start_str = c["start"].strftime('%H:%M') if isinstance(c["start"], datetime) else str(c["start"])
             end_str = c["end"].strftime('%H:%M') if isinstance(c["end"], datetime) else str(c["end"])
             task_nos = ', '.join(f"\\#{active_tasks.index(t)+1}" for t in c["tasks"])
+            cost_str = escape_markdown_v2(f"{c['cost']:,.2f}")
 
             # Определяем статус эмодзи + текст
             if c["start"] <= now < c["end"]:
@@ -650,14 +1829,29 @@ def _send_tasks_list_message(message):
             output += (
                 f"{status_icon} **Кластер {i}**: `{start_str}–{end_str}`\n"
                 f"Задачи: {task_nos}\n"
+                f"Стоимость: `{cost_str} TRX`\n"
                 f"Статус: _{status_text}_\n"
                 "――――――――――――――\n"
             )
 
-    # === 3. Кнопки ===
+    return {"text": output, "ids": [t["id"] for t in active_tasks]}
+
+
+def _send_tasks_list_message(message):
+    report = engine_call("tasks_report")
+    if not report["ids"]:
+        bot.send_message(message.chat.id, "✅ Список активных отложенных задач пуст.")
+        return
+    output = report["text"]
+
+    # Кнопки
+    markup = types.InlineKeyboardMarkup()
+    # В кнопке id задачи, а не номер: пока список висит в чате, номера могут сместиться
+    for i, task_id in enumerate(report["ids"]):
+        markup.add(types.InlineKeyboardButton(f"❌ Удалить задачу #{i+1}", callback_data=f"delete_task_{task_id}"))
     markup.add(types.InlineKeyboardButton("🗑️ Удалить ВСЕ активные", callback_data="confirm_delete_all_tasks"))
 
-    # === 4. Отправка ===
+    # Отправка
     try:
         bot.send_message(
             message.chat.id,
@@ -694,8 +1888,7 @@ def show_delayed_tasks(message):
 @bot.message_handler(func=lambda m: m.text == "Удалить Отложки ❌")
 @admin_only
 def delete_all_delayed_tasks_confirm(message):
-    tasks = load_scheduled_tasks()
-    active_tasks_count = sum(1 for t in tasks if not t.get("executed"))
+    active_tasks_count = engine_call("active_task_count")
     
     if active_tasks_count == 0:
         bot.send_message(message.chat.id, "✅ Нет активных отложенных задач для удаления.")
@@ -728,14 +1921,8 @@ def callback_inline(call):
         bot.edit_message_text("✅ Действие отменено.", chat_id, message_id)
         return
 
-    all_tasks = load_scheduled_tasks()
-    
     if call.data == "confirm_delete_all_tasks":
-        # Создаем новый список, оставляя только выполненные задачи (удаляем все активные)
-        new_all_tasks = [t for t in all_tasks if t.get("executed")]
-        
-        if len(new_all_tasks) < len(all_tasks):
-            save_scheduled_tasks(new_all_tasks)
+        if engine_call("delete_all_tasks"):
             try:
                  bot.edit_message_text(
                     "🗑️ **ВСЕ** активные отложенные задачи удалены.", 
@@ -745,35 +1932,14 @@ def callback_inline(call):
                 )
             except telebot.apihelper.ApiTelegramException: 
                 bot.send_message(chat_id, "🗑️ **ВСЕ** активные отложенные задачи удалены.", parse_mode='Markdown')
-            log_work("Удалены все активные отложенные задачи.")
         else:
             bot.edit_message_text("✅ Нет активных задач для удаления.", chat_id, message_id)
             
     elif call.data.startswith('delete_task_'):
         try:
-            task_index_in_active_list = int(call.data.split('_')[2])
-            
-            active_tasks = [t for t in all_tasks if not t.get("executed")]
-            
-            if task_index_in_active_list < 0 or task_index_in_active_list >= len(active_tasks):
-                bot.send_message(chat_id, "❌ Задача не найдена.")
-                return
-
-            deleted_count = 0
-            new_all_tasks = []
+            task_id = call.data[len('delete_task_'):]
             
-            for t in all_tasks:
-                if not t.get("executed"):
-                    if deleted_count == task_index_in_active_list:
-                        deleted_count += 1
-                        continue 
-                    deleted_count += 1
-                new_all_tasks.append(t)
-                
-            if deleted_count > task_index_in_active_list:
-                save_scheduled_tasks(new_all_tasks)
-                log_work(f"Удалена отложенная задача #{task_index_in_active_list+1}.")
-                
+            if engine_call("delete_task", task_id=task_id):
                 try:
                     bot.delete_message(chat_id, message_id)
                 except Exception:
@@ -782,11 +1948,39 @@ def callback_inline(call):
                 _send_tasks_list_message(call.message) 
                 
             else:
-                bot.send_message(chat_id, "❌ Не удалось найти и удалить задачу.")
+                bot.send_message(chat_id, "❌ Задача не найдена: уже выполнена или удалена.")
                 
+        except (EngineUnavailable, StateNotSaved, EngineCommandError):
+            raise
         except Exception as e:
             log_error_crash(f"Ошибка при удалении задачи: {e}")
             bot.send_message(chat_id, "❌ Произошла ошибка удаления.")
+
+
+@engine_command("active_task_count")
+def active_task_count() -> int:
+    return sum(1 for t in state.tasks if not t.get("executed"))
+
+
+@engine_command("delete_all_tasks")
+def delete_all_tasks() -> bool:
+    """Удаляет все невыполненные задачи. False — удалять было нечего."""
+    # Оставляем только выполненные задачи (удаляем все активные)
+    if not state.remove_tasks(lambda t: not t["executed"]):
+        return False
+    log_work("Удалены все активные отложенные задачи.")
+    request_status_refresh()
+    return True
+
+
+@engine_command("delete_task")
+def delete_task(task_id: str) -> bool:
+    """Удаляет активную задачу по id из кнопки списка отложек. False — такой нет."""
+    if not state.remove_active_by_id(task_id):
+        return False
+    log_work(f"Удалена отложенная задача {task_id}.")
+    request_status_refresh()
+    return True
 #--------------------------------------------------------------------------------------------------------------------------------
 
 
@@ -797,16 +1991,14 @@ def callback_inline(call):
 #------------------------------------- функция отслеживания на входящие делегации ----------------------------------------------------
 def check_incoming_delegations():
     """Проверяет последние транзакции на предмет входящих делегаций энергии."""
-    global last_check_time # Обязательно указываем, что работаем с глобальной переменной
-    
-    now = datetime.now(TZ_MOSCOW)
+    now = chain_clock.now()
     
-    # ПРОВЕРКА ИНТЕРВАЛА
-    if now - last_check_time < timedelta(minutes=CHECK_INTERVAL_MINUTES):
+    # ПРОВЕРКА ИНТЕРВАЛА (время проверки обновляется сразу, до начала выполнения)
+    check_interval = TUNABLES.CHECK_INTERVAL_MINUTES
+    if not state.claim_incoming_check(now, check_interval):
         return
 
-    logging.info(f"🔍 Запущена проверка входящих делегаций (интервал: {CHECK_INTERVAL_MINUTES} мин)...")
-    last_check_time = now # Обновляем время перед началом выполнения
+    logging.info(f"🔍 Запущена проверка входящих делегаций (интервал: {check_interval} мин)...")
 
 
     
@@ -814,87 +2006,412 @@ def check_incoming_delegations():
     # type=0 - все транзакции, limit=50 - последние 50
     # Нам нужны только определенные типы (DelegateResource)
     url = f"https://apilist.tronscanapi.com/api/transaction?sort=-timestamp&count=true&limit=50&start=0&address={main_wallet}"
-    headers = {"TRON-PRO-API-KEY": api_key_tronscan}
     
     try:
-        response = requests.get(url, headers=headers)
-        if response.status_code != 200:
-            raise Exception(f"TronScan API Error: {response.status_code}, {response.text}")
-        
-        data = response.json()
-        transactions = data.get("data", [])
+        # Разбираем ответ потоково и сразу отбрасываем всё, кроме DelegateResource
+        transactions = []
+        newest_ts = 0
+        for tx in stream_tronscan_items(url, TX_FIELDS, "tronscan.transactions"):
+            newest_ts = max(newest_ts, tx.get("timestamp") or 0)
+            if tx.get("contractType") == 57:
+                transactions.append(tx)
         
     except Exception as e:
         log_error_crash(f"Ошибка запроса истории транзакций к TronScan: {e}")
         return
 
     # 2. Обработка транзакций
-    new_tasks_added = False
-    tasks = load_scheduled_tasks()
+    found = []  # (задача, время транзакции)
+    tasks = state.tasks
     
     for tx in transactions:
-        # Ищем транзакции типа DelegateResource
-        if tx.get("contractType") == 57:  # 43 - DelegateResourceContract
-            contract_data = tx.get("contractData", {})
+        # Ищем входящие делегации ЭНЕРГИИ (DelegateResource) на main_wallet
+        if is_incoming_energy_delegation(tx):
             
-            # Проверяем, что это входящая делегация на main_wallet
-            # и делегируется ЭНЕРГИЯ, а не Bandwidth
-            if (contract_data.get("receiver_address") == main_wallet and contract_data.get("resource") == "ENERGY"):
-                
-                # Получаем время транзакции (timestamp в мс)
-                timestamp_ms = tx.get("timestamp")
-                tx_time = datetime.fromtimestamp(timestamp_ms / 1000.0, tz=TZ_MOSCOW)
-                
-                # Идентификатор транзакции для предотвращения повторной обработки
-                tx_id = tx.get("hash")
-                
-                # Проверяем, не обработана ли уже эта транзакция
-                # (ищем txid в списке выполненных/запланированных)
-                if any(t.get("txid_delegate_source") == tx_id for t in tasks):
-                    continue # Пропускаем, уже добавлено
-
-                # 3. Вычисляем время отложенной задачи
-                # 58 минут после времени транзакции
-                TIME_BUY_ENERGY = int(os.getenv("TIME_BUY_ENERGY"))
-                schedule_time = tx_time + timedelta(minutes=TIME_BUY_ENERGY)
-                
-                # 4. Создаем задачу на отложенное делегирование (Спрятать)
-                # Держим 5 минут (можно настроить)
-                hold_minutes = int(os.getenv("AUTO_HOLD_MINUTES"))
-                return_time = schedule_time + timedelta(minutes=hold_minutes)
-                txid_link = "https://tronscan.org/#/transaction/" + tx_id
-                # Проверяем, что время еще в будущем или прошло не более 30 секунд
-                # (для обработки почти реального времени, если вдруг пропустили)
-                now = datetime.now(TZ_MOSCOW)
-                if schedule_time < now and (now - schedule_time).total_seconds() > 30:
-                     logging.info(f"⚠️ Пропущено: Входящая делегация [TXID]({txid_link}) слишком старая. Время делегирования `{tx_time.strftime('%Y-%m-%d %H:%M:%S')}` уже прошло.")
-                     continue
-                
-                tasks.append({
-                    "schedule_time": schedule_time,
-                    "return_time": return_time,
-                    "executed": False,
-                    "delegated": False,
-                    "returned": False,
-                    "txid_delegate": None,
-                    "txid_return": None,
-                    "txid_delegate_source": tx_id # Новый ключ для отслеживания
-                })
-                new_tasks_added = True
-                
-                # Отправка уведомления администраторам
+            # Идентификатор транзакции для предотвращения повторной обработки
+            tx_id = tx.get("hash")
+            
+            # Проверяем, не обработана ли уже эта транзакция
+            # (ищем txid в списке выполненных/запланированных)
+            if any(t.get("txid_delegate_source") == tx_id for t in tasks):
+                continue # Пропускаем, уже добавлено
+
+            # 3. Вычисляем время отложенной задачи: TIME_BUY_ENERGY после транзакции, держим AUTO_HOLD_MINUTES
+            tx_time, schedule_time, return_time = incoming_task_times(tx)
+            txid_link = "https://tronscan.org/#/transaction/" + tx_id
+            # Проверяем, что время еще в будущем или прошло не более 30 секунд
+            # (для обработки почти реального времени, если вдруг пропустили; более старые подбирает догон при старте)
+            now = chain_clock.now()
+            if schedule_time < now and (now - schedule_time).total_seconds() > 30:
+                 logging.info(f"⚠️ Пропущено: Входящая делегация [TXID]({txid_link}) слишком старая. Время делегирования `{tx_time.strftime('%Y-%m-%d %H:%M:%S')}` уже прошло.")
+                 continue
+            
+            found.append((new_task(schedule_time, return_time, tx_id), tx_time))
+
+    # 4. Сохранение задач — все найденные одной записью; state ещё раз отсеет уже добавленные (например, догоном)
+    added = {t["id"] for t in scheduler_add_tasks([task for task, _ in found])}
+    for task, tx_time in found:
+        if task["id"] not in added:
+            continue
+        tx_id = task["txid_delegate_source"]
+        # Отправка уведомления администраторам
+        log_work(
+            f"✨ **Новая входящая делегация обнаружена!**\n"
+            f"TXID: `{tx_id}`\n"
+            f"Ссылка на транзакцию: [TXID](https://tronscan.org/#/transaction/{tx_id})\n"
+            f"Время транзакции: `{tx_time.strftime('%Y-%m-%d %H:%M:%S')}` (UTC+3)\n"
+            f"Спрятать в: `{task['schedule_time'].strftime('%Y-%m-%d %H:%M:%S')}` (UTC+3)\n"
+            f"Вернуть в: `{task['return_time'].strftime('%Y-%m-%d %H:%M:%S')}` (UTC+3)"
+        )
+    if _backfill_cursor_ms is None:
+        scheduler_advance_checkpoint(newest_ts)  # пока догон не закончен, checkpoint не обгоняет непрочитанную историю
+
+
+def is_incoming_energy_delegation(tx: Dict) -> bool:
+    """DelegateResource (contractType 57) ЭНЕРГИИ, а не Bandwidth, на main_wallet."""
+    contract_data = tx.get("contractData", {})
+    return (tx.get("contractType") == 57
+            and contract_data.get("receiver_address") == main_wallet
+            and contract_data.get("resource") == "ENERGY")
+
+
+def incoming_task_times(tx: Dict) -> Tuple[datetime, datetime, datetime]:
+    """(время транзакции, когда прятать, когда вернуть) для входящей делегации."""
+    tunables = TUNABLES
+    tx_ts = tx.get("timestamp") / 1000.0
+    # Складываем в unix-времени: с именованным поясом сложение datetime идёт по «настенному» времени и ломается на переходе DST
+    schedule_ts = tx_ts + tunables.TIME_BUY_ENERGY * 60
+    return (datetime.fromtimestamp(tx_ts, tz=TZ_MOSCOW),
+            datetime.fromtimestamp(schedule_ts, tz=TZ_MOSCOW),
+            datetime.fromtimestamp(schedule_ts + tunables.AUTO_HOLD_MINUTES * 60, tz=TZ_MOSCOW))
+#--------------------------------------------------------------------------------------------------------------------------------
+
+
+
+
+
+
+
+#------------------------------------- Догон пропущенных делегаций после простоя ---------------------------------------------
+# При старте бот дочитывает историю с последней обработанной транзакции (checkpoint в bot_settings.json).
+# Смотреть дальше, чем TIME_BUY_ENERGY + AUTO_HOLD_MINUTES назад, смысла нет: такие задачи уже закончились бы.
+# Страницы тянутся параллельно (BACKFILL_PARALLEL) с общим ограничением частоты запросов (BACKFILL_RPS).
+# Если за проход упёрлись в BACKFILL_MAX_PAGES, checkpoint не двигается, а более старая часть дочитывается следующими
+# проходами на тиках планировщика (_backfill_cursor_ms). Пока догон не закончен, обычная проверка входящих
+# тоже не двигает checkpoint: после рестарта посреди догона история перечитывается с того же checkpoint.
+_backfill_cursor_ms = None  # верхняя граница ещё не прочитанной истории (в памяти), None — догон не идёт
+
+
+class _RateLimiter:
+    """Пропускает не больше rps вызовов wait() в секунду на все потоки."""
+
+    def __init__(self, rps: float):
+        self.interval = 1 / rps if rps > 0 else 0
+        self._lock = threading.Lock()
+        self._next_at = 0.0
+
+    def wait(self):
+        with self._lock:
+            now = time.monotonic()
+            at = max(now, self._next_at)
+            self._next_at = at + self.interval
+        if at > now:
+            time.sleep(at - now)
+
+
+def _fetch_history_page(start: int, min_ts: int, max_ts: int, limiter: _RateLimiter):
+    """Одна страница истории: (кол-во транзакций на странице, самый старый timestamp на ней, входящие DelegateResource)."""
+    limiter.wait()
+    url = (
+        f"https://apilist.tronscanapi.com/api/transaction?sort=-timestamp&count=true"
+        f"&limit={BACKFILL_PAGE_SIZE}&start={start}&address={main_wallet}"
+        f"&start_timestamp={min_ts}&end_timestamp={max_ts}"
+    )
+    count, oldest_ts, delegations = 0, None, []
+    for tx in stream_tronscan_items(url, TX_FIELDS, "tronscan.backfill_page"):
+        count += 1
+        ts = tx.get("timestamp") or 0
+        oldest_ts = ts if oldest_ts is None else min(oldest_ts, ts)
+        if tx.get("contractType") == 57:
+            delegations.append(tx)
+    return count, oldest_ts, delegations
+
+
+def backfill_incoming_delegations():
+    """
+    Восстанавливает задачи по входящим делегациям, пропущенным за время простоя, и присылает сводку.
+    Если задан _backfill_cursor_ms, продолжает незаконченный догон с этой границы вниз.
+    """
+    global _backfill_cursor_ms
+    now = chain_clock.now()
+    now_ms = int(now.timestamp() * 1000)
+    horizon_ms = now_ms - (TUNABLES.TIME_BUY_ENERGY + TUNABLES.AUTO_HOLD_MINUTES) * 60_000
+    checkpoint = state.settings["incoming_checkpoint_ms"]
+    min_ts = max(checkpoint or 0, horizon_ms)
+    continuing = _backfill_cursor_ms is not None
+    max_ts = _backfill_cursor_ms if continuing else now_ms
+
+    limiter = _RateLimiter(BACKFILL_RPS)
+    scanned, pages, oldest_ts, delegations = 0, 0, None, []
+    started = time.monotonic()
+    try:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=BACKFILL_PARALLEL, thread_name_prefix="backfill") as pool:
+            last_page_full = True
+            while last_page_full and pages < BACKFILL_MAX_PAGES:
+                # Первую страницу берём одну: после короткого простоя её обычно достаточно
+                width = 1 if pages == 0 else min(BACKFILL_PARALLEL, BACKFILL_MAX_PAGES - pages)
+                starts = [(pages + k) * BACKFILL_PAGE_SIZE for k in range(width)]
+                for count, page_oldest, found in pool.map(lambda s: _fetch_history_page(s, min_ts, max_ts, limiter), starts):
+                    pages += 1
+                    scanned += count
+                    if page_oldest is not None:
+                        oldest_ts = page_oldest if oldest_ts is None else min(oldest_ts, page_oldest)
+                    delegations.extend(tx for tx in found if is_incoming_energy_delegation(tx))
+                    last_page_full = last_page_full and count == BACKFILL_PAGE_SIZE
+    except Exception as e:
+        log_error_crash(f"❌ Ошибка догона истории после простоя: {e}")
+        return
+    # Упёрлись в BACKFILL_MAX_PAGES, а история ещё не кончилась: между checkpoint и oldest_ts остались непрочитанные транзакции
+    truncated = last_page_full
+
+    known = {t["txid_delegate_source"] for t in state.tasks}
+    recovered_tasks, expired = [], 0
+    for tx in sorted(delegations, key=lambda tx: tx.get("timestamp") or 0):
+        tx_id = tx.get("hash")
+        if tx_id in known:
+            continue
+        tx_time, schedule_time, return_time = incoming_task_times(tx)
+        if return_time <= now:
+            expired += 1
+            continue
+        recovered_tasks.append(new_task(schedule_time, return_time, tx_id))
+
+    added = scheduler_add_tasks(recovered_tasks)
+    recovered = len(added)
+    late = sum(1 for t in added if t["schedule_time"] < now)
+    if truncated:
+        # Checkpoint не трогаем: между ним и oldest_ts история не прочитана, её дочитает следующий проход
+        _backfill_cursor_ms = oldest_ts
+    else:
+        _backfill_cursor_ms = None
+        scheduler_advance_checkpoint(now_ms)
+    state.claim_incoming_check(now, 0)
+
+    if continuing:
+        upto = datetime.fromtimestamp(max_ts / 1000, tz=TZ_MOSCOW).strftime('%Y-%m-%d %H:%M:%S')
+        since = f"продолжение: транзакции до `{upto}` (UTC+3)"
+    elif checkpoint:
+        downtime = timedelta(milliseconds=now_ms - checkpoint)
+        since = f"простой с последней обработанной транзакции: {str(downtime).split('.')[0]}"
+    else:
+        since = "checkpoint не найден, просмотрено последнее окно"
+    if truncated:
+        unread = datetime.fromtimestamp(oldest_ts / 1000, tz=TZ_MOSCOW).strftime('%Y-%m-%d %H:%M:%S')
+        since += (f"\n⚠️ История обрезана лимитом BACKFILL_MAX_PAGES ({BACKFILL_MAX_PAGES}): "
+                  f"транзакции старше `{unread}` (UTC+3) пока не просмотрены, дочитаю на следующем тике")
+    log_work(
+        f"♻️ **Догон истории после запуска**\n"
+        f"{since}\n"
+        f"Страниц: {pages}, транзакций: {scanned} за {time.monotonic() - started:.1f} с\n"
+        f"Входящих делегаций: {len(delegations)}\n"
+        f"Восстановлено задач: {recovered} (из них стартуют с опозданием: {late})\n"
+        f"Уже неактуальны: {expired}"
+    )
+    return recovered
+#--------------------------------------------------------------------------------------------------------------------------------
+
+
+
+
+
+
+#------------------------------------------------ Телеметрия энергии ----------------------------------------------------------------
+# Сэмплер раз в TELEMETRY_INTERVAL_SECONDS пишет показатели get_energy_info для MAIN_WALLET и STASHING_TARGET
+# в кольцевые буферы фиксированного размера на array('d') — ~40 байт на сэмпл, без dict/объектов на каждую точку.
+# Снимок буферов сохраняется в TELEMETRY_PATH, чтобы история переживала перезапуск контейнера.
+class EnergyRing:
+    """Кольцевой буфер сэмплов энергии одного кошелька."""
+
+    FIELDS = ("ts", "free_energy", "energy_used", "trx_energy_price", "delegated_in")
+
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self.data = array("d", bytes(8 * capacity * len(self.FIELDS)))
+        self.head = 0   # индекс следующей записи
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def append(self, ts, free_energy, energy_used, trx_energy_price, delegated_in):
+        width = len(self.FIELDS)
+        with self._lock:
+            base = self.head * width
+            self.data[base:base + width] = array("d", (ts, free_energy, energy_used, trx_energy_price, delegated_in))
+            self.head = (self.head + 1) % self.capacity
+            self.count = min(self.count + 1, self.capacity)
+
+    def rows(self) -> List[Tuple[float, ...]]:
+        """Сэмплы от старых к новым."""
+        width = len(self.FIELDS)
+        with self._lock:
+            start = (self.head - self.count) % self.capacity
+            out = []
+            for k in range(self.count):
+                base = ((start + k) % self.capacity) * width
+                out.append(tuple(self.data[base:base + width]))
+            return out
+
+    def last(self):
+        rows = self.rows()
+        return rows[-1] if rows else None
+
+    def to_bytes(self) -> bytes:
+        with self._lock:
+            return struct.pack("<III", self.capacity, self.head, self.count) + self.data.tobytes()
+
+    def load_bytes(self, raw: bytes) -> bool:
+        capacity, head, count = struct.unpack_from("<III", raw)
+        if capacity != self.capacity or len(raw) != 12 + 8 * capacity * len(self.FIELDS):
+            return False  # размер буфера поменяли в .env — старый снимок не подходит
+        with self._lock:
+            self.data = array("d")
+            self.data.frombytes(raw[12:])
+            self.head, self.count = head, count
+        return True
+
+
+energy_telemetry = {}  # адрес -> EnergyRing, заполняется в init_telemetry()
+
+
+def init_telemetry():
+    """Создаёт буферы и подгружает снимок с диска."""
+    for address in (main_wallet, stashing_target):
+        energy_telemetry[address] = EnergyRing(TELEMETRY_CAPACITY)
+    try:
+        with open(TELEMETRY_PATH, "rb") as f:
+            raw = f.read()
+        if raw[:4] != b"ETS1":
+            return
+        pos = 4
+        while pos < len(raw):
+            addr_len, blob_len = struct.unpack_from("<HI", raw, pos)
+            pos += 6
+            address = raw[pos:pos + addr_len].decode("utf-8")
+            pos += addr_len
+            ring = energy_telemetry.get(address)
+            if ring is not None:
+                ring.load_bytes(raw[pos:pos + blob_len])
+            pos += blob_len
+    except FileNotFoundError:
+        pass
+    except Exception as e:
+        logging.error(f"❌ Ошибка: Не удалось прочитать снимок телеметрии: {e}")
+
+
+def save_telemetry_snapshot():
+    parts = [b"ETS1"]
+    for address, ring in energy_telemetry.items():
+        addr = address.encode("utf-8")
+        blob = ring.to_bytes()
+        parts.append(struct.pack("<HI", len(addr), len(blob)) + addr + blob)
+    try:
+        with trace_span("telemetry.snapshot"), open(TELEMETRY_PATH, "wb") as f:
+            f.write(b"".join(parts))
+    except Exception as e:
+        logging.error(f"❌ Ошибка: Не удалось сохранить снимок телеметрии: {e}")
+
+
+def sample_energy_telemetry():
+    """Снимает по одному сэмплу для каждого кошелька и сохраняет снимок."""
+    ts = time.time()
+    for address, ring in energy_telemetry.items():
+        try:
+            free_energy_ac, trx_energy_price, _, all_energy, energy_used, delegated_in = query_energy_info(address)
+        except Exception as e:
+            # Пропуск одного сэмпла не страшен; тревога администраторам каждые TELEMETRY_INTERVAL_SECONDS — лишняя
+            logging.warning(f"Сэмпл телеметрии {address} пропущен: {e}")
+            continue
+        if not all_energy:
+            # Пустой ответ: нулевая строка дала бы ложный «расход» на следующем сэмпле в find_usage_windows
+            continue
+        ring.append(ts, free_energy_ac, energy_used, trx_energy_price, delegated_in)
+    save_telemetry_snapshot()
+
+
+def find_usage_windows(ring: EnergyRing) -> List[int]:
+    """
+    Ищет повторяющиеся суточные окна расхода энергии.
+    Сутки делятся на слоты по PATTERN_SLOT_MINUTES; слот считается окном, если в нём рост EnergyUsed
+    на PATTERN_MIN_ENERGY и больше наблюдался минимум в PATTERN_MIN_DAYS разных дней.
+    Возвращает начала окон в минутах от полуночи (UTC+3).
+    """
+    days_by_slot = {}
+    prev = None
+    for ts, _, energy_used, _, _ in ring.rows():
+        if prev is not None and energy_used - prev >= PATTERN_MIN_ENERGY:
+            local = datetime.fromtimestamp(ts, tz=TZ_MOSCOW)
+            slot = (local.hour * 60 + local.minute) // PATTERN_SLOT_MINUTES
+            days_by_slot.setdefault(slot, set()).add(local.date())
+        prev = energy_used
+    return sorted(slot * PATTERN_SLOT_MINUTES for slot, days in days_by_slot.items() if len(days) >= PATTERN_MIN_DAYS)
+
+
+# Окна, по которым уже было предложение/задача: "YYYY-MM-DD HH:MM"
+_pattern_handled = set()
+
+
+def schedule_from_patterns():
+    """Предлагает (propose) или создаёт (create) задачи на ближайшие повторяющиеся окна расхода."""
+    if AUTO_PATTERN_MODE == "off":
+        return
+    ring = energy_telemetry.get(main_wallet)
+    if ring is None:
+        return
+
+    now = chain_clock.now()
+    midnight = now.replace(hour=0, minute=0, second=0, microsecond=0)
+
+    for start_min in find_usage_windows(ring):
+        for day in (0, 1):
+            schedule_time = midnight + timedelta(days=day, minutes=start_min)
+            # Смотрим только окна, которые начнутся в течение ближайшего часа
+            if not now <= schedule_time < now + timedelta(hours=1):
+                continue
+            key = schedule_time.strftime('%Y-%m-%d %H:%M')
+            if key in _pattern_handled:
+                continue
+            _pattern_handled.add(key)
+            return_time = schedule_time + timedelta(minutes=PATTERN_SLOT_MINUTES)
+            source = f"pattern:{key}"
+
+            if AUTO_PATTERN_MODE == "propose":
                 log_work(
-                    f"✨ **Новая входящая делегация обнаружена!**\n"
-                    f"TXID: `{tx_id}`\n"
-                    f"Ссылка на транзакцию: [TXID]({txid_link})\n"
-                    f"Время транзакции: `{tx_time.strftime('%Y-%m-%d %H:%M:%S')}` (UTC+3)\n"
-                    f"Спрятать в: `{schedule_time.strftime('%Y-%m-%d %H:%M:%S')}` (UTC+3)\n"
-                    f"Вернуть в: `{return_time.strftime('%Y-%m-%d %H:%M:%S')}` (UTC+3)"
+                    f"💡 **Повторяющееся окно расхода энергии**\n"
+                    f"Предлагаю спрятать: `{key}` – `{return_time.strftime('%H:%M')}` (UTC+3)\n"
+                    f"Добавить можно через «Отложить ⏳»."
                 )
-                
-    # 5. Сохранение задач
-    if new_tasks_added:
-        save_scheduled_tasks(tasks)
+                continue
+
+            if not scheduler_add_tasks([new_task(schedule_time, return_time, source)]):
+                continue
+            log_work(
+                f"🤖 **Задача создана по телеметрии**\n"
+                f"Спрятать в: `{key}` (UTC+3)\n"
+                f"Вернуть в: `{return_time.strftime('%Y-%m-%d %H:%M')}` (UTC+3)"
+            )
+
+    # Не даём множеству расти бесконечно: прошедшие окна больше не нужны
+    cutoff = (now - timedelta(days=1)).strftime('%Y-%m-%d %H:%M')
+    _pattern_handled.difference_update({k for k in _pattern_handled if k < cutoff})
+
+
+def telemetry_worker():
+    while True:
+        try:
+            sample_energy_telemetry()
+            schedule_from_patterns()
+        except Exception as e:
+            log_error_crash(f"❌ Ошибка в telemetry_worker: {e}")
+        time.sleep(TELEMETRY_INTERVAL_SECONDS)
 #--------------------------------------------------------------------------------------------------------------------------------
 
 
@@ -904,198 +2421,1520 @@ def check_incoming_delegations():
 
 
 #------------------------------------------------ Обьединение в кластер ----------------------------------------------------------------
-def group_tasks_into_clusters(tasks: List[Dict], max_gap_minutes: int) -> List[List[Dict]]:
+# Модель стоимости: каждый кластер стоит пару транзакций delegate+undelegate,
+# а склейка через разрыв стоит энергию, которая всё это время остаётся спрятанной.
+# Цена энергии (trx_energy_price) и объём прячущегося TRX кэшируются, чтобы не дёргать API на каждом тике.
+_cost_model_lock = threading.Lock()
+_cost_model = {"updated": None, "trx_energy_price": 0, "hidden_trx": 0}
+
+
+def get_cost_model() -> Dict:
+    """Возвращает параметры модели стоимости, обновляя кэш раз в ENERGY_PRICE_TTL_MINUTES."""
+    with _cost_model_lock:
+        now = datetime.now(TZ_MOSCOW)
+        updated = _cost_model["updated"]
+        if updated is None or now - updated >= timedelta(minutes=ENERGY_PRICE_TTL_MINUTES):
+            # Без тревог администраторам: вызывается на каждом проходе планировщика, при сбое API остаются прошлые значения
+            try:
+                _, trx_energy_price, _, _, _, _ = query_energy_info(main_wallet)
+                max_sun = query_max_delegatable_trx(main_wallet)
+            except Exception as e:
+                logging.warning(f"Модель стоимости не обновлена, действуют прошлые значения: {e}")
+                trx_energy_price, max_sun = 0, 0
+            if trx_energy_price > 0:
+                _cost_model["trx_energy_price"] = trx_energy_price
+            # Во время активной делегации max_size = 0, поэтому храним последний ненулевой объём
+            if max_sun > 0:
+                _cost_model["hidden_trx"] = max_sun / 1_000_000
+            _cost_model["updated"] = now
+        return dict(_cost_model)
+
+
+def gap_cost_trx(gap_minutes: float, model: Dict) -> float:
+    """Стоимость удержания энергии спрятанной в течение разрыва между задачами (в TRX)."""
+    price = model["trx_energy_price"]
+    if price <= 0 or gap_minutes <= 0:
+        return 0.0
+    hidden_energy = model["hidden_trx"] / price
+    # Энергия восстанавливается за сутки: разрыв в N минут "съедает" N/1440 суточного объёма
+    return hidden_energy * (gap_minutes / 1440) * ENERGY_FEE_SUN / 1_000_000
+
+
+class ClusterPlanner:
     """
-    Группирует задачи в кластеры, где:
-      - задачи пересекаются, ИЛИ
-      - разрыв между концом одной и началом другой ≤ max_gap_minutes
-    
-    Возвращает список кластеров (списков задач), отсортированных по времени.
+    Оптимальное разбиение задач на кластеры динамическим программированием.
+
+    Пересекающиеся задачи сначала склеиваются в неразрывные блоки. Затем для
+    отсортированных блоков считается best[j] — минимальная стоимость покрытия
+    первых j блоков, где каждый кластер стоит 2 * TX_FEE_TRX плюс стоимость
+    всех разрывов внутри него. Разрывы длиннее max_gap_minutes не склеиваются,
+    а блоки, уже делегированные одной транзакцией, не разрезаются.
+
+    Результат DP для префикса блоков переиспользуется: если новые задачи
+    добавились в конец, досчитываются только новые позиции. best[j] зависит
+    от max_gap_minutes только через то, какие разрывы можно склеивать, поэтому
+    после смены SLICE_MINUTES префикс до первого изменившегося решения тоже
+    не пересчитывается.
     """
-    if not tasks:
-        return []
 
-    # Сортируем по schedule_time
-    sorted_tasks = sorted(tasks, key=lambda t: t["schedule_time"])
-    clusters = []
-    current_cluster = [sorted_tasks[0]]
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._keys = []    # ключи блоков, для которых посчитан DP
+        self._merge = []   # can_merge этих блоков при прошлом расчёте
+        self._params = None
+        self._best = [0.0]
+        self._cut = [0]
+        self.last_reused = 0  # сколько блоков взято из прошлого расчёта (для отчёта о перепланировании)
+
+    @staticmethod
+    def _build_blocks(tasks: List[Dict]) -> List[Dict]:
+        blocks = []
+        for t in sorted(tasks, key=lambda t: t["schedule_time"]):
+            if blocks and t["schedule_time"] <= blocks[-1]["end"]:
+                b = blocks[-1]
+                b["tasks"].append(t)
+                b["end"] = max(b["end"], t["return_time"])
+            else:
+                blocks.append({"tasks": [t], "start": t["schedule_time"], "end": t["return_time"]})
+        for b in blocks:
+            b["sticky"] = any(t["delegated"] and not t["returned"] for t in b["tasks"])
+        return blocks
+
+    def plan(self, tasks: List[Dict], max_gap_minutes: int, model: Dict) -> Tuple[List[List[Dict]], List[float]]:
+        """Возвращает (кластеры, стоимость каждого кластера в TRX)."""
+        if not tasks:
+            return [], []
+
+        blocks = self._build_blocks(tasks)
+        keys = [(b["start"], b["end"], b["sticky"]) for b in blocks]
+        params = (TX_FEE_TRX, ENERGY_FEE_SUN, model["trx_energy_price"], model["hidden_trx"])
+        pair_cost = 2 * TX_FEE_TRX
+
+        # gaps[k] — разрыв (мин) перед блоком k; can_cut[k] — можно ли начать новый кластер с блока k
+        gaps = [0.0] * len(blocks)
+        can_cut = [True] * len(blocks)
+        can_merge = [True] * len(blocks)
+        for k in range(1, len(blocks)):
+            gaps[k] = (blocks[k]["start"] - blocks[k - 1]["end"]).total_seconds() / 60
+            can_cut[k] = not (blocks[k]["sticky"] and blocks[k - 1]["sticky"])
+            can_merge[k] = gaps[k] <= max_gap_minutes or not can_cut[k]
+
+        with self._lock:
+            # Переиспользуем DP только для совпадающего префикса (те же блоки и те же склейки) при тех же ценах
+            reuse = 0
+            if params == self._params:
+                while (reuse < min(len(keys), len(self._keys)) and keys[reuse] == self._keys[reuse]
+                       and can_merge[reuse] == self._merge[reuse]):
+                    reuse += 1
+            best = self._best[:reuse + 1]
+            cut = self._cut[:reuse + 1]
+
+            for j in range(reuse + 1, len(blocks) + 1):
+                # Кластер из блоков i..j-1, идём от j-1 влево, накапливая стоимость разрывов
+                best_j, cut_j, inner = float("inf"), j - 1, 0.0
+                for i in range(j - 1, -1, -1):
+                    if can_cut[i] or i == 0:
+                        cost = best[i] + pair_cost + inner
+                        if cost < best_j:
+                            best_j, cut_j = cost, i
+                    if i == 0 or not can_merge[i]:
+                        break
+                    inner += gap_cost_trx(gaps[i], model)
+                best.append(best_j)
+                cut.append(cut_j)
+
+            self._keys, self._merge, self._params, self._best, self._cut = keys, can_merge, params, best, cut
+            self.last_reused = reuse
+
+        # Восстанавливаем разбиение
+        clusters, costs = [], []
+        j = len(blocks)
+        while j > 0:
+            i = cut[j]
+            clusters.append([t for b in blocks[i:j] for t in b["tasks"]])
+            costs.append(best[j] - best[i])
+            j = i
+        clusters.reverse()
+        costs.reverse()
+        return clusters, costs
+
+
+cluster_planner = ClusterPlanner()
+
+
+def plan_clusters(tasks: List[Dict]) -> Tuple[List[List[Dict]], List[float]]:
+    """Планирует кластеры для pending-задач по текущей модели стоимости."""
+    return cluster_planner.plan(tasks, max_gap_minutes=TUNABLES.SLICE_MINUTES, model=get_cost_model())
+# ---------------------------------------------------------------------------------------------------------------------------------------
+
+
 
-    for t in sorted_tasks[1:]:
-        last_in_cluster = current_cluster[-1]
-        # Разрыв = начало новой - конец последней в кластере
-        gap = (t["schedule_time"] - last_in_cluster["return_time"]).total_seconds() / 60  # в минутах
 
-        if gap <= max_gap_minutes and t["schedule_time"] <= last_in_cluster["return_time"] + timedelta(minutes=max_gap_minutes):
-            # Задача входит в текущий кластер (пересекается или близка)
-            current_cluster.append(t)
-        else:
-            # Новый кластер
-            clusters.append(current_cluster)
-            current_cluster = [t]
 
-    clusters.append(current_cluster)
-    return clusters
-# ---------------------------------------------------------------------------------------------------------------------------------------
 
 
+#---------------------------------------------------------------- Догрузка активного кластера ------------------------------------------
+# Время последней проверки max_size для каждого активного кластера (ключ — начало кластера)
+_topup_checked = {}
+
+
+def topup_cluster(c: Dict, now: datetime) -> bool:
+    """
+    Докидывает в уже делегированный кластер TRX, освободившийся или застейканный после старта.
+    Проверка идёт не чаще TOPUP_INTERVAL_SECONDS, транзакция — только при приросте ≥ TOPUP_MIN_TRX.
+    Возвращает True, если догрузка прошла (задачи кластера обновлены в state).
+    """
+    if TOPUP_INTERVAL_SECONDS <= 0:
+        return False
+    last = _topup_checked.get(c["start"])
+    if last is not None and (now - last).total_seconds() < TOPUP_INTERVAL_SECONDS:
+        return False
+    key = RetryQueue.key("topup", c)
+    if not retry_queue.due(key):
+        return False
+    _topup_checked[c["start"]] = now
+
+    try:
+        trx_amount = query_max_delegatable_trx(main_wallet) // 1_000_000
+        if trx_amount < TOPUP_MIN_TRX:
+            retry_queue.succeeded(key)
+            return False
+        txid = send_delegate_energy(main_wallet, stashing_target, trx_amount)
+    except Exception as e:
+        retry_queue.failed(key, "topup", e, chain_clock.deadline(c["end"]))
+        return False
+    retry_queue.succeeded(key)
+
+    total = max(t["delegated_trx"] for t in c["tasks"]) + trx_amount
+    receipt = take_tx_receipt(txid, "topup")
+
+    def add_topup(t):
+        t["delegated_trx"] = total
+        t["txid_topups"].append(txid)
+        if receipt:
+            t["tx_receipts"].append(receipt)
+    scheduler_update_tasks([t["id"] for t in c["tasks"]], add_topup)
+    txid_link = f"https://tronscan.org/#/transaction/{txid}"
+    log_work(
+        f"\n➕ Догрузка кластера\n\n"
+        f"Начало: {c['start']}\n"
+        f"Конец:  {c['end']}\n\n"
+        f"Догружено: {trx_amount:,.2f} TRX\n"
+        f"Всего спрятано: {total:,.2f} TRX\n\n"
+        f"[TXID]({txid_link})"
+    )
+    return True
+#--------------------------------------------------------------------------------------------------------------------------------
+
+
+
+
+#---------------------------------------------------------------- Учёт кластеров ----------------------------------------------------
+# Каждый закрытый кластер — одна строка JSON в LEDGER_PATH (только дозапись): сколько TRX было спрятано и сколько
+# держалось, комиссии транзакций delegate/topup/undelegate и время их подтверждения.
+# Часовые и дневные суммы (rollups) обновляются при каждой записи и лежат в ROLLUPS_PATH, поэтому /stats не читает
+# ни журнал, ни scheduled_tasks.json. В rollups запоминается размер журнала: если он не совпал (файл заменили,
+# запись оборвалась), суммы один раз пересчитываются по журналу при старте.
+LEDGER_HOURS_KEEP = 7 * 24
+LEDGER_DAYS_KEEP = 400
+LEDGER_CSV_FIELDS = ("closed", "start", "end", "outcome", "tasks", "delegated_trx", "hold_s", "trx_hours",
+                     "fee_trx", "net_fee_trx", "energy_fee_trx", "net_usage", "energy_usage",
+                     "txs", "confirm_avg_s", "confirm_max_s", "txids")
+
+_ledger_lock = threading.Lock()
+_rollups = None  # {"ledger_bytes", "hourly": {ключ: сумма}, "daily": {...}, "total": сумма}
+
+
+def _empty_bucket() -> Dict:
+    return {"n": 0, "returned": 0, "empty": 0, "missed": 0, "delegated_trx": 0.0, "trx_hours": 0.0, "hold_s": 0.0,
+            "fee_trx": 0.0, "net_fee_trx": 0.0, "energy_fee_trx": 0.0, "confirm_n": 0, "confirm_sum_s": 0.0,
+            "confirm_max_s": 0.0}
+
+
+def _add_to_bucket(bucket: Dict, rec: Dict):
+    bucket["n"] += 1
+    bucket[rec["outcome"]] += 1
+    for key in ("delegated_trx", "trx_hours", "hold_s", "fee_trx", "net_fee_trx", "energy_fee_trx"):
+        bucket[key] += rec[key]
+    if rec["txs"]:
+        bucket["confirm_n"] += rec["txs"]
+        bucket["confirm_sum_s"] += rec["confirm_avg_s"] * rec["txs"]
+        bucket["confirm_max_s"] = max(bucket["confirm_max_s"], rec["confirm_max_s"])
+
+
+def _apply_to_rollups(rollups: Dict, rec: Dict):
+    closed = datetime.fromtimestamp(rec["closed"], tz=TZ_MOSCOW)
+    _add_to_bucket(rollups["hourly"].setdefault(closed.strftime("%Y-%m-%d %H"), _empty_bucket()), rec)
+    _add_to_bucket(rollups["daily"].setdefault(closed.strftime("%Y-%m-%d"), _empty_bucket()), rec)
+    _add_to_bucket(rollups["total"], rec)
+    # Ключи сортируются как время, старые вытесняем
+    for name, keep in (("hourly", LEDGER_HOURS_KEEP), ("daily", LEDGER_DAYS_KEEP)):
+        buckets = rollups[name]
+        for key in sorted(buckets)[:-keep]:
+            del buckets[key]
+
+
+def _ledger_size() -> int:
+    try:
+        return os.path.getsize(LEDGER_PATH)
+    except OSError:
+        return 0
+
+
+def _load_rollups() -> Dict:
+    """Суммы из ROLLUPS_PATH; если они не соответствуют журналу — пересчёт по журналу."""
+    try:
+        with open(ROLLUPS_PATH, "r", encoding="utf-8") as f:
+            rollups = json.load(f)
+        if rollups.get("ledger_bytes") == _ledger_size():
+            return rollups
+    except (FileNotFoundError, json.JSONDecodeError):
+        pass
+
+    rollups = {"ledger_bytes": 0, "hourly": {}, "daily": {}, "total": _empty_bucket()}
+    records = 0
+    try:
+        with open(LEDGER_PATH, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    _apply_to_rollups(rollups, json.loads(line))
+                    records += 1
+                except (json.JSONDecodeError, KeyError):
+                    continue  # оборванная последняя строка
+    except FileNotFoundError:
+        pass
+    rollups["ledger_bytes"] = _ledger_size()
+    logging.info(f"Сводки журнала кластеров пересчитаны: {records} записей")
+    _save_rollups(rollups)
+    return rollups
+
+
+def _save_rollups(rollups: Dict):
+    # Недописанный файл не страшен: при загрузке он не разберётся или не совпадёт ledger_bytes, и сводки пересчитаются
+    try:
+        write_file_in_place(ROLLUPS_PATH, json.dumps(rollups, separators=(",", ":")))
+    except OSError as e:
+        logging.error(f"❌ Ошибка: Не удалось сохранить сводки журнала: {e}")
+
+
+def _get_rollups() -> Dict:
+    global _rollups
+    if _rollups is None:
+        _rollups = _load_rollups()
+    return _rollups
+
+
+def record_cluster(c: Dict, outcome: str, undelegate_receipt=None):
+    """
+    Пишет закрытый кластер в журнал и обновляет суммы. outcome: returned — делегация возвращена,
+    empty — делегации к возврату не оказалось, missed — окно прошло, пока бот был недоступен.
+    """
+    receipts = {}
+    for t in c["tasks"]:
+        for r in t.get("tx_receipts", []):
+            receipts[r["txid"]] = r
+    if undelegate_receipt:
+        receipts[undelegate_receipt["txid"]] = undelegate_receipt
+    receipts = list(receipts.values())
+
+    now = chain_clock.now()
+    delegated_trx = max(t.get("delegated_trx", 0) for t in c["tasks"]) if outcome != "missed" else 0
+    delegate_ts = min((r["block_ts"] for r in receipts if r["kind"] == "delegate" and r.get("block_ts")), default=None)
+    if outcome == "returned" and delegate_ts and undelegate_receipt and undelegate_receipt.get("block_ts"):
+        # Длительность по меткам блоков — сколько энергия реально была спрятана
+        hold_s = (undelegate_receipt["block_ts"] - delegate_ts) / 1000
+    elif outcome == "missed":
+        hold_s = 0.0
+    else:
+        hold_s = max((now - c["start"]).total_seconds(), 0.0)
+    confirms = [r["confirm_s"] for r in receipts]
+
+    rec = {
+        "closed": round(now.timestamp(), 3),
+        "start": c["start"].isoformat(),
+        "end": c["end"].isoformat(),
+        "outcome": outcome,
+        "tasks": len(c["tasks"]),
+        "delegated_trx": delegated_trx,
+        "hold_s": round(hold_s, 1),
+        "trx_hours": round(delegated_trx * hold_s / 3600, 3),
+        "fee_trx": sum(r["fee_sun"] for r in receipts) / 1_000_000,
+        "net_fee_trx": sum(r["net_fee_sun"] for r in receipts) / 1_000_000,
+        "energy_fee_trx": sum(r["energy_fee_sun"] for r in receipts) / 1_000_000,
+        "net_usage": sum(r["net_usage"] for r in receipts),
+        "energy_usage": sum(r["energy_usage"] for r in receipts),
+        "txs": len(receipts),
+        "confirm_avg_s": round(sum(confirms) / len(confirms), 3) if confirms else 0.0,
+        "confirm_max_s": max(confirms, default=0.0),
+        "txids": [r["txid"] for r in receipts],
+    }
+    try:
+        with _ledger_lock:
+            rollups = _get_rollups()
+            with open(LEDGER_PATH, "a", encoding="utf-8") as f:
+                f.write(json.dumps(rec, ensure_ascii=False, separators=(",", ":")) + "\n")
+            _apply_to_rollups(rollups, rec)
+            rollups["ledger_bytes"] = _ledger_size()
+            _save_rollups(rollups)
+    except OSError as e:
+        log_error_crash(f"❌ Не удалось записать кластер в журнал: {e}")
+
+
+def _format_bucket(title: str, b: Dict) -> str:
+    if not b["n"]:
+        return f"*{title}:* кластеров не было"
+    confirm = (f"{b['confirm_sum_s'] / b['confirm_n']:.1f} / {b['confirm_max_s']:.1f} с"
+               if b["confirm_n"] else "нет данных")
+    return (
+        f"*{title}:* кластеров {b['n']} (возвращено {b['returned']}, пустых {b['empty']}, пропущено {b['missed']})\n"
+        f"  Спрятано: {b['delegated_trx']:,.0f} TRX, {b['trx_hours']:,.1f} TRX·ч, удержание {b['hold_s'] / 3600:,.1f} ч\n"
+        f"  Комиссии: {b['fee_trx']:,.2f} TRX (bandwidth {b['net_fee_trx']:,.2f}, energy {b['energy_fee_trx']:,.2f})\n"
+        f"  Подтверждение транзакций avg/max: {confirm}"
+    )
+
+
+@engine_command("stats_report")
+def stats_report() -> str:
+    with _ledger_lock:
+        rollups = _get_rollups()
+        now = chain_clock.now()
+        last_day = _empty_bucket()
+        for h in range(24):
+            bucket = rollups["hourly"].get((now - timedelta(hours=h)).strftime("%Y-%m-%d %H"))
+            if bucket:
+                for key, value in bucket.items():
+                    last_day[key] = max(last_day[key], value) if key == "confirm_max_s" else last_day[key] + value
+        last_week = _empty_bucket()
+        for d in range(7):
+            bucket = rollups["daily"].get((now - timedelta(days=d)).strftime("%Y-%m-%d"))
+            if bucket:
+                for key, value in bucket.items():
+                    last_week[key] = max(last_week[key], value) if key == "confirm_max_s" else last_week[key] + value
+        today = rollups["daily"].get(now.strftime("%Y-%m-%d"), _empty_bucket())
+        total = rollups["total"]
+        return (
+            "📒 *Статистика кластеров*\n\n"
+            + "\n\n".join((
+                _format_bucket("Сегодня", today),
+                _format_bucket("За 24 ч", last_day),
+                _format_bucket("За 7 дней", last_week),
+                _format_bucket("Всего", total),
+            ))
+            + "\n\nCSV всего журнала: /stats\\_csv"
+        )
+
+
+@engine_command("ledger_csv")
+def ledger_csv() -> str:
+    out = io.StringIO()
+    writer = csv.DictWriter(out, fieldnames=LEDGER_CSV_FIELDS, extrasaction="ignore")
+    writer.writeheader()
+    with _ledger_lock:
+        try:
+            with open(LEDGER_PATH, "r", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        rec = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue
+                    rec["closed"] = datetime.fromtimestamp(rec["closed"], tz=TZ_MOSCOW).isoformat()
+                    rec["txids"] = " ".join(rec.get("txids", []))
+                    writer.writerow(rec)
+        except FileNotFoundError:
+            pass
+    return out.getvalue()
+
+
+@bot.message_handler(commands=["stats"])
+@admin_only
+def show_stats(message):
+    bot.send_message(message.chat.id, engine_call("stats_report"), parse_mode='Markdown')
+
+
+@bot.message_handler(commands=["stats_csv"])
+@admin_only
+def export_stats_csv(message):
+    data = engine_call("ledger_csv")
+    name = f"cluster_ledger_{datetime.now(TZ_MOSCOW).strftime('%Y%m%d_%H%M')}.csv"
+    bot.send_document(message.chat.id, io.BytesIO(data.encode("utf-8")), visible_file_name=name,
+                      caption="📒 Журнал кластеров")
+#--------------------------------------------------------------------------------------------------------------------------------
+
+
+
+
+#---------------------------------------------------------------- Повтор операций ---------------------------------------------------
+# Шаг планировщика, который не прошёл (delegate, topup или undelegate кластера), ставится в очередь повторов
+# с экспоненциальной паузой и случайным разбросом (чтобы после сбоя ноды повторы не шли пачкой). Пока пауза не истекла,
+# проход по очереди этот шаг пропускает: не запрашивает объёмы и не шлёт транзакцию. Остальные кластеры при этом
+# обрабатываются как обычно. Когда время подошло, повторяется только этот шаг, вместе с запросом объёма. Поэтому
+# повтор после транзакции, которая не дождалась блока, но всё же прошла, не задвоит объём.
+# Срок повторов: для delegate/topup — конец кластера; для undelegate — RETRY_UNDELEGATE_DEADLINE_MINUTES, после чего
+# администраторам уходит тревога, а возврат дальше пробуется раз в RETRY_MAX_SECONDS (энергию нельзя оставить спрятанной).
+# Постоянная ошибка (отказ валидации, подпись) — сразу тревога по этому шагу, без частых повторов.
+# Про общий сбой (сеть, TronGrid) администраторы получают одно сообщение в начале и одно после первой успешной операции.
+class RetryQueue:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.ops = {}  # ключ шага → {"kind", "attempts", "last_error", "next_mono", "deadline_mono", "gave_up"}
+        self.outage = None  # {"started_mono", "failures"} — идёт общий сбой
+        self.pass_mono = 0.0  # начало последнего прохода планировщика (prune)
+
+    @staticmethod
+    def key(kind: str, c: Dict) -> Tuple[str, str]:
+        return kind, c["start"].isoformat()
+
+    def due(self, key) -> bool:
+        with self._lock:
+            op = self.ops.get(key)
+            return op is None or time.monotonic() >= op["next_mono"]
+
+    def next_due(self):
+        """
+        Ближайший момент повтора по time.monotonic() или None. Шаги, которые были должны уже к началу прошлого
+        прохода, но он их не тронул, не учитываются: иначе планировщик просыпался бы сразу и крутился вхолостую.
+        Их подберёт обычный тик.
+        """
+        with self._lock:
+            return min((op["next_mono"] for op in self.ops.values()
+                        if op["next_mono"] > self.pass_mono), default=None)
+
+    def prune(self, live_keys):
+        """
+        Начало прохода планировщика: забывает шаги кластеров, которых больше нет в плане (задачи удалены,
+        кластер склеился с другим или сдвинулось его начало после /set).
+        """
+        with self._lock:
+            self.pass_mono = time.monotonic()
+            for key in [k for k in self.ops if k not in live_keys]:
+                op = self.ops.pop(key)
+                logging.info(f"Повтор {op['kind']} [{key[1]}] снят: кластера больше нет в плане")
+
+    def failed(self, key, kind: str, error: Exception, deadline_mono: float, keep_probing: bool = False):
+        """
+        Учитывает неудачу шага и назначает следующий повтор. keep_probing — после срока или постоянной ошибки не
+        бросать шаг, а пробовать раз в RETRY_MAX_SECONDS.
+        """
+        now = time.monotonic()
+        transient = is_transient_tx_error(error)
+        with self._lock:
+            op = self.ops.setdefault(key, {"kind": kind, "attempts": 0, "deadline_mono": deadline_mono, "gave_up": False})
+            op["attempts"] += 1
+            op["last_error"] = str(error)
+            delay = min(RETRY_MAX_SECONDS, RETRY_BASE_SECONDS * 2 ** (op["attempts"] - 1))
+            op["next_mono"] = now + random.uniform(delay / 2, delay)
+
+            alert = None
+            if (not transient or now >= op["deadline_mono"]) and not op["gave_up"]:
+                op["gave_up"] = True
+                reason = "постоянная ошибка" if not transient else "срок повторов истёк"
+                alert = (f"❌ {kind} кластера [{key[1]}] не проходит ({reason}, попыток: {op['attempts']}):\n"
+                         f"`{op['last_error']}`")
+                if keep_probing:
+                    alert += f"\nПродолжаю пробовать раз в {RETRY_MAX_SECONDS:.0f} с; можно вернуть вручную кнопкой."
+            if op["gave_up"]:
+                op["next_mono"] = now + RETRY_MAX_SECONDS if keep_probing else float("inf")
+
+            started_outage = transient and self.outage is None
+            if transient:
+                if self.outage is None:
+                    self.outage = {"started_mono": now, "failures": 0}
+                self.outage["failures"] += 1
+
+        logging.error(f"❌ {kind} [{key[1]}], попытка {op['attempts']}: {error}")
+        if started_outage:
+            log_error_crash(f"⚠️ Транзакции не проходят ({kind}: `{error}`).\n"
+                            f"Повторяю с нарастающей паузой; следующее сообщение — когда заработает.")
+        if alert:
+            log_error_crash(alert)
+
+    def succeeded(self, key):
+        with self._lock:
+            self.ops.pop(key, None)
+            outage, self.outage = self.outage, None
+            if outage:
+                # Сеть вернулась — остальные ждущие шаги не досиживают паузу
+                for op in self.ops.values():
+                    if not op["gave_up"]:
+                        op["next_mono"] = time.monotonic()
+        if outage:
+            minutes = (time.monotonic() - outage["started_mono"]) / 60
+            log_work(f"✅ Транзакции снова проходят. Сбой длился {minutes:.1f} мин, неудачных попыток: {outage['failures']}.")
+            _scheduler_wake.set()
+
+    def forget(self, key):
+        """Кластер закрыт — повтор больше не нужен. Возвращает запись шага или None."""
+        with self._lock:
+            return self.ops.pop(key, None)
+
+    def summary(self):
+        with self._lock:
+            if not self.ops:
+                return None
+            now = time.monotonic()
+            waits = [op["next_mono"] - now for op in self.ops.values() if op["next_mono"] != float("inf")]
+            text = f"ждут повтора: {len(self.ops)}"
+            if waits:
+                text += f", ближайший через {max(min(waits), 0):.0f} с"
+            return text
+
+
+retry_queue = RetryQueue()
+#--------------------------------------------------------------------------------------------------------------------------------
 
 
 
 
 #---------------------------------------------------------------- Работа с очередью ----------------------------------------------------
+def process_scheduled_tasks():
+    """
+    Один проход по очереди: делегирует/догружает/возвращает кластеры, время которых наступило.
+    Возвращает ближайшую будущую границу кластера (начало или конец) или None, если ждать нечего.
+    Проход целиком (снимок задач → транзакции → команды state) идёт под блокировкой кошелька: его запускают и планировщик,
+    и реактивный режим, и второй проход не должен работать со снимком, взятым до чужих транзакций.
+    Изменения кластера уходят в state одной командой — одна запись файла на кластер.
+    """
+    with wallet_operation(main_wallet):
+        return _process_scheduled_tasks()
+
+
+def _process_scheduled_tasks():
+    now = chain_clock.now()
+#    log_work(f"[🕒 Текущее время: {now.strftime('%H:%M:%S')}]")
+    pending_tasks = [t for t in state.tasks if not t["executed"]]
+    if not pending_tasks:
+        retry_queue.prune(set())
+        _topup_checked.clear()
+        return None
+
+    # === 1. Группируем ВСЕ pending_tasks в кластеры ===
+    with trace_span("scheduler.plan_clusters"):
+        clusters, _ = plan_clusters(pending_tasks)
+    # Каждый кластер → {'start', 'end', 'tasks', 'delegated', 'returned'}
+    cluster_info = []
+    for cluster in clusters:
+        c_start = min(t["schedule_time"] for t in cluster)
+        c_end = max(t["return_time"] for t in cluster)
+        # Есть ли хоть одна делегированная и не возвращённая в кластере?
+        delegated_in_cluster = any(t["delegated"] and not t["returned"] for t in cluster)
+        returned_in_cluster = all(t["returned"] for t in cluster if t["delegated"])
+        cluster_info.append({
+            "tasks": cluster,
+            "start": c_start,
+            "end": c_end,
+            "delegated": delegated_in_cluster,
+            "returned": returned_in_cluster,
+            "ids": [t["id"] for t in cluster],
+        })
+    retry_queue.prune({RetryQueue.key(kind, c) for c in cluster_info for kind in ("delegate", "topup", "undelegate")})
+    live_starts = {c["start"] for c in cluster_info}
+    for start in [s for s in _topup_checked if s not in live_starts]:
+        del _topup_checked[start]  # кластер перепланирован или пропущен
+
+#    ### ➕ DEBUG LOG ➕
+#    log_work(f"[DEBUG] Найдено кластеров: {len(cluster_info)}")
+#    for i, c in enumerate(cluster_info, 1):
+#        status = "🟢 активен и неделегирован" if (c["start"] <= now < c["end"] and not c["delegated"]) else \
+#                 "🟠 активен, делегирован" if (c["start"] <= now < c["end"] and c["delegated"]) else \
+#                 "🔴 завершён, ждёт возврата" if (now >= c["end"] and c["delegated"] and not c["returned"]) else \
+#                 "⚪ ожидает"
+#        log_work(f"  К{i}: {c['start'].strftime('%H:%M')}–{c['end'].strftime('%H:%M')} | задач: {len(c['tasks'])} | {status}")
+#    ### ➕ /DEBUG LOG ➕
+
+
+    # === 2. Обрабатываем каждый кластер независимо ===
+    # Все операции с кошельком (расчёт объёма + транзакция) идут под блокировкой кошелька, которую держит
+    # process_scheduled_tasks на весь проход: ручные "Спрятать"/"Вернуть" не считают объём одновременно с планировщиком
+    for c in cluster_info:
+        # Сценарий: сейчас внутри кластера, но делегации нет → делегировать
+        if c["start"] <= now < c["end"] and not c["delegated"]:
+            # Шаг ждёт повтора после неудачи — до своего времени не трогаем
+            key = RetryQueue.key("delegate", c)
+            if not retry_queue.due(key):
+                continue
+            # Делегируем ВЕСЬ кластер
+            try:
+                trx_amount = query_max_delegatable_trx(main_wallet) // 1_000_000
+                txid = send_delegate_energy(main_wallet, stashing_target, trx_amount) if trx_amount > 0 else None
+            except Exception as e:
+                retry_queue.failed(key, "delegate", e, chain_clock.deadline(c["end"]))
+                continue
+            retry_queue.succeeded(key)
+
+            if txid:
+                txid_link = f"https://tronscan.org/#/transaction/{txid}"
+                log_work(
+                    f"\n✅ Делегирование кластера\n\n"
+                    f"Начало: {c['start']}\n"
+                    f"Конец:  {c['end']}\n\n"
+                    f"Задач: {len(c['tasks'])}\n\n"
+                    f"Делегировано: {trx_amount:,.2f} TRX\n\n"
+                    f"[TXID]({txid_link})"
+                )
+                receipt = take_tx_receipt(txid, "delegate")
+
+                def mark_delegated(t):
+                    t.update(delegated=True, txid_delegate=txid, delegated_trx=trx_amount)
+                    if receipt:
+                        t["tx_receipts"].append(receipt)
+                scheduler_update_tasks(c["ids"], mark_delegated)
+                _topup_checked[c["start"]] = now
+            else:
+                log_work(f"⚠️ Делегировать нечего для кластера [{c['start']}–{c['end']}]")
+                scheduler_update_tasks(c["ids"], lambda t: t.update(delegated=True))
+
+        # Сценарий: кластер активен и уже делегирован → докидываем освободившийся TRX
+        elif c["start"] <= now < c["end"] and c["delegated"]:
+            topup_cluster(c, now)
+
+        # Сценарий: время кластера истекло, но делегация есть и не возвращена → анделегировать
+        elif now >= c["end"] and c["delegated"] and not c["returned"]:
+            key = RetryQueue.key("undelegate", c)
+            if not retry_queue.due(key):
+                continue
+            try:
+                # Индексатор TronScan может отставать от только что прошедшей догрузки — возвращаем не меньше учтённого
+                indexed_trx = get_delegation_balance(main_wallet, stashing_target) // 1_000_000
+                tracked_trx = max((t["delegated_trx"] for t in c["tasks"] if t["delegated"] and not t["returned"]), default=0)
+                amount_in_trx = max(indexed_trx, tracked_trx)
+                try:
+                    txid = send_undelegate_energy(main_wallet, stashing_target, amount_in_trx) if amount_in_trx > 0 else None
+                except TxError as e:
+                    if e.transient or amount_in_trx <= indexed_trx:
+                        raise
+                    # Сеть отказала в учтённом объёме: он устарел (например, часть вернули кнопкой) — берём объём индексатора
+                    logging.warning(f"Возврат {amount_in_trx} TRX отклонён ({e}), возвращаю по индексатору: {indexed_trx} TRX")
+                    amount_in_trx = indexed_trx
+                    txid = send_undelegate_energy(main_wallet, stashing_target, amount_in_trx) if amount_in_trx > 0 else None
+            except Exception as e:
+                # Задачи остаются невозвращёнными: возврат повторится, а не потеряется
+                retry_queue.failed(key, "undelegate", e, time.monotonic() + RETRY_UNDELEGATE_DEADLINE_MINUTES * 60,
+                                   keep_probing=True)
+                continue
+            retry_queue.succeeded(key)
+
+            if txid:
+                txid_link = f"https://tronscan.org/#/transaction/{txid}"
+                log_work(
+                    f"\n✅ Анделегирование кластера\n\n"
+                    f"Начало: {c['start']}\n"
+                    f"Конец:  {c['end']}\n\n"
+                    f"Задач: {len(c['tasks'])}\n\n"
+                    f"Анделегировано: {amount_in_trx:,.2f} TRX\n\n"
+                    f"[TXID]({txid_link})"
+                )
+            else:
+                log_work(f"⚠️ Делегация отсутствует для кластера [{c['start']}–{c['end']}]")
+            _topup_checked.pop(c["start"], None)
+            retry_queue.forget(RetryQueue.key("topup", c))
+
+            # Помечаем ВСЕ задачи кластера возвращёнными и выполненными
+            scheduler_update_tasks(c["ids"], lambda t: t.update(returned=True, txid_return=txid, executed=True))
+            # В журнал — только после записи задач: при падении между ними кластер не попадёт в журнал дважды
+            if txid:
+                record_cluster(c, "returned", take_tx_receipt(txid, "undelegate"))
+            else:
+                record_cluster(c, "empty")
+
+        # Сценарий: окно кластера прошло целиком, а делегации так и не было (бот лежал) → закрываем как пропущенный
+        elif now >= c["end"] and not c["delegated"]:
+            failed = retry_queue.forget(RetryQueue.key("delegate", c))
+            reason = f"делегирование не прошло: `{failed['last_error']}`" if failed else "бот был недоступен"
+            log_work(f"⚠️ Кластер пропущен ({reason}): [{c['start']}–{c['end']}], задач: {len(c['tasks'])}")
+            scheduler_update_tasks(c["ids"], lambda t: t.update(executed=True))
+            record_cluster(c, "missed")
+
+    boundaries = [b for c in cluster_info for b in (c["start"], c["end"]) if b > now]
+    return min(boundaries, default=None)
+
+
+SCHEDULER_TICK_SECONDS = 30
+_scheduler_wake = threading.Event()  # будит планировщик раньше тика (например, после смены настроек)
+
+
 def scheduler_worker():
-    global MONITORING_ENABLED
+    while True:
+        try:
+            with trace_span("tick"):
+                if state.settings["monitoring_enabled"]:
+                    if _backfill_cursor_ms is not None:
+                        with trace_span("tick.backfill"):
+                            backfill_incoming_delegations()
+                    with trace_span("tick.check_incoming_delegations"):
+                        check_incoming_delegations()
+
+                with trace_span("tick.process_scheduled_tasks"):
+                    next_boundary = process_scheduled_tasks()
+
+        except Exception as e:
+            log_error_crash(f"❌ Ошибка в scheduler_worker: {e}")
+            next_boundary = None
+
+        # Спим до ближайшей границы кластера, но не дольше обычного тика. Дедлайн — по time.monotonic(),
+        # поэтому перевод системных часов не сдвигает делегацию
+        deadline = time.monotonic() + SCHEDULER_TICK_SECONDS
+        if next_boundary is not None:
+            deadline = min(deadline, chain_clock.deadline(next_boundary))
+        retry_at = retry_queue.next_due()
+        if retry_at is not None:
+            deadline = min(deadline, retry_at)
+        _scheduler_wake.wait(max(deadline - time.monotonic(), 0.0))
+        _scheduler_wake.clear()
+#--------------------------------------------------------------------------------------------------------------------------------
+
 
+
+#------------------------------------------------ Настройки на лету ------------------------------------------------------------------
+# Параметры Tunables меняются без перезапуска: командой /set ИМЯ ЗНАЧЕНИЕ или правкой TUNABLES_PATH
+# ({"SLICE_MINUTES": 10}). В файле лежат только переопределения, остальное берётся из .env; /set пишет в тот же файл,
+# поэтому значение переживает рестарт. Новый набор сначала целиком проверяется и только потом подменяет TUNABLES;
+# при ошибке остаются прежние значения. После подмены очередь сразу перепланируется: ClusterPlanner пересчитывает
+# только блоки после первого изменившегося решения о склейке, уже делегированные кластеры не разрезаются.
+# Транзакции по новому плану отправляет поток планировщика (его будит _scheduler_wake), а не команда /set.
+# TIME_BUY_ENERGY и AUTO_HOLD_MINUTES действуют на входящие делегации, найденные после изменения.
+TUNABLES_POLL_SECONDS = 5
+
+_tunables_lock = threading.Lock()
+_tunables_mtime = None  # mtime файла, который уже применён (или отвергнут)
+
+
+def read_tunables_file() -> Tuple[Dict, List[str]]:
+    """Переопределения из TUNABLES_PATH и ошибки чтения. Пустой или отсутствующий файл — переопределений нет."""
+    try:
+        with open(TUNABLES_PATH, "r", encoding="utf-8") as f:
+            text = f.read()
+    except FileNotFoundError:
+        return {}, []
+    if not text.strip():
+        return {}, []
+    try:
+        overrides = json.loads(text)
+    except json.JSONDecodeError as e:
+        return {}, [f"{TUNABLES_PATH}: некорректный JSON ({e})"]
+    if not isinstance(overrides, dict):
+        return {}, [f"{TUNABLES_PATH}: ожидается объект {{\"ИМЯ\": значение}}"]
+    return overrides, []
+
+
+def build_tunables(overrides: Dict) -> Tuple[Tunables, List[str]]:
+    """Значения из .env с наложенными переопределениями и список ошибок проверки."""
+    values = ENV_TUNABLES._asdict()
+    errors = []
+    for name, value in overrides.items():
+        if name not in Tunables._fields:
+            errors.append(f"{name}: на лету меняются только {', '.join(Tunables._fields)}")
+            continue
+        try:
+            if isinstance(value, bool):
+                raise ValueError
+            values[name] = int(str(value).strip())
+        except ValueError:
+            errors.append(f"{name}: ожидается целое число, получено {value!r}")
+    errors += _tunables_errors(values)
+    return Tunables(**values), errors
+
+
+def apply_tunables(new: Tunables, source: str):
+    """
+    Подменяет TUNABLES и сразу пересчитывает план кластеров. Вызывать под _tunables_lock.
+    Транзакции здесь не отправляются: их по новому плану делает поток планировщика, которого будит _scheduler_wake.
+    """
+    global TUNABLES
+    old = TUNABLES
+    changes = [f"`{name}`: {getattr(old, name)} → {getattr(new, name)}"
+               for name in Tunables._fields if getattr(old, name) != getattr(new, name)]
+    if not changes:
+        return
+    TUNABLES = new
+
+    started = time.monotonic()
+    try:
+        pending = [t for t in state.tasks if not t["executed"]]
+        clusters, _ = plan_clusters(pending) if pending else ([], [])
+        replan = (f"План пересчитан за {time.monotonic() - started:.2f} с: кластеров {len(clusters)} "
+                  f"(из прошлого расчёта взято блоков: {cluster_planner.last_reused}).")
+    except Exception as e:
+        replan = f"⚠️ Перепланирование не удалось, повторится на следующем тике: {e}"
+    _scheduler_wake.set()  # планировщик заново выберет, когда просыпаться
+    log_work(f"⚙️ Настройки изменены ({source}):\n" + "\n".join(changes) + "\n\n" + replan)
+
+
+def reload_tunables(source: str = "файл", startup: bool = False) -> List[str]:
+    """
+    Перечитывает TUNABLES_PATH и применяет, если файл изменился. Возвращает ошибки (пусто — успех).
+    startup — при старте движка: только подменить значения, очередь ещё не обработана и перепланируется сама.
+    """
+    global _tunables_mtime, TUNABLES
+    with _tunables_lock:
+        try:
+            mtime = os.stat(TUNABLES_PATH).st_mtime_ns
+        except FileNotFoundError:
+            mtime = None
+        if mtime == _tunables_mtime:
+            return []
+        _tunables_mtime = mtime
+
+        overrides, errors = read_tunables_file()
+        new, more_errors = build_tunables(overrides)
+        errors += more_errors
+        if errors:
+            log_error_crash("❌ Настройки из файла не применены, действуют прежние:\n" + "\n".join(f"`{e}`" for e in errors))
+            return errors
+        if startup:
+            TUNABLES = new
+            if new != ENV_TUNABLES:
+                logging.info(f"⚙️ Настройки из {TUNABLES_PATH}: {new._asdict()}")
+        else:
+            apply_tunables(new, source)
+        return []
+
+
+def tunables_worker():
     while True:
+        time.sleep(TUNABLES_POLL_SECONDS)
         try:
-            if MONITORING_ENABLED:
-                check_incoming_delegations()
+            reload_tunables()
+        except Exception as e:
+            log_error_crash(f"❌ Ошибка в tunables_worker: {e}")
+
+
+@engine_command("tunables_report")
+def tunables_report() -> str:
+    overrides, _ = read_tunables_file()
+    lines = ["⚙️ *Настройки, меняющиеся на лету*\n"]
+    for name in Tunables._fields:
+        origin = "файл" if name in overrides else ".env"
+        lines.append(f"`{name}` = {getattr(TUNABLES, name)} ({origin})")
+    lines.append("\nИзменить: `/set ИМЯ ЗНАЧЕНИЕ`, вернуть значение из .env: `/set ИМЯ -`")
+    return "\n".join(lines)
+
+
+@engine_command("set_tunable")
+def set_tunable(name: str, value: str) -> str:
+    global _tunables_mtime
+    with _tunables_lock:
+        overrides, errors = read_tunables_file()
+        if errors:
+            return f"❌ `{errors[0]}`"
+        overrides = dict(overrides)
+        if value == "-":
+            overrides.pop(name, None)
+        else:
+            overrides[name] = value
+        new, errors = build_tunables(overrides)
+        if errors:
+            return "❌ Не применено:\n" + "\n".join(f"`{e}`" for e in errors)
 
-            now = datetime.now(TZ_MOSCOW)
-#            log_work(f"[🕒 Текущее время: {now.strftime('%H:%M:%S')}]")
-            tasks = load_scheduled_tasks()
-            updated = False
+        overrides = {k: getattr(new, k) for k in overrides}
+        try:
+            # На месте, а не через os.replace: tunables.json смонтирован файлом. tunables_worker ждёт _tunables_lock
+            # и недописанный файл не прочитает
+            write_file_in_place(TUNABLES_PATH, json.dumps(overrides, indent=2))
+            _tunables_mtime = os.stat(TUNABLES_PATH).st_mtime_ns
+        except OSError as e:
+            return f"❌ Не удалось сохранить {TUNABLES_PATH}: {e}"
+        apply_tunables(new, "/set")
+    return f"✅ `{name}` = {getattr(new, name)}"
 
-            pending_tasks = [t for t in tasks if not t["executed"]]
-            if not pending_tasks:
-                time.sleep(30)
-                continue
 
-            # === 1. Группируем ВСЕ pending_tasks в кластеры ===
-            clusters = group_tasks_into_clusters(pending_tasks, max_gap_minutes=SLICE_MINUTES)
-            # Каждый кластер → {'start', 'end', 'tasks', 'delegated', 'returned'}
-            cluster_info = []
-            for cluster in clusters:
-                c_start = min(t["schedule_time"] for t in cluster)
-                c_end = max(t["return_time"] for t in cluster)
-                # Есть ли хоть одна делегированная и не возвращённая в кластере?
-                delegated_in_cluster = any(t["delegated"] and not t["returned"] for t in cluster)
-                returned_in_cluster = all(t["returned"] for t in cluster if t["delegated"])
-                cluster_info.append({
-                    "tasks": cluster,
-                    "start": c_start,
-                    "end": c_end,
-                    "delegated": delegated_in_cluster,
-                    "returned": returned_in_cluster,
-                })
-
-#            ### ➕ DEBUG LOG ➕
-#            log_work(f"[DEBUG] Найдено кластеров: {len(cluster_info)}")
-#            for i, c in enumerate(cluster_info, 1):
-#                status = "🟢 активен и неделегирован" if (c["start"] <= now < c["end"] and not c["delegated"]) else \
-#                         "🟠 активен, делегирован" if (c["start"] <= now < c["end"] and c["delegated"]) else \
-#                         "🔴 завершён, ждёт возврата" if (now >= c["end"] and c["delegated"] and not c["returned"]) else \
-#                         "⚪ ожидает"
-#                log_work(f"  К{i}: {c['start'].strftime('%H:%M')}–{c['end'].strftime('%H:%M')} | задач: {len(c['tasks'])} | {status}")
-#            ### ➕ /DEBUG LOG ➕
-
-
-            # === 2. Обрабатываем каждый кластер независимо ===
-            for c in cluster_info:
-                # Сценарий: сейчас внутри кластера, но делегации нет → делегировать
-                if c["start"] <= now < c["end"] and not c["delegated"]:
-                    # Делегируем ВЕСЬ кластер
-                    trx_sun = get_max_delegatable_trx(main_wallet)
-                    trx_amount = trx_sun // 1_000_000
-
-                    if trx_amount > 0:
-                        txid, ok = create_delegate_energy_txid(main_wallet, stashing_target, trx_amount)
-                        if ok:
-                            txid_link = f"https://tronscan.org/#/transaction/{txid}"
-                            log_work(
-                                f"\n✅ Делегирование кластера\n\n"
-                                f"Начало: {c['start']}\n"
-                                f"Конец:  {c['end']}\n\n"
-                                f"Задач: {len(c['tasks'])}\n\n"
-                                f"Делегировано: {trx_amount:,.2f} TRX\n\n"
-                                f"[TXID]({txid_link})"
-                            )
-                            for t in c["tasks"]:
-                                t["delegated"] = True
-                                t["txid_delegate"] = txid
-                            updated = True
-                        else:
-                            log_error_crash("❌ Не удалось создать TX делегирования.")
-                    else:
-                        log_work(f"⚠️ Делегировать нечего для кластера [{c['start']}–{c['end']}]")
-                        for t in c["tasks"]:
-                            t["delegated"] = True
-                        updated = True
-
-                # Сценарий: время кластера истекло, но делегация есть и не возвращена → анделегировать
-                elif now >= c["end"] and c["delegated"] and not c["returned"]:
-                    try:
-                        url = f"https://apilist.tronscanapi.com/api/account/resourcev2?address={main_wallet}&type=2&resourceType=2"
-                        headers = {"TRON-PRO-API-KEY": api_key_tronscan}
-                        data = requests.get(url, headers=headers, timeout=10).json()
-
-                        amount_in_trx = 0
-                        for d in data.get("data", []):
-                            if d.get("receiverAddress") == stashing_target:
-                                amount_in_trx = d.get("balance", 0) // 1_000_000
-
-                        if amount_in_trx > 0:
-                            txid, ok = create_undelegate_energy_txid(main_wallet, stashing_target, amount_in_trx)
-                            if ok:
-                                txid_link = f"https://tronscan.org/#/transaction/{txid}"
-                                log_work(
-                                    f"\n✅ Анделегирование кластера\n\n"
-                                    f"Начало: {c['start']}\n"
-                                    f"Конец:  {c['end']}\n\n"
-                                    f"Задач: {len(c['tasks'])}\n\n"
-                                    f"Анделегировано: {amount_in_trx:,.2f} TRX\n\n"
-                                    f"[TXID]({txid_link})"
-                                )
-                                for t in c["tasks"]:
-                                    t["returned"] = True
-                                    t["txid_return"] = txid
-                            else:
-                                log_error_crash("❌ Ошибка анделегирования.")
-                        else:
-                            log_work(f"⚠️ Делегация отсутствует для кластера [{c['start']}–{c['end']}]")
-                            for t in c["tasks"]:
-                                t["returned"] = True
-
-                        # Помечаем ВСЕ задачи кластера как выполненные
-                        for t in c["tasks"]:
-                            t["executed"] = True
-                        updated = True
+@bot.message_handler(commands=["set"])
+@admin_only
+def set_tunable_command(message):
+    parts = message.text.split()
+    if len(parts) != 3:
+        bot.send_message(message.chat.id, engine_call("tunables_report"), parse_mode='Markdown')
+        return
+    bot.send_message(message.chat.id, engine_call("set_tunable", name=parts[1].upper(), value=parts[2]),
+                     parse_mode='Markdown')
+#--------------------------------------------------------------------------------------------------------------------------------
 
-                    except Exception as e:
-                        log_error_crash(f"❌ Ошибка анделегирования кластера: {e}")
 
-            # === 3. Сохраняем изменения ===
-            if updated:
-                save_scheduled_tasks(tasks)
 
+#------------------------------------------------ Реактивный режим ------------------------------------------------------------------
+# Автозапуск не по входящей делегации с фиксированной задержкой, а по самому уровню энергии MAIN_WALLET.
+# Поток опрашивает get_energy_info тем чаще, чем ближе значение к порогу. Когда свободная энергия или unused_slot
+# доходит до порога, ставит задачу «с этого момента» (не дольше REACTIVE_MAX_HOLD_MINUTES) и сразу прогоняет очередь:
+# кластеризация и транзакции те же, что у обычных задач. Когда EnergyUsed перестаёт расти (за REACTIVE_SETTLE_MINUTES
+# вырос меньше REACTIVE_SETTLE_ENERGY), время возврата задачи переносится на «сейчас».
+# Гистерезис: после срабатывания следующий запуск возможен, только когда значение опустилось ниже
+# порога × (1 − REACTIVE_HYSTERESIS), иначе после возврата энергия снова над порогом и режим бы «дребезжал».
+REACTIVE_SOURCE_PREFIX = "reactive:"  # txid_delegate_source реактивных задач (по нему задача находится после рестарта)
+
+
+class ReactiveStasher:
+    def __init__(self):
+        self.armed = True
+        self.task_source = None  # txid_delegate_source активной реактивной задачи
+        self.usage = collections.deque()  # (monotonic, EnergyUsed) за окно успокоения
+        self.last_sample_mono = None
+        self.reactions = collections.deque(maxlen=50)  # секунды от обнаружения порога до отправки транзакции
+        self.failures = 0  # неудачных опросов подряд (сбой API)
+
+    def resume(self):
+        """После рестарта подхватывает незавершённую реактивную задачу из файла."""
+        for t in state.tasks:
+            source = t.get("txid_delegate_source") or ""
+            if source.startswith(REACTIVE_SOURCE_PREFIX) and not t["executed"]:
+                self.task_source = source
+                self.armed = False
+
+    def threshold_ratio(self, free_energy, unused_slot) -> float:
+        """Какую долю порога достигло значение (по ближайшему к срабатыванию из заданных порогов)."""
+        ratios = []
+        if REACTIVE_FREE_ENERGY_HIGH > 0:
+            ratios.append(free_energy / REACTIVE_FREE_ENERGY_HIGH)
+        if REACTIVE_UNUSED_SLOT_HIGH > 0:
+            ratios.append(unused_slot / REACTIVE_UNUSED_SLOT_HIGH)
+        return max(ratios)
+
+    def next_interval(self, ratio: float) -> float:
+        if self.task_source is not None:
+            # Ждём успокоения расхода: хотя бы 4 сэмпла на окно
+            return min(REACTIVE_MAX_POLL_SECONDS, REACTIVE_SETTLE_MINUTES * 60 / 4)
+        closeness = min(max(ratio, 0.0), 1.0)
+        return REACTIVE_MAX_POLL_SECONDS - (REACTIVE_MAX_POLL_SECONDS - REACTIVE_MIN_POLL_SECONDS) * closeness
+
+    def step(self) -> float:
+        """Один опрос. Возвращает, через сколько секунд опрашивать снова."""
+        try:
+            free_energy, _, unused_slot, all_energy, energy_used, _ = query_energy_info(main_wallet)
         except Exception as e:
-            log_error_crash(f"❌ Ошибка в scheduler_worker: {e}")
+            # Сбой API: сообщаем один раз за сбой и опрашиваем всё реже (удвоение от MIN до MAX)
+            self.failures += 1
+            if self.failures == 1:
+                log_error_crash(f"❌ Реактивный режим: не удалось получить энергию {main_wallet}: {e}")
+            return min(REACTIVE_MAX_POLL_SECONDS, REACTIVE_MIN_POLL_SECONDS * 2 ** self.failures)
+        if self.failures:
+            logging.info(f"Реактивный режим: опрос энергии восстановлен после {self.failures} неудач")
+            self.failures = 0
+        if all_energy == 0:
+            # Пустой ответ — не принимаем его за падение ниже порога
+            return REACTIVE_MIN_POLL_SECONDS
+        now_mono = time.monotonic()
+        prev_mono, self.last_sample_mono = self.last_sample_mono, now_mono
+        ratio = self.threshold_ratio(free_energy, unused_slot)
+
+        if self.task_source is not None:
+            self._watch_usage(now_mono, energy_used)
+        elif ratio < 1.0 - REACTIVE_HYSTERESIS:
+            self.armed = True
+        elif ratio >= 1.0 and self.armed and state.settings["monitoring_enabled"]:
+            self._start(free_energy, unused_slot, energy_used, now_mono, prev_mono)
+        return self.next_interval(ratio)
+
+    def _find_task(self, tasks):
+        for t in tasks:
+            if t.get("txid_delegate_source") == self.task_source and not t["executed"]:
+                return t
+        return None
+
+    def _start(self, free_energy, unused_slot, energy_used, detected_mono, prev_mono):
+        now = chain_clock.now()
+        self.task_source = f"{REACTIVE_SOURCE_PREFIX}{int(now.timestamp())}"
+        self.armed = False
+        self.usage.clear()
+        self.usage.append((detected_mono, energy_used))
+
+        scheduler_add_tasks([new_task(now, now + timedelta(minutes=REACTIVE_MAX_HOLD_MINUTES), self.task_source)])
+        with trace_span("reactive.reaction"):
+            process_scheduled_tasks()
+        reaction = time.monotonic() - detected_mono
+
+        task = self._find_task(state.tasks)
+        if task is not None and task.get("txid_delegate"):
+            self.reactions.append(reaction)
+            result = f"Реакция: {reaction:.2f} с от обнаружения до отправки транзакции"
+        else:
+            result = "Транзакция не отправлена (кластер уже делегирован или делегировать нечего)"
+        window = f", порог пройден за последние {detected_mono - prev_mono:.0f} с" if prev_mono is not None else ""
+        log_work(
+            f"⚡ Реактивное скрытие\n\n"
+            f"Свободная энергия: {free_energy:,.0f}, unused_slot: {unused_slot:,.0f}\n"
+            f"{result}{window}"
+        )
+
+    def _watch_usage(self, now_mono, energy_used):
+        task = self._find_task(state.tasks)
+        if task is None:
+            # Задачу удалили вручную или она закрылась по REACTIVE_MAX_HOLD_MINUTES
+            self.task_source = None
+            return
+
+        window = REACTIVE_SETTLE_MINUTES * 60
+        self.usage.append((now_mono, energy_used))
+        # Оставляем ровно один сэмпл старше окна — от него считаем рост
+        while len(self.usage) > 1 and self.usage[1][0] <= now_mono - window:
+            self.usage.popleft()
+        if now_mono - self.usage[0][0] < window:
+            return
+        growth = max(e for _, e in self.usage) - self.usage[0][1]
+        if growth >= REACTIVE_SETTLE_ENERGY:
+            return
+
+        now = chain_clock.now()
+        if task["return_time"] > now:
+            scheduler_update_tasks([task["id"]], lambda t: t.update(return_time=now))
+        self.task_source = None
+        log_work(f"⚡ Расход энергии успокоился (+{growth:,.0f} за {REACTIVE_SETTLE_MINUTES:g} мин), возвращаю реактивное скрытие.")
+        process_scheduled_tasks()
+
+    def summary(self) -> str:
+        if self.task_source is not None:
+            phase = "скрыто, жду успокоения расхода"
+        else:
+            phase = "ждёт порога" if self.armed else "ждёт падения ниже порога (гистерезис)"
+        if self.reactions:
+            ordered = sorted(self.reactions)
+            reactions = f", реакция p50 {ordered[len(ordered) // 2]:.2f} с, max {ordered[-1]:.2f} с (n={len(ordered)})"
+        else:
+            reactions = ""
+        return f"Реактивный режим: {phase}{reactions}"
+
+
+reactive_stasher = ReactiveStasher()
 
-        time.sleep(30)
+
+def reactive_worker():
+    reactive_stasher.resume()
+    while True:
+        try:
+            interval = reactive_stasher.step()
+        except Exception as e:
+            log_error_crash(f"❌ Ошибка в reactive_worker: {e}")
+            interval = REACTIVE_MAX_POLL_SECONDS
+        time.sleep(interval)
 #--------------------------------------------------------------------------------------------------------------------------------
 
 
 
-#------------------------------------ загрузка ------------------------------------------------------------------------------------
-load_settings() # загружаем кнопку настроек слежения
-scheduler_thread = threading.Thread(target=scheduler_worker, daemon=True)
-scheduler_thread.start()
+
+#------------------------------------------------ Снимок статуса ------------------------------------------------------------------
+# Фоновый поток держит в памяти готовый снимок состояния (энергия, max_size, делегация, ближайший кластер,
+# последняя транзакция). /status отвечает из него мгновенно, без запросов к API.
+# Снимок — неизменяемый словарь, который целиком подменяется новой ссылкой, поэтому читатель всегда видит согласованные данные.
+_status_snapshot = None
+_status_refresh_event = threading.Event()
+_last_tx = None
+
+
+def record_last_tx(kind: str, txid: str, amount_trx: float):
+    """Запоминает последнюю транзакцию и просит немедленно обновить снимок."""
+    global _last_tx
+    _last_tx = {"kind": kind, "txid": txid, "amount_trx": amount_trx, "time": datetime.now(TZ_MOSCOW)}
+    request_status_refresh()
+
+
+def request_status_refresh():
+    _status_refresh_event.set()
+
+
+_STATUS_CHAIN_FIELDS = ("free_energy", "energy_used", "all_energy", "unused_slot", "max_delegatable_trx", "delegated_trx")
+_status_api_error = None  # ошибка API, пока данные сети не обновляются (тревога — одна на сбой)
+
+
+def query_chain_status() -> Dict:
+    """Данные сети для /status. При ошибке API — исключение."""
+    free_energy_ac, _, unused_slot, all_energy, energy_used, _ = query_energy_info(main_wallet)
+    return {
+        "free_energy": free_energy_ac,
+        "energy_used": energy_used,
+        "all_energy": all_energy,
+        "unused_slot": unused_slot,
+        "max_delegatable_trx": query_max_delegatable_trx(main_wallet) / 1_000_000,
+        "delegated_trx": get_delegation_balance(main_wallet, stashing_target) / 1_000_000,
+        "chain_mono": time.monotonic(),
+    }
+
+
+def build_status_snapshot() -> Dict:
+    global _status_api_error
+    previous = _status_snapshot
+    try:
+        chain = query_chain_status()
+        if _status_api_error is not None:
+            logging.info("Снимок статуса: данные сети снова обновляются")
+        _status_api_error = None
+    except Exception as e:
+        # Сбой API: оставляем последние удачные значения (format_status покажет их возраст), тревога — одна на сбой
+        if _status_api_error is None:
+            log_error_crash(f"⚠️ Снимок статуса: данные сети не обновляются, показываю последние удачные: {e}")
+        _status_api_error = str(e)
+        if previous is not None and previous["chain_mono"] is not None:
+            chain = {name: previous[name] for name in _STATUS_CHAIN_FIELDS + ("chain_mono",)}
+        else:
+            chain = dict.fromkeys(_STATUS_CHAIN_FIELDS + ("chain_mono",))
+
+    now = chain_clock.now()
+    pending = [t for t in state.tasks if not t.get("executed")]
+    clusters, costs = plan_clusters(pending)
+    next_cluster = None
+    for cluster, cost in zip(clusters, costs):
+        c_end = max(t["return_time"] for t in cluster)
+        if c_end > now:
+            next_cluster = {
+                "start": min(t["schedule_time"] for t in cluster),
+                "end": c_end,
+                "tasks": len(cluster),
+                "cost": cost,
+            }
+            break
+
+    return dict(
+        chain,
+        updated=now,
+        updated_mono=time.monotonic(),
+        chain_error=_status_api_error,
+        next_cluster=next_cluster,
+        pending_tasks=len(pending),
+        last_tx=_last_tx,
+    )
+
+
+def status_worker():
+    global _status_snapshot
+    while True:
+        _status_refresh_event.clear()
+        try:
+            with trace_span("status.refresh"):
+                _status_snapshot = build_status_snapshot()
+        except Exception as e:
+            log_error_crash(f"❌ Ошибка обновления статуса: {e}")
+        _status_refresh_event.wait(STATUS_REFRESH_SECONDS)
+
+
+def format_status(snapshot: Dict) -> str:
+    age = time.monotonic() - snapshot["updated_mono"]
+    if snapshot["chain_mono"] is None:
+        return (f"📊 *Статус*\n\n⚠️ Данные сети ещё не получены: `{snapshot['chain_error']}`\n\n"
+                f"Активных задач: {snapshot['pending_tasks']}")
+    delegated_str = f"{snapshot['delegated_trx']:,.0f} TRX"
+    if snapshot["chain_error"]:
+        chain_age = time.monotonic() - snapshot["chain_mono"]
+        stale_str = (f"⚠️ Данные сети устарели: получены {chain_age:.0f} с назад, "
+                     f"API недоступно: `{snapshot['chain_error']}`\n\n")
+    else:
+        stale_str = ""
+
+    nc = snapshot["next_cluster"]
+    if nc:
+        cluster_str = (
+            f"{nc['start'].strftime('%m-%d %H:%M')}–{nc['end'].strftime('%H:%M')}, "
+            f"задач: {nc['tasks']}, ≈{nc['cost']:,.2f} TRX"
+        )
+    else:
+        cluster_str = "нет"
+
+    tx = snapshot["last_tx"]
+    if tx:
+        kind = "делегирование" if tx["kind"] == "delegate" else "возврат"
+        tx_str = (
+            f"{kind} {tx['amount_trx']:,.0f} TRX в {tx['time'].strftime('%m-%d %H:%M:%S')}\n"
+            f"[TXID](https://tronscan.org/#/transaction/{tx['txid']})"
+        )
+    else:
+        tx_str = "нет (с момента запуска)"
+    retries = retry_queue.summary()
+    if retries:
+        tx_str += f"\nПовторы: {retries}"
+
+    skew = chain_clock.skew()
+    if skew is None:
+        clock_str = "по локальным часам (нет синхронизации с сетью)"
+    else:
+        clock_str = f"расхождение с сетью {skew:+.1f} с (сверка {time.monotonic() - chain_clock.synced_mono:.0f} с назад)"
+
+    return (
+        f"📊 *Статус* (данные {age:.0f} с назад)\n\n"
+        f"{stale_str}"
+        f"Свободная энергия: {snapshot['free_energy']:,.0f} / {snapshot['all_energy']:,.0f}\n"
+        f"Израсходовано: {snapshot['energy_used']:,.0f}\n"
+        f"Можно спрятать: {snapshot['max_delegatable_trx']:,.0f} TRX\n"
+        f"Спрятано на Тайнике: {delegated_str}\n\n"
+        f"Активных задач: {snapshot['pending_tasks']}\n"
+        f"Ближайший кластер: {cluster_str}\n\n"
+        f"Последняя транзакция: {tx_str}\n\n"
+        f"Часы: {clock_str}"
+    )
+
+
+@engine_command("status_report")
+def status_report():
+    """Готовый текст /status или None, если первый снимок ещё собирается."""
+    snapshot = _status_snapshot
+    return None if snapshot is None else format_status(snapshot)
+
+
+@bot.message_handler(commands=["status"])
+@admin_only
+def show_status(message):
+    text = engine_call("status_report")
+    if text is None:
+        bot.send_message(message.chat.id, "⏳ Статус ещё собирается, попробуйте через несколько секунд.")
+        return
+    bot.send_message(message.chat.id, text, parse_mode='Markdown', disable_web_page_preview=True)
+#--------------------------------------------------------------------------------------------------------------------------------
+
+
+
+
+#------------------------------------------------ Лидерство (active/standby) ---------------------------------------------------
+# Несколько реплик на одном хосте делят один файл задач. Лидер держит эксклюзивный flock на LEADER_LOCK_PATH
+# и раз в LEADER_HEARTBEAT_SECONDS пишет в него heartbeat. Только лидер запускает планировщик, шлёт транзакции
+# и опрашивает Telegram. Остальные реплики ждут блокировку: ОС снимает её сразу, как только процесс лидера умер,
+# поэтому резервная реплика подхватывает работу за ~LEADER_POLL_SECONDS.
+class LeaderLease:
+    def __init__(self, path: str, replica_id: str):
+        self.path = path
+        self.replica_id = replica_id
+        self.fd = None
+        self.since = None
+
+    def read_lease(self) -> Dict:
+        """Текущее содержимое аренды (кто лидер и когда был последний heartbeat). Без блокировки."""
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                return json.loads(f.read() or "{}")
+        except (FileNotFoundError, json.JSONDecodeError):
+            return {}
+
+    def try_acquire(self) -> bool:
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(fd)
+            return False
+        self.fd = fd
+        self.since = time.time()
+        return True
+
+    def heartbeat(self):
+        data = json.dumps({"holder": self.replica_id, "pid": os.getpid(), "since": self.since, "heartbeat": time.time()})
+        os.ftruncate(self.fd, 0)
+        os.pwrite(self.fd, data.encode("utf-8"), 0)
+
+    def wait_for_leadership(self, on_standby=None):
+        """
+        Блокирует, пока реплика не станет лидером. Возвращает (предыдущая аренда, секунд с её последнего heartbeat) —
+        это верхняя оценка времени переключения. on_standby() вызывается один раз, если пришлось ждать.
+        """
+        stale_warned = False
+        waited = False
+        while not self.try_acquire():
+            if not waited:
+                waited = True
+                logging.info(f"⏸️ Реплика {self.replica_id} в резерве, лидер: {self.read_lease().get('holder')}")
+                if on_standby is not None:
+                    try:
+                        on_standby()
+                    except Exception as e:
+                        logging.error(f"❌ Ошибка подготовки резервной реплики: {e}")
+            lease = self.read_lease()
+            if not stale_warned and lease and time.time() - lease.get("heartbeat", 0) > LEADER_STALE_SECONDS:
+                # Процесс лидера жив (держит flock), но не пишет heartbeat — скорее всего, завис
+                logging.warning(f"⚠️ Heartbeat лидера {lease.get('holder')} не обновлялся больше {LEADER_STALE_SECONDS} с")
+                stale_warned = True
+            elif lease and time.time() - lease.get("heartbeat", 0) <= LEADER_STALE_SECONDS:
+                stale_warned = False
+            time.sleep(LEADER_POLL_SECONDS)
+
+        previous = self.read_lease()
+        self.heartbeat()
+        gap = time.time() - previous["heartbeat"] if previous.get("heartbeat") else None
+        return previous, gap
+
+    def start_heartbeat(self, health_check=None):
+        """Фоновый heartbeat. Если health_check() вернул False — завершаем процесс, чтобы отдать лидерство резерву."""
+        def run():
+            while True:
+                try:
+                    self.heartbeat()
+                except OSError as e:
+                    logging.error(f"❌ Не удалось записать heartbeat: {e}")
+                if health_check is not None and not health_check():
+                    logging.critical("❌ Лидер неисправен, освобождаю лидерство")
+                    os._exit(1)
+                time.sleep(LEADER_HEARTBEAT_SECONDS)
+
+        threading.Thread(target=run, name="leader-heartbeat", daemon=True).start()
 #--------------------------------------------------------------------------------------------------------------------------------
 
 
 
 
-# ------------------------------------------------- Запуск бота --------------------------------------------------------------------
-logging.info("Бот запущен...")
+#------------------------------------------------ IPC движка ---------------------------------------------------------------------
+# Процессы: engine — планировщик, кошелёк, файл задач и настройки; frontend — только поллинг Telegram.
+# Фронтенд шлёт команды движку по Unix-сокету ENGINE_SOCKET_PATH: одна строка JSON {"cmd", "args"} на соединение,
+# в ответ одна строка {"ok", "result" | "error"}. Процессы перезапускаются независимо: без фронтенда движок продолжает
+# выполнять расписание и слать уведомления, без движка фронтенд отвечает, что движок недоступен.
+ENGINE_REMOTE = False  # True в процессе frontend: команды уходят в сокет, а не вызываются напрямую
+
+
+class EngineUnavailable(Exception):
+    """Движок не отвечает (процесс перезапускается, сокета нет, истёк таймаут)."""
+
+
+class EngineCommandError(RuntimeError):
+    """Команда дошла до движка, но завершилась ошибкой. error_type — имя исключения на стороне движка."""
+
+    def __init__(self, message: str, error_type: str = None):
+        super().__init__(message)
+        self.error_type = error_type
 
-while True:
+
+def engine_call(cmd: str, **args):
+    if not ENGINE_REMOTE:
+        return ENGINE_COMMANDS[cmd](**args)
+
+    request = json.dumps({"cmd": cmd, "args": args}, ensure_ascii=False) + "\n"
     try:
-        logging.info("Бот запущен и ожидает новые посты и команды...")
-        bot.polling(none_stop=True, interval=0, timeout=40)
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.settimeout(ENGINE_CALL_TIMEOUT_SECONDS)
+            sock.connect(ENGINE_SOCKET_PATH)
+            sock.sendall(request.encode("utf-8"))
+            with sock.makefile("rb") as f:
+                line = f.readline()
+    except OSError as e:
+        raise EngineUnavailable(f"{cmd}: {e}") from e
+    if not line:
+        raise EngineUnavailable(f"{cmd}: движок закрыл соединение без ответа")
+
+    response = json.loads(line)
+    if not response["ok"]:
+        raise EngineCommandError(f"Ошибка команды движка {cmd}: {response['error']}", response.get("error_type"))
+    return response["result"]
+
+
+class _EngineRequestHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        cmd = None
+        try:
+            request = json.loads(self.rfile.readline())
+            cmd = request["cmd"]
+            with trace_span(f"ipc.{cmd}"):
+                response = {"ok": True, "result": ENGINE_COMMANDS[cmd](**request.get("args", {}))}
+        except Exception as e:
+            logging.error(f"❌ Ошибка команды движка {cmd}: {e}")
+            response = {"ok": False, "error": f"{type(e).__name__}: {e}", "error_type": type(e).__name__}
+        try:
+            self.wfile.write((json.dumps(response, ensure_ascii=False) + "\n").encode("utf-8"))
+        except OSError as e:
+            # Фронтенд не дождался (таймаут или перезапуск) — команда уже выполнена, просто теряем ответ
+            logging.info(f"[ERROR] Could not send engine response for {cmd}: {e}")
+
+
+def serve_engine_ipc():
+    """Принимает команды фронтенда. Блокирует вызывающий поток."""
+    os.makedirs(os.path.dirname(ENGINE_SOCKET_PATH) or ".", exist_ok=True)
+    # Сокет прошлого процесса движка (или упавшего лидера) остаётся файлом — убираем его перед bind
+    if os.path.exists(ENGINE_SOCKET_PATH):
+        os.unlink(ENGINE_SOCKET_PATH)
+    server = socketserver.ThreadingUnixStreamServer(ENGINE_SOCKET_PATH, _EngineRequestHandler)
+    server.daemon_threads = True
+    os.chmod(ENGINE_SOCKET_PATH, 0o660)
+    logging.info(f"Движок принимает команды на {ENGINE_SOCKET_PATH}")
+    server.serve_forever()
+#--------------------------------------------------------------------------------------------------------------------------------
 
+
+
+
+#------------------------------------ загрузка ------------------------------------------------------------------------------------
+def start_engine():
+    """Лидерство, восстановление расписания и фоновые потоки движка. Возвращается, когда всё запущено."""
+    # Ждём лидерства: пока другая реплика жива, эта стоит в резерве и ничего не делает
+    lease = LeaderLease(LEADER_LOCK_PATH, REPLICA_ID)
+    previous, gap = lease.wait_for_leadership(on_standby=_get_tron)  # в резерве заранее прогреваем tronpy
+    lease_acquired = time.monotonic()
+    scheduler_thread = None
+    lease.start_heartbeat(health_check=lambda: scheduler_thread is None or scheduler_thread.is_alive())
+
+    state.start()  # задачи и настройки (кнопка автослежения, checkpoint истории); дальше их меняет только поток state
+    reload_tunables(startup=True)  # переопределения из TUNABLES_PATH — до первого планирования
+    with _ledger_lock:
+        _get_rollups()  # сводки журнала кластеров; при расхождении с журналом пересчитываются здесь, а не в /stats
+
+    # Сверяем часы с сетью до восстановления расписания, чтобы просроченные кластеры определялись по времени сети
+    if CLOCK_SYNC_SECONDS > 0:
+        chain_clock.sync()
+
+    # Сразу восстанавливаем расписание из файла: просроченные кластеры (делегированы, но не возвращены)
+    # и уже начавшиеся обрабатываются до старта поллинга, не дожидаясь первого тика
+    try:
+        process_scheduled_tasks()
     except Exception as e:
-        # Логирование критической ошибки
-        logging.info(f"*** КРИТИЧЕСКАЯ ОШИБКА ВНЕ ПОЛЛИНГА: {e} ***")
-        # Ждём перед попыткой перезапуска
-        time.sleep(15)
+        log_error_crash(f"❌ Ошибка восстановления расписания при старте: {e}")
+    if previous.get("holder") and previous.get("holder") != REPLICA_ID and gap is not None:
+        log_work(
+            f"👑 Реплика `{REPLICA_ID}` стала лидером вместо `{previous['holder']}`.\n"
+            f"Переключение: ≤ {gap:.1f} с от последнего heartbeat, расписание восстановлено за "
+            f"{time.monotonic() - lease_acquired:.2f} с."
+        )
+    else:
+        boot_seconds = time.monotonic() - _BOOT_MONO
+        log_work(f"🚀 Бот запущен (`{REPLICA_ID}`). Расписание восстановлено за {boot_seconds:.2f} с.")
+
+    # Догоняем входящие делегации, пропущенные за время простоя; опоздавшие задачи запускаем сразу
+    if state.settings["monitoring_enabled"]:
+        try:
+            if backfill_incoming_delegations():
+                process_scheduled_tasks()
+        except Exception as e:
+            log_error_crash(f"❌ Ошибка догона истории при старте: {e}")
+
+    scheduler_thread = threading.Thread(target=scheduler_worker, name="scheduler", daemon=True)
+    scheduler_thread.start()
+
+    threading.Thread(target=status_worker, name="status", daemon=True).start()
+    threading.Thread(target=tunables_worker, name="tunables", daemon=True).start()
+
+    if CLOCK_SYNC_SECONDS > 0:
+        threading.Thread(target=clock_worker, name="clock", daemon=True).start()
+
+    if TELEMETRY_INTERVAL_SECONDS > 0:
+        init_telemetry()
+        threading.Thread(target=telemetry_worker, name="telemetry", daemon=True).start()
+
+    if REACTIVE_ENABLED:
+        threading.Thread(target=reactive_worker, name="reactive", daemon=True).start()
+
+
+def run_polling():
+    # ------------------------------------------------- Запуск бота --------------------------------------------------------------------
+    while True:
+        try:
+            logging.info("Бот запущен и ожидает новые посты и команды...")
+            bot.polling(none_stop=True, interval=0, timeout=40)
+
+        except Exception as e:
+            # Логирование критической ошибки
+            logging.info(f"*** КРИТИЧЕСКАЯ ОШИБКА ВНЕ ПОЛЛИНГА: {e} ***")
+            # Ждём перед попыткой перезапуска
+            time.sleep(15)
+
+
+def main():
+    # python botss.py [all|engine|frontend]: по умолчанию всё в одном процессе, как раньше
+    global ENGINE_REMOTE
+    role = sys.argv[1] if len(sys.argv) > 1 else "all"
+    if role not in ("all", "engine", "frontend"):
+        sys.exit(f"Использование: python {sys.argv[0]} [all|engine|frontend]")
+
+    threading.Thread(target=notifier_worker, name="notifier", daemon=True).start()
+
+    if role == "frontend":
+        ENGINE_REMOTE = True
+        logging.info(f"Фронтенд: команды уходят движку на {ENGINE_SOCKET_PATH}")
+        run_polling()
+        return
+
+    start_engine()
+    if role == "engine":
+        serve_engine_ipc()
+    else:
+        run_polling()
+
+
+if __name__ == "__main__":
+    main()
 #--------------------------------------------------------------------------------------------------------------------------------
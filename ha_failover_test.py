@@ -0,0 +1,157 @@
+"""
+Локальная проверка переключения лидера между репликами бота.
+
+Запускает несколько процессов-реплик с общим файлом аренды (LEADER_LOCK_PATH), убивает текущего лидера
+через SIGKILL и замеряет, через сколько резервная реплика берёт лидерство. Реплики используют тот же
+LeaderLease, что и botss.main(), но вместо планировщика и поллинга просто держат лидерство.
+
+Запуск:
+    python ha_failover_test.py --replicas 3 --rounds 5
+
+В конце печатается JSON-отчёт с временем каждого переключения.
+"""
+import argparse
+import json
+import os
+import queue
+import signal
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+# Фиктивная конфигурация: реплике нужен только импорт botss, в сеть она не ходит
+FAKE_ENV = {
+    "zone_time": "3",
+    "API_TOKEN": "123456:FAILOVER-TEST",
+    "API_KEY_TRONSCAN": "test",
+    "API_KEY_TRONGRID": "test",
+    "PRIV_KEY_MY_HEX": "11" * 32,
+    "PERM_ID": "9",
+    "MAIN_WALLET": "TMainWalletTest",
+    "STASHING_TARGET": "TStashTargetTest",
+    "ADMIN_IDS": "1",
+    "CHECK_INTERVAL_MINUTES": "10",
+    "SLICE_MINUTES": "5",
+    "TIME_BUY_ENERGY": "58",
+    "AUTO_HOLD_MINUTES": "5",
+}
+
+
+def run_replica():
+    """Процесс-реплика: ждёт лидерства, сообщает о нём в stdout и держит аренду до смерти."""
+    for key, value in FAKE_ENV.items():
+        os.environ.setdefault(key, value)
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import botss
+
+    lease = botss.LeaderLease(botss.LEADER_LOCK_PATH, botss.REPLICA_ID)
+    print(json.dumps({"event": "standby", "replica": botss.REPLICA_ID, "pid": os.getpid()}), flush=True)
+    previous, gap = lease.wait_for_leadership()
+    lease.start_heartbeat()
+    print(json.dumps({
+        "event": "leader", "replica": botss.REPLICA_ID, "pid": os.getpid(),
+        "previous": previous.get("holder"), "heartbeat_gap": gap,
+    }), flush=True)
+    while True:
+        time.sleep(3600)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--replicas", type=int, default=3)
+    parser.add_argument("--rounds", type=int, default=5)
+    parser.add_argument("--poll", type=float, default=1.0, help="LEADER_POLL_SECONDS для реплик")
+    parser.add_argument("--heartbeat", type=float, default=2.0, help="LEADER_HEARTBEAT_SECONDS для реплик")
+    parser.add_argument("--timeout", type=float, default=30.0, help="сколько ждать нового лидера, с")
+    parser.add_argument("--replica", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.replica:
+        run_replica()
+        return
+
+    workdir = tempfile.mkdtemp(prefix="ha_failover_")
+    env = dict(os.environ, **FAKE_ENV)
+    env.update({
+        "LEADER_LOCK_PATH": os.path.join(workdir, "leader.lock"),
+        "LEADER_POLL_SECONDS": str(args.poll),
+        "LEADER_HEARTBEAT_SECONDS": str(args.heartbeat),
+    })
+
+    events = queue.Queue()
+    procs = {}
+
+    def spawn(n):
+        env_n = dict(env, REPLICA_ID=f"replica-{n}")
+        proc = subprocess.Popen(
+            [sys.executable, os.path.abspath(__file__), "--replica"],
+            env=env_n, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True,
+        )
+        procs[proc.pid] = proc
+
+        def pump():
+            for line in proc.stdout:
+                try:
+                    events.put(json.loads(line))
+                except json.JSONDecodeError:
+                    pass
+
+        threading.Thread(target=pump, daemon=True).start()
+
+    def wait_leader():
+        deadline = time.monotonic() + args.timeout
+        while time.monotonic() < deadline:
+            try:
+                event = events.get(timeout=deadline - time.monotonic())
+            except queue.Empty:
+                break
+            if event["event"] == "leader":
+                return event
+        raise SystemExit("❌ Новый лидер не появился за отведённое время")
+
+    results = []
+    next_n = 0
+    try:
+        for _ in range(args.replicas):
+            spawn(next_n)
+            next_n += 1
+        leader = wait_leader()
+
+        for round_no in range(1, args.rounds + 1):
+            killed_at = time.monotonic()
+            os.kill(leader["pid"], signal.SIGKILL)
+            procs.pop(leader["pid"]).wait()
+            new_leader = wait_leader()
+            failover = time.monotonic() - killed_at
+            results.append({
+                "round": round_no,
+                "killed": leader["replica"],
+                "new_leader": new_leader["replica"],
+                "failover_seconds": round(failover, 3),
+                "heartbeat_gap_seconds": round(new_leader["heartbeat_gap"] or 0, 3),
+            })
+            print(f"раунд {round_no}: {leader['replica']} → {new_leader['replica']} за {failover:.2f} с", file=sys.stderr)
+            leader = new_leader
+            # Держим число реплик постоянным
+            spawn(next_n)
+            next_n += 1
+    finally:
+        for proc in procs.values():
+            proc.kill()
+
+    failovers = sorted(r["failover_seconds"] for r in results)
+    report = {
+        "replicas": args.replicas,
+        "poll_seconds": args.poll,
+        "heartbeat_seconds": args.heartbeat,
+        "rounds": results,
+        "failover_p50_seconds": failovers[len(failovers) // 2] if failovers else None,
+        "failover_max_seconds": failovers[-1] if failovers else None,
+    }
+    print(json.dumps(report, indent=2, ensure_ascii=False))
+
+
+if __name__ == "__main__":
+    main()
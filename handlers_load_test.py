@@ -0,0 +1,303 @@
+"""
+Нагрузочный прогон обработчиков Telegram на синтетических апдейтах.
+
+Поднимает локальный фейковый Bot API (HTTP на 127.0.0.1, отвечает как Telegram, включая лимит 4096 символов),
+направляет в него telebot и скармливает боту апдейты через bot.process_new_updates. Сценарий одного раунда:
+    список отложек → диалог «Отложить» (4 апдейта, добавляет задачу) → удаление задачи кнопкой → запрос не-админа.
+Число задач в хранилище за раунд не меняется. Прогон повторяется для каждого размера хранилища (--sizes).
+
+Обработчики выполняются синхронно (bot.threaded = False), поэтому задержка апдейта — это время его обработки.
+Файлы задач и настроек — во временной папке; к TronGrid/TronScan харнесс не обращается (кэш модели стоимости
+заполнен заранее и не устаревает за время прогона).
+
+Запуск:
+    python handlers_load_test.py --sizes 10,1000,10000 --rounds 100 --budget 120 --out report.json
+
+--budget ограничивает время на один размер: на 10k задач раунд идёт долго, и число выполненных раундов
+попадает в отчёт.
+
+Отчёт — JSON: по каждому размеру updates/sec, p50/p99 задержки по типам апдейтов, ошибки, прирост RSS
+и число записей файла задач.
+Отчёты разных версий сравниваются по полю git_rev.
+"""
+import argparse
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+ADMIN_ID = 1
+STRANGER_ID = 999
+
+# Фиктивная конфигурация: харнессу нужен только импорт botss
+FAKE_ENV = {
+    "zone_time": "3",
+    "API_TOKEN": "123456:LOAD-TEST",
+    "API_KEY_TRONSCAN": "test",
+    "API_KEY_TRONGRID": "test",
+    "PRIV_KEY_MY_HEX": "11" * 32,
+    "PERM_ID": "9",
+    "MAIN_WALLET": "TMainWalletTest",
+    "STASHING_TARGET": "TStashTargetTest",
+    "ADMIN_IDS": str(ADMIN_ID),
+    "CHECK_INTERVAL_MINUTES": "10",
+    "SLICE_MINUTES": "5",
+    "TIME_BUY_ENERGY": "58",
+    "AUTO_HOLD_MINUTES": "5",
+    "ENERGY_PRICE_TTL_MINUTES": str(365 * 24 * 60),
+    "TRACE_ENABLED": "0",
+}
+TELEGRAM_TEXT_LIMIT = 4096
+
+
+#------------------------------------------ Фейковый Bot API ------------------------------------------------------------
+class FakeBotAPI(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # keep-alive, как у настоящего API через requests.Session
+    disable_nagle_algorithm = True  # иначе заголовки и тело ответа ждут delayed ACK (~40 мс на запрос)
+    message_id = 0
+    lock = threading.Lock()
+    calls = {}
+
+    def do_GET(self):
+        self._answer()
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        if length:
+            self.rfile.read(length)
+        self._answer()
+
+    def _answer(self):
+        url = urlparse(self.path)
+        method = url.path.rsplit("/", 1)[-1]
+        params = {k: v[0] for k, v in parse_qs(url.query).items()}
+        with FakeBotAPI.lock:
+            FakeBotAPI.calls[method] = FakeBotAPI.calls.get(method, 0) + 1
+            FakeBotAPI.message_id += 1
+            message_id = FakeBotAPI.message_id
+
+        if len(params.get("text", "")) > TELEGRAM_TEXT_LIMIT:
+            self._send(400, {"ok": False, "error_code": 400, "description": "Bad Request: message is too long"})
+            return
+        if method in ("sendMessage", "editMessageText", "sendDocument"):
+            chat_id = int(params.get("chat_id", 0))
+            result = {
+                "message_id": int(params.get("message_id", message_id)),
+                "date": int(time.time()),
+                "chat": {"id": chat_id, "type": "private"},
+                "text": params.get("text", ""),
+            }
+        else:
+            result = True
+        self._send(200, {"ok": True, "result": result})
+
+    def _send(self, code, payload):
+        body = json.dumps(payload).encode("utf-8")
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+#------------------------------------------ Синтетические апдейты ------------------------------------------------------------
+class UpdateFactory:
+    def __init__(self):
+        self.update_id = 0
+
+    def _user(self, user_id):
+        return {"id": user_id, "is_bot": False, "first_name": "load"}
+
+    def _message(self, user_id, text):
+        self.update_id += 1
+        return {
+            "message_id": self.update_id,
+            "from": self._user(user_id),
+            "chat": {"id": user_id, "type": "private"},
+            "date": int(time.time()),
+            "text": text,
+        }
+
+    def message(self, text, user_id=ADMIN_ID):
+        from telebot import types
+        msg = self._message(user_id, text)
+        return types.Update.de_json({"update_id": self.update_id, "message": msg})
+
+    def callback(self, data, user_id=ADMIN_ID):
+        from telebot import types
+        msg = self._message(user_id, "list")
+        return types.Update.de_json({
+            "update_id": self.update_id,
+            "callback_query": {
+                "id": str(self.update_id),
+                "from": self._user(user_id),
+                "message": msg,
+                "chat_instance": "load",
+                "data": data,
+            },
+        })
+
+
+#------------------------------------------ Прогон ------------------------------------------------------------
+def rss_kb() -> int:
+    """Текущий RSS процесса (Linux: /proc), иначе пиковый."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") // 1024
+    except OSError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def percentile(values, q):
+    ordered = sorted(values)
+    return ordered[min(int(q * (len(ordered) - 1) + 0.5), len(ordered) - 1)]
+
+
+def seed_tasks(botss, count):
+    start = botss.chain_clock.now() + timedelta(days=1)
+    tasks = [
+        botss.new_task(start + timedelta(minutes=7 * i), start + timedelta(minutes=7 * i + 5), f"seed{i}")
+        for i in range(count)
+    ]
+    botss.state.remove_tasks(lambda t: True)
+    botss.state.add_tasks(tasks, dedup=False)
+
+
+def run_size(botss, factory, size, rounds, budget_seconds):
+    seed_tasks(botss, size)
+    latencies = {"tasks_list": [], "dialog_step": [], "delete_callback": [], "admin_gate": []}
+    errors = {name: 0 for name in latencies}
+    # Дата задачи из диалога — через сутки, как и у посеянных, чтобы она попадала в тот же план
+    when = (botss.chain_clock.now() + timedelta(days=1, minutes=3)).strftime("%Y-%m-%d %H:%M")
+
+    def feed(kind, update):
+        t0 = time.perf_counter()
+        try:
+            botss.bot.process_new_updates([update])
+        except Exception:
+            errors[kind] += 1
+        latencies[kind].append(time.perf_counter() - t0)
+
+    # Прогрев: импорт ленивых модулей, первый разбор файла
+    feed("tasks_list", factory.message("Показать Отложки 📋"))
+    for values in latencies.values():
+        values.clear()
+    for kind in errors:
+        errors[kind] = 0
+
+    rss_before = rss_kb()
+    flushes_before = botss.state.flushes
+    started = time.perf_counter()
+    updates = 0
+    done = 0
+    for _ in range(rounds):
+        # На больших хранилищах раунд может идти секунды — ограничиваем прогон по времени
+        if time.perf_counter() - started > budget_seconds:
+            break
+        feed("tasks_list", factory.message("Показать Отложки 📋"))
+        for text in ("Отложить ⏳", when, "6", "-"):
+            feed("dialog_step", factory.message(text))
+        active = [t for t in botss.state.tasks if not t["executed"]]
+        feed("delete_callback", factory.callback(f"delete_task_{active[0]['id']}" if active else "delete_task_none"))
+        feed("admin_gate", factory.message("/status", user_id=STRANGER_ID))
+        updates += 7
+        done += 1
+    elapsed = time.perf_counter() - started
+
+    return {
+        "stored_tasks": size,
+        "rounds": done,
+        "updates": updates,
+        "seconds": round(elapsed, 3),
+        "updates_per_sec": round(updates / elapsed, 1),
+        "handlers": {
+            kind: {
+                "n": len(values),
+                "p50_ms": round(percentile(values, 0.50) * 1000, 3),
+                "p99_ms": round(percentile(values, 0.99) * 1000, 3),
+                "errors": errors[kind],
+            }
+            for kind, values in latencies.items()
+        },
+        "rss_growth_kb": rss_kb() - rss_before,
+        "task_file_writes": botss.state.flushes - flushes_before,
+        "tasks_after": len(botss.load_scheduled_tasks()),
+    }
+
+
+def git_rev():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__)), timeout=5).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", default="10,1000,10000", help="размеры хранилища задач через запятую")
+    parser.add_argument("--rounds", type=int, default=100, help="раундов сценария на каждый размер")
+    parser.add_argument("--budget", type=float, default=120.0, help="не дольше стольких секунд на размер")
+    parser.add_argument("--out", help="куда записать JSON-отчёт (по умолчанию stdout)")
+    args = parser.parse_args()
+    sizes = [int(s) for s in args.sizes.split(",") if s.strip()]
+
+    for key, value in FAKE_ENV.items():
+        os.environ.setdefault(key, value)
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import logging
+    import telebot
+    import botss
+
+    # Ошибки обработчиков считаются в отчёте; логи botss (в том числе log_error_crash) только мешают
+    logging.getLogger().setLevel(logging.CRITICAL)
+    workdir = tempfile.mkdtemp(prefix="handlers_load_")
+    botss.path_json_otl = os.path.join(workdir, "scheduled_tasks.json")
+    botss.SETTINGS_PATH = os.path.join(workdir, "bot_settings.json")
+    botss.state.start()
+    botss._cost_model.update(updated=botss.chain_clock.now(), trx_energy_price=0.0002, hidden_trx=10_000)
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), FakeBotAPI)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    telebot.apihelper.API_URL = f"http://127.0.0.1:{server.server_address[1]}/bot{{0}}/{{1}}"
+    botss.bot.threaded = False
+    threading.Thread(target=botss.notifier_worker, name="notifier", daemon=True).start()
+
+    factory = UpdateFactory()
+    results = []
+    for size in sizes:
+        result = run_size(botss, factory, size, args.rounds, args.budget)
+        results.append(result)
+        print(f"{size} задач: {result['updates_per_sec']} upd/s, "
+              f"список p50 {result['handlers']['tasks_list']['p50_ms']} мс", file=sys.stderr)
+
+    report = {
+        "git_rev": git_rev(),
+        "python": platform.python_version(),
+        "telebot": telebot.__version__ if hasattr(telebot, "__version__") else None,
+        "mode": "sync",
+        "results": results,
+        "fake_api_calls": FakeBotAPI.calls,
+    }
+    text = json.dumps(report, indent=2, ensure_ascii=False)
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()